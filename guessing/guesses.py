@@ -0,0 +1,645 @@
+"""
+Enumerates the guesses of a grammar in decreasing probability order, as
+guessmaker does, in Python and with bounded memory.
+
+A guess is a base structure with a terminal for each of its tags, given by
+the positions of the terminals in their tag's list, which is sorted by
+decreasing probability. The guesses of a base structure form a tree rooted
+at the guess of its most probable terminals, in which a child increments
+one position, the pivot, of its parent (see Weir's dissertation):
+
+- next: a child only increments positions from its parent's pivot on.
+- deadbeat: a child is expanded only from its lowest probability parent.
+
+Either way, each guess has one parent, which is at least as probable.
+Instead of a priority queue, guesses are output in bands of probability
+[lower, upper): for each band, the trees are traversed depth-first,
+pruning guesses less probable than lower, and the guesses found in the
+band are sorted and output. Bands are sized so that at most about
+batch_size guesses are held in memory. The next band resumes from the
+guesses pruned by the previous one, its frontier, so that each guess is
+expanded once. The frontier holds at most frontier_size guesses: past that,
+it is dropped and the next band restarts from the roots, traversing again
+the guesses of earlier bands, which costs about N^2 / batch_size for N
+guesses output.
+
+To use several cores, the base structures are split into disjoint sets
+balanced by their estimated number of guesses (see partition_rules), which
+worker processes enumerate independently. Their outputs are merged into one
+stream in probability order, or written to one ordered file per worker (see
+parallel_guesses and write_parts).
+
+The guess number of a password, i.e., the number of guesses more probable,
+can be counted over the same sorted lists without enumerating the guesses
+(see GuessCounter).
+"""
+
+from operator import itemgetter
+
+import os
+import sys
+import math
+import heapq
+import itertools
+import queue
+import argparse
+import logging
+import traceback
+import multiprocessing
+import numpy as np
+
+from learning import model
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 200000
+FRONTIER_SIZE = 10**6  # unexpanded guesses kept between bands
+CHUNK_SIZE = 10000  # guesses sent from a worker at a time
+
+
+class GuessEnumerator(object):
+
+    ALGORITHMS = ['deadbeat', 'next']
+
+    def __init__(self, grammar, algorithm='deadbeat', min_prob=0,
+        batch_size=BATCH_SIZE, rules=None, frontier_size=FRONTIER_SIZE):
+        """
+        Args:
+            grammar - a learning.model.Grammar
+            algorithm - 'deadbeat' or 'next'
+            min_prob - optional - only guesses at least this probable are
+                enumerated (guesses of probability 0 never are)
+            batch_size - optional - the approximate max. number of guesses
+                held in memory
+            rules - optional - indices of the base structures to enumerate
+                (see RuleTable), by default all of them
+            frontier_size - optional - the max. number of unexpanded guesses
+                kept from one band to the next, beyond which bands restart
+                from the roots
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError("Unknown algorithm: {}".format(algorithm))
+
+        self.grammar    = grammar
+        self.deadbeat   = algorithm == 'deadbeat'
+        self.min_prob   = min_prob
+        self.batch_size = batch_size
+        self.frontier_size = frontier_size
+
+        # the smallest float above 0, so that guesses of probability 0 are
+        # never enumerated
+        self.floor = max(min_prob, float(np.nextafter(0, 1)))
+
+        self.rules = grammar.rules
+        self.rule_ids = list(range(len(self.rules))) if rules is None \
+            else list(rules)
+
+        self._probabilities = dict()  # tag ID -> list of probabilities
+
+    def _tag_probabilities(self, t):
+        """Return the probabilities of a tag's terminals as a list."""
+        probabilities = self._probabilities.get(t)
+        if probabilities is None:
+            probabilities = self._probabilities[t] = self.grammar.terminals\
+                .probabilities(self.rules.tags[t]).tolist()
+        return probabilities
+
+    def _rule(self, r):
+        """Return the probability of rule r and the lists of probabilities
+        of its tags' terminals."""
+        return float(self.rules.probabilities[r]), \
+            [self._tag_probabilities(t) for t in self.rules[r]]
+
+    @staticmethod
+    def _probability(p, lists, positions):
+        # always multiplied in the same order, so that a guess has the same
+        # probability whichever path led to it
+        for probabilities, i in zip(lists, positions):
+            p *= probabilities[i]
+        return p
+
+    def _is_lowest_parent(self, p_rule, lists, child, parent_p, pivot):
+        """ Whether the parent that child was generated from, by
+        incrementing position pivot, is the least probable of its parents
+        (ties go to the largest pivot). See Appendix B of Weir's
+        dissertation. """
+        for i, j in enumerate(child):
+            if i == pivot or j == 0:
+                continue
+            other = child[:i] + (j - 1,) + child[i+1:]
+            other_p = self._probability(p_rule, lists, other)
+            if other_p < parent_p or (other_p == parent_p and i > pivot):
+                return False
+        return True
+
+    def _roots(self):
+        """Return the frontier of the most probable guess of each base
+        structure (see _band)."""
+        frontier = dict()
+        for r in self.rule_ids:
+            p_rule, lists = self._rule(r)
+            if any(len(probabilities) == 0 for probabilities in lists):
+                continue
+            root = (0,) * len(lists)
+            p = self._probability(p_rule, lists, root)
+            if p >= self.floor:
+                frontier[r] = [(root, 0, p)]
+        return frontier
+
+    def _band(self, frontier, lower, upper, limit=None):
+        """ Traverse the guesses at least as probable as lower, starting
+        from a frontier, a dict mapping rules to lists of (positions, pivot,
+        p) of guesses not expanded yet.
+
+        Returns:
+            (found, pruned, below) - found is a list of (p, rule, positions)
+                of the guesses less probable than upper (None if there are
+                more than limit), pruned is the frontier of the guesses less
+                probable than lower (None if it holds more than
+                frontier_size guesses) and below is the probability of the
+                most probable of them (0 if none)
+        """
+        found = []
+        pruned = dict()
+        size = 0
+        below = 0.0
+        deadbeat = self.deadbeat
+
+        for r, nodes in frontier.items():
+            p_rule, lists = self._rule(r)
+            kept = []
+            stack = []
+            for node in nodes:
+                (stack if node[2] >= lower else kept).append(node)
+
+            while stack:
+                positions, pivot, p = stack.pop()
+                if p < upper:
+                    found.append((p, r, positions))
+                    if limit is not None and len(found) > limit:
+                        return None, None, below
+
+                for i in range(0 if deadbeat else pivot, len(lists)):
+                    j = positions[i] + 1
+                    if j == len(lists[i]):
+                        continue
+                    child = positions[:i] + (j,) + positions[i+1:]
+                    child_p = self._probability(p_rule, lists, child)
+                    if child_p < self.floor:
+                        continue
+
+                    if deadbeat and not self._is_lowest_parent(p_rule, lists,
+                            child, p, i):
+                        continue
+                    if child_p < lower:
+                        kept.append((child, i, child_p))
+                        continue
+                    stack.append((child, i, child_p))
+
+            if not kept:
+                continue
+            below = max(below, max(node[2] for node in kept))
+            size += len(kept)
+            if pruned is not None and size <= self.frontier_size:
+                pruned[r] = kept
+            else:
+                pruned = None
+
+        return found, pruned, below
+
+    def __iter__(self):
+        """ Yield guesses as (p, rule, positions), most probable first. """
+        upper    = math.inf
+        frontier = self._roots()
+        ref      = max((nodes[0][2] for nodes in frontier.values()),
+            default=0.0)
+        factor   = 0.5  # lower = ref * factor, adapted to batch_size
+
+        while ref >= self.floor:
+            lower = max(ref * factor, self.floor)
+            narrowest = factor > 0.999 or lower == self.floor
+            if frontier is None:  # too large, restart from the roots
+                frontier = self._roots()
+            found, pruned, below = self._band(frontier, lower, upper,
+                None if narrowest else self.batch_size)
+
+            if found is None:  # too many guesses, narrow the band
+                factor = math.sqrt(factor)
+                continue
+
+            log.debug("{} guesses in [{}, {})".format(len(found), lower,
+                upper))
+            if len(found) < self.batch_size // 4:  # widen the next band
+                factor = max(factor * factor, 1e-12)
+
+            found.sort(key=lambda guess: guess[0], reverse=True)
+            for guess in found:
+                yield guess
+
+            if lower == self.floor:
+                return
+            upper, ref, frontier = lower, below, pruned
+
+    def decode(self, r, positions):
+        """Return the terminals of a guess."""
+        terminals = self.grammar.terminals
+        vocabulary = terminals.vocabulary
+        words = []
+        for t, i in zip(self.rules[r], positions):
+            start, end = terminals.range(self.rules.tags[t])
+            words.append(vocabulary[terminals.words[start + i]])
+        return words
+
+
+class GuessCounter(object):
+    """ Counts the guesses of a grammar more probable than a password, i.e.,
+    its exact guess number, without enumerating them.
+
+    For a base structure with tags t1..tk, whose terminal probabilities are
+    sorted arrays, the guesses more probable than p are counted by recursing
+    over the terminals of t1..t(k-1) that can still lead to such a guess,
+    and counting those of tk by binary search. The work is at most
+    proportional to the number of guesses counted, hence the limit of count.
+    """
+
+    # guesses whose probability is within this relative difference of the
+    # password's are ties, not more probable (probabilities computed in a
+    # different order can differ in their last bits)
+    TIES = 1e-9
+
+    def __init__(self, grammar):
+        self.rules     = grammar.rules
+        self.terminals = grammar.terminals
+        self._arrays   = dict()  # tag ID -> probabilities, decreasing
+
+        roots, _ = rule_bounds(grammar)
+        self.order = np.argsort(-roots, kind='stable')
+        self.roots = roots[self.order]
+
+    def _tag_probabilities(self, t):
+        probabilities = self._arrays.get(t)
+        if probabilities is None:
+            tag = self.rules.tags[t]
+            probabilities = self._arrays[t] = self.terminals.probabilities(
+                tag) if tag in self.terminals else np.zeros(0)
+        return probabilities
+
+    def count(self, p, limit=None):
+        """ Return the number of guesses more probable than p, or None if
+        there are more than limit. """
+        threshold = p * (1 + self.TIES)
+        # the roots were multiplied in another order: keep those just below
+        n = int(np.searchsorted(-self.roots, -threshold * (1 - self.TIES),
+            side='left'))
+
+        total = 0
+        for r in self.order[:n].tolist():
+            lists = [self._tag_probabilities(t) for t in self.rules[r]]
+            budget = None if limit is None else limit - total
+            total += self._count(float(self.rules.probabilities[r]), lists,
+                threshold, budget)
+            if limit is not None and total > limit:
+                return None
+        return total
+
+    def _count(self, partial, lists, threshold, limit=None):
+        """ The number of combinations of terminals of lists whose product
+        with partial (multiplied left to right, as the enumerator does) is
+        greater than threshold; more than limit, if there are. """
+        if not lists:
+            return int(partial > threshold)
+        if len(lists) == 1:
+            return self._count_last(np.array([partial]), lists[0], threshold)
+
+        first, rest = lists[0], lists[1:]
+        if any(len(probabilities) == 0 for probabilities in rest):
+            return 0
+
+        # the terminals of the first tag that can lead to a guess above the
+        # threshold: those whose product with the rest's best is above it
+        tops = (0,) * len(rest)
+        lo, hi = 0, len(first)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if GuessEnumerator._probability(partial * first[mid], rest,
+                    tops) > threshold:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if len(rest) == 1:
+            return self._count_last(partial * first[:lo], rest[0], threshold)
+
+        total = 0
+        for q in first[:lo].tolist():
+            total += self._count(partial * q, rest, threshold,
+                None if limit is None else limit - total)
+            if limit is not None and total > limit:
+                break
+        return total
+
+    @staticmethod
+    def _count_last(partials, last, threshold):
+        """ The number of pairs (i, j) such that partials[i] * last[j] is
+        greater than threshold, for last in decreasing order. """
+        n = len(last)
+        if n == 0 or len(partials) == 0:
+            return 0
+
+        # binary search for the bound, then exact correction of rounding
+        j = np.searchsorted(-last, -(threshold / partials), side='left')
+        while True:
+            up = (j < n) & (partials * last[np.minimum(j, n - 1)] > threshold)
+            j = j + up
+            down = (j > 0) & ~(partials * last[np.maximum(j - 1, 0)] >
+                threshold)
+            j = j - down
+            if not up.any() and not down.any():
+                return int(j.sum())
+
+
+def is_gap(tag):
+    """Whether a tag's terminals are digits, symbols or characters, which
+    are not mangled."""
+    return tag.startswith(('number', 'special', 'char'))
+
+
+def mangle(words, tags):
+    """ Return the variants of a guess output by guessmaker --mangle:
+    lowercase, uppercase, camel case and capitalized, without duplicates.
+    Terminals of gap tags (see is_gap) are kept as they are. """
+    gaps = [is_gap(tag) for tag in tags]
+    if all(gaps):
+        return [''.join(words)]
+
+    def transform(f):
+        return ''.join(w if gap else f(w) for w, gap in zip(words, gaps))
+
+    lower = transform(str.lower)
+    upper = transform(str.upper)
+    camel = transform(lambda w: w[:1].upper() + w[1:].lower())
+    title = lower[:1].upper() + lower[1:]
+
+    guesses = [lower, upper]
+    if camel != upper:
+        guesses.append(camel)
+    if title != camel:
+        guesses.append(title)
+    return guesses
+
+
+def guesses(grammar, algorithm='deadbeat', min_prob=0, mangled=False,
+    min_length=0, batch_size=BATCH_SIZE, rules=None):
+    """ Enumerate the guesses of a grammar in decreasing probability order
+    (see GuessEnumerator).
+
+    Args:
+        mangled - optional - output the case variants of each guess (see
+            mangle)
+        min_length - optional - skip guesses shorter than this
+
+    Returns:
+        generator of tuples (guess, probability, base_struct)
+    """
+    enumerator = GuessEnumerator(grammar, algorithm, min_prob, batch_size,
+        rules)
+    rule_table = enumerator.rules
+
+    for p, r, positions in enumerator:
+        words = enumerator.decode(r, positions)
+        if mangled:
+            variants = mangle(words, rule_table.tag_names(r))
+        else:
+            variants = [''.join(words)]
+
+        for guess in variants:
+            if len(guess) >= min_length:
+                yield (guess, p, rule_table.format(r))
+
+
+def rule_bounds(grammar):
+    """ Return, for each base structure of a grammar, the probability of its
+    most probable guess and its number of guesses (the product of the sizes
+    of its tags), as two arrays. """
+    rules, terminals = grammar.rules, grammar.terminals
+
+    # the size and the highest probability of each tag of the rule table
+    sizes = np.diff(terminals.offsets)
+    first = np.zeros(len(sizes))
+    found = sizes > 0
+    first[found] = (terminals.counts[terminals.offsets[:-1][found]] +
+        terminals.alpha) / terminals.normalizers[found]
+    tag_ids = np.array([terminals.tag_ids.get(tag, -1) for tag in rules.tags],
+        dtype=np.int64)
+    tag_sizes = np.where(tag_ids >= 0, sizes[tag_ids], 0).astype(np.float64)
+    tag_first = np.where(tag_ids >= 0, first[tag_ids], 0)
+
+    # products over the slots of each base structure
+    nonempty = np.diff(rules.offsets) > 0
+    starts   = rules.offsets[:-1][nonempty]
+    slots    = rules.rule_tags
+    roots    = np.array(rules.probabilities, dtype=np.float64)
+    counts   = np.ones(len(rules))
+    if len(slots):
+        roots[nonempty] *= np.multiply.reduceat(tag_first[slots], starts)
+        counts[nonempty] = np.multiply.reduceat(tag_sizes[slots], starts)
+
+    return roots, counts
+
+
+def partition_rules(grammar, num_parts):
+    """ Split the base structures of a grammar into num_parts disjoint lists
+    with about as many guesses each (see rule_bounds). Base structures are
+    assigned in decreasing order of their most probable guess, each to the
+    list with the fewest guesses so far, so that lists also share the most
+    probable guesses. """
+    roots, estimates = rule_bounds(grammar)
+
+    parts = [[] for i in range(num_parts)]
+    loads = [(0.0, i) for i in range(num_parts)]
+
+    order = np.argsort(-roots, kind='stable')
+    for r, estimate in zip(order.tolist(), estimates[order].tolist()):
+        load, i = heapq.heappop(loads)
+        parts[i].append(r)
+        heapq.heappush(loads, (load + estimate, i))
+
+    return parts
+
+
+def _enumerate_part(grammar_dir, rules, args, output):
+    """ Enumerate the guesses of some base structures (in a worker process)
+    into a queue, in chunks, or into a file. """
+    try:
+        grammar = model.Grammar.from_files(grammar_dir)
+        stream  = guesses(grammar, rules=rules, **args)
+
+        if not isinstance(output, str):
+            chunk = []
+            for guess in stream:
+                chunk.append(guess)
+                if len(chunk) == CHUNK_SIZE:
+                    output.put(chunk)
+                    chunk = []
+            output.put(chunk)
+            output.put(None)
+        else:
+            with open(output, 'w') as f:
+                write_guesses(stream, f, verbose=True)
+    except Exception:
+        if isinstance(output, str):
+            raise
+        output.put(RuntimeError(traceback.format_exc()))
+
+
+def _drain(output, process):
+    """Yield the guesses a worker puts in a queue."""
+    while True:
+        try:
+            chunk = output.get(timeout=10)
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError("A guess generation worker died")
+            continue
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield from chunk
+
+
+def _start_workers(grammar_dir, num_workers, args, output):
+    """ Start a process for each set of base structures (see
+    partition_rules), which enumerates them into output(i), a queue or the
+    path of a file. Returns a list of (process, output). """
+    grammar = model.Grammar.from_files(grammar_dir, lazy=True)
+    parts = [part for part in partition_rules(grammar, num_workers) if part]
+
+    workers = []
+    for i, part in enumerate(parts):
+        out = output(i)
+        process = multiprocessing.Process(target=_enumerate_part,
+            args=(grammar_dir, part, args, out), daemon=True)
+        process.start()
+        workers.append((process, out))
+    return workers
+
+
+def _stop_workers(workers):
+    for process, output in workers:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def parallel_guesses(grammar_dir, num_workers, algorithm='deadbeat',
+    min_prob=0, mangled=False, min_length=0, batch_size=BATCH_SIZE,
+    max_chunks=8):
+    """ Enumerate guesses with num_workers processes, each over a set of
+    base structures (see partition_rules), and merge their outputs.
+
+    Args:
+        max_chunks - optional - the max. number of chunks of guesses a
+            worker gets ahead of the merge
+        others - see guesses
+
+    Returns:
+        generator of tuples (guess, probability, base_struct) in
+        decreasing probability order
+    """
+    args = dict(algorithm=algorithm, min_prob=min_prob, mangled=mangled,
+        min_length=min_length, batch_size=batch_size)
+    workers = _start_workers(grammar_dir, num_workers, args,
+        lambda i: multiprocessing.Queue(max_chunks))
+
+    try:
+        yield from heapq.merge(*[_drain(output, process) for process, output
+            in workers], key=itemgetter(1), reverse=True)
+    finally:
+        _stop_workers(workers)
+
+
+def write_parts(grammar_dir, folder, num_workers, algorithm='deadbeat',
+    min_prob=0, mangled=False, min_length=0, batch_size=BATCH_SIZE):
+    """ Enumerate guesses with num_workers processes, each over a set of
+    base structures (see partition_rules), into a file per process,
+    folder/guesses-<i>.txt, in decreasing probability order (see
+    write_guesses, verbose).
+
+    Returns:
+        the paths of the files
+    """
+    os.makedirs(folder, exist_ok=True)
+    args = dict(algorithm=algorithm, min_prob=min_prob, mangled=mangled,
+        min_length=min_length, batch_size=batch_size)
+    workers = _start_workers(grammar_dir, num_workers, args,
+        lambda i: os.path.join(folder, 'guesses-{}.txt'.format(i)))
+
+    try:
+        for process, path in workers:
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError("Guess generation failed for {}".format(
+                    path))
+    finally:
+        _stop_workers(workers)
+
+    return [path for process, path in workers]
+
+
+def write_guesses(stream, f, limit=None, verbose=False):
+    """ Write guesses to a file, a chunk at a time: one per line or, if
+    verbose, with their probability and base structure (tab-separated). """
+    buffer = []
+    for guess, p, base_struct in itertools.islice(stream, limit):
+        buffer.append('{}\t{}\t{}\n'.format(guess, p, base_struct)
+            if verbose else guess + '\n')
+        if len(buffer) == CHUNK_SIZE:
+            f.write(''.join(buffer))
+            buffer = []
+    f.write(''.join(buffer))
+
+
+def options():
+    parser = argparse.ArgumentParser(description='Generates guesses from a '
+        'grammar in decreasing probability order')
+    parser.add_argument('grammar_dir')
+    parser.add_argument('-m', '--mangle', action='store_true',
+        help='enables mangling rules')
+    parser.add_argument('-n', '--limit', type=int, default=None,
+        help='limits the number of guesses generated')
+    parser.add_argument('-l', '--length', type=int, default=0,
+        help='minimum length of the guesses')
+    parser.add_argument('-p', '--prob', type=float, default=0,
+        help='sets a minimum guess probability threshold')
+    parser.add_argument('-a', '--algorithm', default='deadbeat',
+        choices=GuessEnumerator.ALGORITHMS)
+    parser.add_argument('-b', '--batch_size', type=int, default=BATCH_SIZE,
+        help='approximate max. number of guesses held in memory')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='output the probability and base structure of each guess')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+        help='number of processes generating guesses, each over a share of '
+        'the base structures')
+    parser.add_argument('--parts', default=None,
+        help='with -w, write the guesses of each process to a file in this '
+        'folder (verbose, in probability order, without --limit) instead of '
+        'merging them')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts = options()
+    args = (opts.algorithm, opts.prob, opts.mangle, opts.length,
+        opts.batch_size)
+
+    if opts.num_workers > 1 and opts.parts:
+        write_parts(opts.grammar_dir, opts.parts, opts.num_workers, *args)
+        sys.exit()
+
+    if opts.num_workers > 1:
+        stream = parallel_guesses(opts.grammar_dir, opts.num_workers, *args)
+    else:
+        stream = guesses(model.Grammar.from_files(opts.grammar_dir), *args)
+
+    write_guesses(stream, sys.stdout, opts.limit, opts.verbose)
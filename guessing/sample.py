@@ -1,18 +1,135 @@
 """
 Outputs a password sample of a given size from a grammar.
+
+The sample is drawn in shards of SHARD_SIZE passwords, each with its own
+seed spawned from --seed, so that shards can be drawn by parallel workers
+and the output depends only on the seed, not on the number of workers.
 """
+from learning        import model
+from learning.corpus import StringTable
+
+import os
+import sys
+import shutil
+import zipfile
 import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+
+SHARD_SIZE = 1000000
+
+_grammar = None  # the grammar of a worker process
+
+
+def _init_worker(grammar_dir):
+    global _grammar
+    _grammar = model.Grammar.from_files(grammar_dir)
+
+
+def _sample_shard(task):
+    """Return the passwords and probabilities of a shard of the sample."""
+    n, seed = task
+    passwords, probabilities = [], []
+    for password, base_struct, p in _grammar.sample(n, rng=seed):
+        passwords.append(password)
+        probabilities.append(p)
+    return passwords, np.array(probabilities)
+
+
+def sample(grammar_dir, N, num_workers=1, seed=None, shard_size=SHARD_SIZE):
+    """ Draw a sample of N passwords from the grammar in grammar_dir.
+
+    Args:
+        num_workers - number of processes drawing shards
+        seed - optional - an int, for a reproducible sample
+
+    Returns:
+        generator of shards (list of passwords, array of probabilities), in
+        order
+    """
+    seeds = np.random.SeedSequence(seed).spawn(-(-N // shard_size))
+    tasks = [(min(shard_size, N - i * shard_size), s)
+        for i, s in enumerate(seeds)]
+
+    if num_workers <= 1:
+        _init_worker(grammar_dir)
+        for task in tasks:
+            yield _sample_shard(task)
+        return
+
+    with multiprocessing.Pool(num_workers, _init_worker,
+            (grammar_dir,)) as pool:
+        for shard in pool.imap(_sample_shard, tasks):
+            yield shard
+
+
+def write_text(shards, f):
+    """Write shards as lines password<TAB>probability, a shard at a time."""
+    for passwords, probabilities in shards:
+        f.write(''.join('{}\t{}\n'.format(password, p) for password, p
+            in zip(passwords, probabilities.tolist())))
+
+
+def write_npz(shards, path):
+    """ Write shards to a .npz file, with the probabilities in array 'p'
+    and the passwords as a StringTable (arrays 'passwords' and
+    'password_offsets'), e.g., for guessing.strength.
+
+    Each shard is appended to temporary files (next to path) as it arrives,
+    so that only one shard is held in memory, and the files are copied into
+    the archive at the end. """
+    folder = tempfile.mkdtemp(prefix='sample-',
+        dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        files = {name: open(os.path.join(folder, name), 'wb')
+            for name in ['p', 'passwords', 'password_offsets']}
+        n, nbytes = 0, 0
+        with files['p'], files['passwords'], files['password_offsets']:
+            for passwords, probabilities in shards:
+                table = StringTable.from_list(passwords)
+                files['p'].write(np.asarray(probabilities,
+                    dtype=np.float64).tobytes())
+                files['passwords'].write(table.blob.tobytes())
+                files['password_offsets'].write(
+                    (table.offsets[:-1] + nbytes).tobytes())
+                n += len(table)
+                nbytes += int(table.offsets[-1])
+            files['password_offsets'].write(
+                np.array([nbytes], dtype=np.int64).tobytes())
+
+        arrays = [('p', np.float64, n), ('passwords', np.uint8, nbytes),
+                  ('password_offsets', np.int64, n + 1)]
+        with zipfile.ZipFile(path, 'w', allowZip64=True) as archive:
+            for name, dtype, length in arrays:
+                with archive.open(name + '.npy', 'w', force_zip64=True) as f, \
+                        open(os.path.join(folder, name), 'rb') as data:
+                    np.lib.format.write_array_header_1_0(f, {
+                        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                        'fortran_order': False, 'shape': (length,)})
+                    shutil.copyfileobj(data, f, 2**20)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
 
-from learning import model
 
 def options():
     parser = argparse.ArgumentParser()
     parser.add_argument('N', type=int, default=1000)
     parser.add_argument('grammar_dir')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+        help='number of processes drawing the sample')
+    parser.add_argument('--seed', type=int, default=None,
+        help='seed for a reproducible sample (the same for any number of '
+        'workers)')
+    parser.add_argument('--npz', default=None,
+        help='write the sample to this binary .npz file, which '
+        'guessing.strength reads, instead of the standard output')
     return parser.parse_args()
 
 if __name__ == '__main__':
     opts = options()
-    grammar = model.Grammar.from_files(opts.grammar_dir)
-    for password, base_struct, p in grammar.sample(opts.N):
-        print("{}\t{}".format(password, p))
+    shards = sample(opts.grammar_dir, opts.N, opts.num_workers, opts.seed)
+    if opts.npz:
+        write_npz(shards, opts.npz)
+    else:
+        write_text(shards, sys.stdout)
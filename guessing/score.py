@@ -4,7 +4,10 @@ from nltk.corpus    import wordnet as wn
 from learning.train import getchunks, pos_tag, synset
 from learning       import model
 from learning.pos   import ExhaustiveTagger, BackoffTagger
+from learning.rules import RuleTable
+from guessing.guesses import GuessCounter
 from learning.tagset_conversion import TagsetConverter
+from misc.cache     import PersistentCache
 from functools      import reduce
 from itertools      import chain
 
@@ -77,18 +80,32 @@ def score_segmentation(result):
 
 
 class MemoTagger():
-    def __init__(self, postagger, tc_nouns, tc_verbs, grammar):
+    def __init__(self, postagger, tc_nouns, tc_verbs, grammar, cache=None):
+        """
+        Args:
+            cache - optional - a PersistentCache for the POS tags of strings,
+                shared across runs
+        """
         self.postagger = postagger
+        self.cache     = cache
         self.tc_nouns  = tc_nouns
         self.tc_verbs  = tc_verbs
         self.grammar   = grammar
+        self.terminals = grammar.terminals
         self.tagconv   = TagsetConverter()
-        self.tag_prob_cache = dict()
 
     @functools.lru_cache(maxsize=10000)
     def get_pos(self, string):
+        if self.cache is not None:
+            tags = self.cache.get(string)
+            if tags is not None:
+                return tags
+
         tags = self.postagger.get_tags(string)
         tags.append((string, None))
+
+        if self.cache is not None:
+            self.cache[string] = tags
         return tags
 
     @functools.lru_cache(maxsize=10000)
@@ -114,27 +131,7 @@ class MemoTagger():
         return self.grammar.tagger._get_tag(string, pos, synset, self.grammar.tagtype)
 
     def prob(self, tag, string):
-        tag_prob_cache = self.tag_prob_cache
-        grammar = self.grammar
-
-        if tag not in tag_prob_cache:
-            tag_prob_cache[tag] = dict()
-            samplesize          = sum(grammar.tag_dicts[tag].values())
-            vocabsize           = len(grammar.tag_dicts[tag])
-
-            if grammar.estimator == 'laplace':
-                estimator = model.LaplaceEstimator(samplesize, vocabsize, 1)
-            else:
-                estimator = model.MleEstimator(samplesize)
-
-            entries = map(lambda x, e=estimator: (x[0], e.probability(x[1])), grammar.tag_dicts[tag].items())
-
-            tag_prob_cache[tag].update(entries)
-
-        try:
-            return tag_prob_cache[tag][string]
-        except KeyError:
-            return 0
+        return self.terminals.prob(tag, string)
 
     @functools.lru_cache(maxsize=10000)
     def get_tags(self, word):
@@ -144,7 +141,7 @@ class MemoTagger():
             syns.add(None)
             for syn in syns:
                 segment_tag = self.get_segment_tag(word, pos, syn)
-                if segment_tag in self.grammar.tag_dicts:
+                if segment_tag in self.terminals:
                     p = self.prob(segment_tag, word)
                     tagset.add((segment_tag, p))
         return tagset
@@ -159,9 +156,9 @@ class GrammarTable():
     def __init__(self, grammar):
         records = []
 
-        for i, struct in enumerate(grammar.base_structures.keys()):
-            tags = re.findall("[\w\.]+", struct)
-            for j, tag in enumerate(tags):
+        rules = grammar.rules
+        for i in range(len(rules)):
+            for j, tag in enumerate(rules.tag_names(i)):
                 records.append((i, tag, j))
 
         self.table = pd.DataFrame.from_records(records,
@@ -175,20 +172,25 @@ class GrammarTable():
 
 class BaseStructChecker():
     def __init__(self, grammar):
-        self.cache = set()
-
-        for i, struct in enumerate(grammar.base_structures.keys()):
-            tags = re.findall("[\w\-\'\.]+", struct)
-            acc = ''
-            for tag in tags:
-                acc += '('+tag+')'
-                self.cache.add(acc)
+        self.rules = grammar.rules
+        self.cache = self.rules.prefixes()  # tuples of tag IDs
 
     def exists(self, tags):
-        if type(tags) == str:
+        """ Whether a sequence of tags starts a base structure of the
+        grammar. tags is a tuple of tag IDs (see RuleTable), a list of tags
+        or a base structure in string form. """
+        if type(tags) == tuple:
             return tags in self.cache
-        else:
-            return '('+')('.join(tags)+')' in self.cache
+        if type(tags) == str:
+            tags = RuleTable.parse(tags)
+
+        rule = []
+        for tag in tags:
+            t = self.rules.tag_ids.get(tag)
+            if t is None:
+                return False
+            rule.append(t)
+        return tuple(rule) in self.cache
 
 
 class GraphNode():
@@ -203,8 +205,9 @@ class GrammarGraph():
         self.edges = set()  # self.edges.add((id1, id2, position))
         self._next_node_id = 0
 
-        for struct in grammar.base_structures.keys():
-            tags = re.findall("[\w\.]+", struct)
+        rules = grammar.rules
+        for i in range(len(rules)):
+            tags = list(rules.tag_names(i))
             tags.insert(0, '^')
             tags.append('$')
             for i, (tag1, tag2) in enumerate(zip(tags[:-1], tags[1:])):
@@ -238,14 +241,15 @@ class GrammarGraph():
 
 
 class PrefixTreeNode():
-    def __init__(self, word, p=0, tag=None, parent=None):
+    def __init__(self, word, p=0, tag=None, parent=None, tag_id=None):
         self.word = word
         self.p = p
         self.parent = parent
         self.children = []
         self.depth = 0
         self.sequence_p = p
-        self.base_struct = '('+tag+')' if tag is not None else ''
+        # the base structure up to this node, as tag IDs (see RuleTable)
+        self.rule = (tag_id,) if tag_id is not None else ()
         self.tag = tag
 
     def append_child(self, node):
@@ -253,7 +257,7 @@ class PrefixTreeNode():
         node.parent = self
         node.depth = self.depth + 1
         node.sequence_p = node.p*self.sequence_p
-        node.base_struct = self.base_struct + node.base_struct
+        node.rule = self.rule + node.rule
 
     def dfs(self):
         stack = deque([self])
@@ -276,11 +280,15 @@ class PrefixTreeNode():
 
 
 def score(passwords, grammar, tc_nouns,
-    tc_verbs, postagger=None, vocab=None):
+    tc_verbs, postagger=None, vocab=None, cache=None):
     """
     For each password finds the most probable rule that outputs
     it, if any. The test is done with a lowercased version of the
     password.
+
+    Args:
+        cache - optional - a PersistentCache for POS tags (see
+            open_tag_cache)
     """
 
     if postagger is None:
@@ -288,8 +296,9 @@ def score(passwords, grammar, tc_nouns,
     if vocab is None:
         vocab = grammar.get_vocab()
 
-    memotagger = MemoTagger(postagger, tc_nouns, tc_verbs, grammar)
-    base_struct_dist = dict(grammar.base_structure_probabilities())
+    memotagger = MemoTagger(postagger, tc_nouns, tc_verbs, grammar, cache)
+    rules   = grammar.rules
+    tag_ids = rules.tag_ids
     checker = BaseStructChecker(grammar)
 
     # optimize for ordered lists with repeated passwords
@@ -305,15 +314,6 @@ def score(passwords, grammar, tc_nouns,
             yield last_yield
             continue
 
-        if password.isdigit():
-            base_struct = 'number'+str(len(password))
-            try:
-                yield (password, base_struct, base_struct_dist[base_struct])
-                continue
-            except:
-                pass
-
-
         segs = deque()
         root = PrefixTreeNode('', tag=None, p=1)
         segs.append((root, password))
@@ -321,7 +321,7 @@ def score(passwords, grammar, tc_nouns,
         # leaves = []
 
         max_p = 0
-        max_base_struct  = None
+        max_rule         = None
         max_segmentation = None
 
         while len(segs) > 0:
@@ -337,20 +337,20 @@ def score(passwords, grammar, tc_nouns,
                 for tag, p in memotagger.get_tags(newsplit[0].lower()):
                     # if this tag never occurs after the head tag in the grammar
                     # then ignore this split
-                    bs = head.base_struct + '(' + tag + ')'
-
-                    if not checker.exists(bs):
+                    t = tag_ids.get(tag)
+                    if t is None or not checker.exists(head.rule + (t,)):
                         continue
 
-                    newhead = PrefixTreeNode(newsplit[0], tag=tag, p=p)
+                    newhead = PrefixTreeNode(newsplit[0], tag=tag, p=p, tag_id=t)
                     head.append_child(newhead)
 
                     if newsplit[1] == '': # success!
-                        if newhead.base_struct in base_struct_dist:
-                            p = newhead.sequence_p * base_struct_dist[newhead.base_struct]
+                        i = rules.index.get(newhead.rule)
+                        if i is not None:
+                            p = newhead.sequence_p * rules.probabilities[i]
                             if p > max_p:
                                 max_p = p
-                                max_base_struct  = newhead.base_struct
+                                max_rule         = i
                                 max_segmentation = [node.word for node in newhead.prefix_path()]
                                 max_segmentation.reverse()
                         # leaves.append(newhead)
@@ -359,11 +359,19 @@ def score(passwords, grammar, tc_nouns,
                             segs.append((newhead, newsplit[1]))
 
         last_password = password
+        max_base_struct = rules.format(max_rule) if max_rule is not None \
+            else None
         last_yield    = (password, max_base_struct, max_segmentation, max_p)
 
         yield last_yield
 
 
+def open_tag_cache(path, postagger_path=None):
+    """Open the on-disk cache of ExhaustiveTagger's tags stored in path."""
+    return PersistentCache(path, 'exhaustive_pos',
+        ExhaustiveTagger.version(postagger_path))
+
+
 #%%------------------------------------------------------------------
 
 
@@ -411,6 +419,14 @@ def options():
         help='produce a match even when a password is capitalized')
     parser.add_argument('--print_split', action='store_true')
     parser.add_argument('--session_name')
+    parser.add_argument('--cache',
+        help='a file for caching POS tags across runs')
+    parser.add_argument('--lazy', action='store_true',
+        help=('load the terminals of a tag only when a password uses it '
+              '(faster for short lists)'))
+    parser.add_argument('--guess_number', type=int, metavar='LIMIT',
+        help=('also output the exact guess number of each password (the '
+              'number of guesses more probable), or - if it exceeds LIMIT'))
 
     return parser.parse_args()
 
@@ -429,7 +445,14 @@ if __name__ == '__main__':
     postagger = ExhaustiveTagger.from_pickle()
     tc_nouns  = pickle.load(open(grammar_dir / 'noun_treecut.pickle', 'rb'))
     tc_verbs  = pickle.load(open(grammar_dir / 'verb_treecut.pickle', 'rb'))
-    grammar   = model.Grammar.from_files(opts.grammar_dir)
+    grammar   = model.Grammar.from_files(opts.grammar_dir, opts.lazy)
+    cache     = open_tag_cache(opts.cache) if opts.cache else None
+    counter   = GuessCounter(grammar) if opts.guess_number is not None \
+        else None
+
+    def guess_number(prob):
+        n = counter.count(prob, opts.guess_number) if prob > 0 else None
+        return ['-' if n is None else n] if counter else []
 
     skip = 0
     if session_name:
@@ -444,10 +467,10 @@ if __name__ == '__main__':
 
     try:
         for password, struct, split, prob in score(passwords, grammar,
-            tc_nouns, tc_verbs, postagger, grammar.get_vocab()):
+            tc_nouns, tc_verbs, postagger, grammar.get_vocab(), cache):
 
             if prob == 0:
-                print(password, struct, prob)
+                print(password, struct, prob, *guess_number(prob))
                 continue
 
             if password.islower() or \
@@ -456,12 +479,13 @@ if __name__ == '__main__':
             accept_capital and password[0].isupper() and password[1:].islower():
 
                 if opts.print_split:
-                    print(password, struct, " ".join(split), prob)
+                    print(password, struct, " ".join(split), prob,
+                        *guess_number(prob))
                 else:
-                    print(password, struct, prob)
+                    print(password, struct, prob, *guess_number(prob))
 
             else:
-                print(password, None, 0)
+                print(password, None, 0, *guess_number(0))
 
             n_processed += 1
 
@@ -474,3 +498,5 @@ if __name__ == '__main__':
     finally:
         if session_name:
             save_progress(session_name, n_processed, completed)
+        if cache is not None:
+            cache.close()
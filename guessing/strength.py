@@ -16,8 +16,10 @@ import sys
 import numpy  as np 
 import pandas as pd
 
-from learning       import model
-from guessing.score import score
+from learning        import model
+from learning.corpus import StringTable
+from guessing.score  import score
+from guessing.guesses import GuessCounter
 from pathlib        import Path
 
 
@@ -37,8 +39,9 @@ def options():
 
     parser = argparse.ArgumentParser(description=desc, epilog=epilog)
     parser.add_argument('sample',
-        type=argparse.FileType('r'),
-        help='a large and diverse list of passwords and their probabilities')
+        help='a large and diverse list of passwords and their probabilities '
+        '(- for the standard input), or a .npz file written by '
+        'guessing.sample --npz')
     parser.add_argument('--grammar',
         help='grammar path for computing password probabilities.')
     parser.add_argument('--zeroes',
@@ -63,6 +66,16 @@ def options():
         help='a multiplier for the guess number estimate. Useful '
         'for when each guess is modified by a number of mangling '
         'rules.')
+    parser.add_argument('--exact',
+        metavar='GRAMMAR',
+        help='count the exact guess number of passwords with this grammar '
+        '(the one that scored them) instead of estimating it from the '
+        'sample, when it is at most --exact_limit')
+    parser.add_argument('--exact_limit',
+        type=int,
+        default=10**7,
+        help='largest guess number counted with --exact; the strength of '
+        'weaker passwords is estimated from the sample. Default is 10^7.')
 
     return parser.parse_args()
 
@@ -73,7 +86,21 @@ def p_converter(x):
         return None
 
 
-def read_sample(f):
+def read_sample(path, passwords=True):
+    """
+    Args:
+        passwords - optional - read the passwords too, not only the
+            probabilities (only matters for .npz samples)
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            sample = pd.DataFrame({'p': data['p']})
+            if passwords:
+                table = StringTable(data['passwords'], data['password_offsets'])
+                sample.insert(0, 'password', list(table))
+        return sample
+
+    f = sys.stdin if path == '-' else path
     return pd.read_csv(f, 
             sep='\t', 
             dtype={'password': object, 'p': np.float64}, 
@@ -107,7 +134,7 @@ def main():
 
     multiplier = opts.multiplier
 
-    sample = read_sample(opts.sample)  # a pandas frame
+    sample = read_sample(opts.sample, opts.dedupe)  # a pandas frame
     # drop duplicates
     if opts.dedupe:
         sample = sample.drop_duplicates("password")
@@ -128,12 +155,22 @@ def main():
     # restore index
     sample = sample.reset_index().drop("index", axis=1)
 
+    counter = GuessCounter(model.Grammar.from_files(opts.exact)) \
+        if opts.exact else None
+
     for password, struct, p in password_score_iterator(opts.passwords, opts.grammar):
         if p == 0:  # password isn't guessed by this grammar
             if opts.zeroes:
                 sys.stdout.write("{}\t{:.2f}\n".format(password, 0))
             continue
 
+        if counter is not None:
+            guess_number = counter.count(p, opts.exact_limit)
+            if guess_number is not None:
+                sys.stdout.write("{}\t{:.2f}\n".format(password,
+                    guess_number * multiplier))
+                continue
+
         # find bisector (index where elements should be inserted to maintain order)
         # invert Dellamico's 3.2 instruction since our array is in ascending order
         bisector = sample['p'].searchsorted(p, side='left')[0]  # note left
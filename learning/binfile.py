@@ -0,0 +1,92 @@
+"""
+A binary file of NumPy arrays with JSON metadata, read through mmap.
+
+Opening a file maps it read-only: arrays are views into the mapping, so
+loading costs no copies, and every process that opens the same file shares
+its pages through the page cache.
+
+Layout:
+
+    MAGIC | header length (uint64, little endian) | JSON header | arrays
+
+The header holds the metadata and, for each array, its dtype, shape and
+offset from the start of the file. Arrays are aligned to ALIGNMENT bytes.
+"""
+
+import os
+import json
+import mmap
+import struct
+import numpy as np
+
+MAGIC     = b'SGBIN\x00\x00\x01'
+ALIGNMENT = 64
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_arrays(path, arrays, meta=None):
+    """ Write arrays and metadata to a file. The file is written under a
+    temporary name and then renamed, so that processes that have the
+    previous version mapped keep reading it.
+
+    Args:
+        arrays - a dict of array name -> numpy.ndarray
+        meta - optional - a JSON-serializable dict
+    """
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+
+    # the header's size depends on the offsets, which depend on the
+    # header's size: reserve room for offsets of up to 20 digits
+    directory = {name: {'dtype': a.dtype.str, 'shape': list(a.shape),
+        'offset': 10**19} for name, a in arrays.items()}
+    header = json.dumps({'meta': meta or {}, 'arrays': directory})
+    offset = _aligned(len(MAGIC) + 8 + len(header.encode('utf-8')))
+
+    for name, a in arrays.items():
+        directory[name]['offset'] = offset
+        offset = _aligned(offset + a.nbytes)
+
+    header = json.dumps({'meta': meta or {}, 'arrays': directory})\
+        .encode('utf-8')
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, a in arrays.items():
+            f.write(b'\0' * (directory[name]['offset'] - f.tell()))
+            f.write(a.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_arrays(path):
+    """ Map a file written by write_arrays.
+
+    Returns:
+        (meta, arrays) - the metadata and a dict of read-only arrays backed
+            by the mapping, which stays open while any of them is referenced
+    """
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapping[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a binary grammar file (or has an "
+            "unsupported version)".format(path))
+
+    start = len(MAGIC) + 8
+    length, = struct.unpack('<Q', mapping[len(MAGIC):start])
+    header = json.loads(mapping[start:start+length].decode('utf-8'))
+
+    arrays = dict()
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        count = int(np.prod(shape)) if shape else 1
+        arrays[name] = np.frombuffer(mapping, dtype=dtype, count=count,
+            offset=spec['offset']).reshape(shape)
+
+    return header['meta'], arrays
@@ -0,0 +1,108 @@
+"""
+On-disk checkpoints of the training stages (tagged corpus, tree cut models,
+grammar), so that a training run can skip the stages whose inputs did not
+change since a previous run.
+
+Every artifact is stored under a key derived from everything that determines
+its contents (a digest of the password list, the options of the stage and the
+keys of the stages it depends on).
+"""
+
+import os
+import pickle
+import shutil
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def input_digest(password_file):
+    """Return a digest of a password list's contents, or None if the file
+    cannot be read twice (e.g., stdin)."""
+    path = getattr(password_file, 'name', None)
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return None
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class Checkpoints(object):
+
+    def __init__(self, folder=None):
+        """
+        Args:
+            folder - where to store the artifacts. If None, checkpointing is
+                disabled: nothing is saved and every stage is run.
+        """
+        self.folder = folder
+
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.folder is not None
+
+    def key(self, *parts):
+        """Return a key for an artifact determined by parts (e.g., the key
+        of its input and the options of the stage)."""
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def path(self, stage, key, folder=False):
+        """ The file of an artifact, or its folder if folder is True. """
+        name = '{}-{}' if folder else '{}-{}.pickle'
+        return os.path.join(self.folder, name.format(stage, key))
+
+    def exists(self, stage, key, folder=False):
+        return self.enabled and os.path.exists(self.path(stage, key, folder))
+
+    def load(self, stage, key, cls=None):
+        if cls is not None:
+            return cls.load(self.path(stage, key, True), mmap_mode='r')
+
+        with open(self.path(stage, key), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, stage, key, artifact, cls=None):
+        if not self.enabled:
+            return
+
+        # write to a temporary file first, so that an interrupted run never
+        # leaves a truncated artifact behind
+        path = self.path(stage, key, cls is not None)
+        if cls is not None:
+            shutil.rmtree(path + '.tmp', ignore_errors=True)
+            artifact.save(path + '.tmp')
+        else:
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(artifact, f, -1)
+        os.replace(path + '.tmp', path)
+
+    def run(self, stage, key, function, cls=None):
+        """Return the artifact of a stage, loading it from disk if it was
+        saved before or computing it with function() otherwise.
+
+        Args:
+            cls - optional - the class of the artifact, if it is stored as a
+                folder with artifact.save(folder) and loaded memory-mapped with
+                cls.load(folder, mmap_mode='r') (e.g., TaggedCorpus) instead
+                of pickled
+        """
+        if self.exists(stage, key, cls is not None):
+            log.info("Loading {} from checkpoint {}"
+                .format(stage, self.path(stage, key, cls is not None)))
+            return self.load(stage, key, cls)
+
+        artifact = function()
+        if not self.enabled:
+            return artifact
+
+        self.save(stage, key, artifact, cls)
+        if cls is not None:  # continue with the memory-mapped copy
+            artifact = self.load(stage, key, cls)
+        return artifact
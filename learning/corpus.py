@@ -0,0 +1,349 @@
+"""
+A compact, columnar form of a tagged password corpus.
+
+A tagged corpus is a list of passwords, each a list of (string, pos) chunks
+with a count. As Python lists of tuples it costs hundreds of bytes per
+chunk. Here, chunk strings, POS tags and synsets are interned and each chunk
+is a few integer IDs in NumPy arrays; password boundaries are given by an
+array of offsets:
+
+    the chunks of password i are tokens[offsets[i]:offsets[i+1]]
+
+A corpus can be saved as a folder of .npy files and loaded memory-mapped, so
+that worker processes read it without copying (see shared_corpus).
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+
+import os
+import sys
+import array
+import pickle
+import logging
+import tempfile
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class StringTable(object):
+    """ A read-only list of strings stored as one UTF-8 blob and an array of
+    offsets, so that it can be saved and memory-mapped like the other
+    columns. """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, strings):
+        encoded = [s.encode('utf-8', 'surrogatepass') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes()\
+            .decode('utf-8', 'surrogatepass')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def nbytes(self):
+        return self.blob.nbytes + self.offsets.nbytes
+
+
+class TaggedCorpus(object):
+
+    # the arrays saved as .npy files (see save)
+    COLUMNS = ['tokens', 'pos', 'offsets', 'counts']
+
+    def __init__(self, strings, tags, tokens, pos, offsets, counts):
+        """
+        Args:
+            strings - the distinct chunk strings (string ID -> str), a list
+                or a StringTable
+            tags - list of the distinct POS tags (POS ID -> tag or None)
+            tokens - array with the string ID of every chunk
+            pos - array with the POS ID of every chunk
+            offsets - array of len(counts) + 1 password boundaries
+            counts - array with the count of every password
+        """
+        self.strings = strings
+        self.tags    = tags
+        self.tokens  = tokens
+        self.pos     = pos
+        self.offsets = offsets
+        self.counts  = counts
+
+        # the synset ID of every chunk (-1 for none), see set_synsets
+        self.synsets = None
+        self.synset_names = []
+
+        self.path = None  # the folder the corpus was loaded from, if mapped
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def num_chunks(self):
+        return len(self.tokens)
+
+    def lengths(self):
+        """Return the number of chunks of every password."""
+        return np.diff(self.offsets)
+
+    def chunk_counts(self):
+        """Return the count of every chunk (its password's count)."""
+        return np.repeat(self.counts, self.lengths())
+
+    def passwords(self, start=0, end=None):
+        """ Iterate over passwords in the original form: tuples
+        (list of (string, pos), count). """
+        end = len(self) if end is None else end
+        strings, tags = self.strings, self.tags
+        offsets = self.offsets[start:end+1].tolist()
+        first, last = offsets[0], offsets[-1]
+        tokens = self.tokens[first:last].tolist()
+        pos = self.pos[first:last].tolist()
+
+        for i, count in enumerate(self.counts[start:end].tolist()):
+            a, b = offsets[i] - first, offsets[i+1] - first
+            yield ([(strings[tokens[j]], tags[pos[j]]) for j in range(a, b)],
+                count)
+
+    def __iter__(self):
+        return self.passwords()
+
+    def _pair_keys(self):
+        return self.tokens.astype(np.int64) * len(self.tags) + self.pos
+
+    def pairs(self):
+        """Return the distinct (string, pos) pairs of the corpus."""
+        T = len(self.tags)
+        return [(self.strings[key // T], self.tags[key % T])
+            for key in np.unique(self._pair_keys()).tolist()]
+
+    def set_synsets(self, table):
+        """ Assign a synset to every chunk.
+
+        Args:
+            table - a dict mapping (string, pos) pairs to synset names.
+                Chunks whose pair is absent get no synset (-1).
+        """
+        T = len(self.tags)
+        self.synset_names = sorted(set(table.values()))
+        ids = {name: i for i, name in enumerate(self.synset_names)}
+
+        keys, inverse = np.unique(self._pair_keys(), return_inverse=True)
+        pair_synsets = np.array([ids.get(table.get(
+            (self.strings[key // T], self.tags[key % T])), -1)
+            for key in keys.tolist()], dtype=np.int32)
+        self.synsets = pair_synsets[inverse.reshape(-1)]
+
+    def synset_counts(self):
+        """Return a Counter of synset names, weighted by password counts."""
+        found = self.synsets >= 0
+        totals = np.bincount(self.synsets[found],
+            weights=self.chunk_counts()[found],
+            minlength=len(self.synset_names))
+
+        return Counter({name: total for name, total
+            in zip(self.synset_names, totals.tolist()) if total})
+
+    def nbytes(self):
+        """Approximate memory used by the corpus, in bytes."""
+        arrays = [self.tokens, self.pos, self.offsets, self.counts]
+        if self.synsets is not None:
+            arrays.append(self.synsets)
+
+        strings = self.tags + self.synset_names
+        if isinstance(self.strings, StringTable):
+            nbytes = self.strings.nbytes
+        else:
+            strings = strings + self.strings
+            nbytes = 0
+
+        return nbytes + sum(a.nbytes for a in arrays) + \
+            sum(sys.getsizeof(s) for s in strings)
+
+    def save(self, folder):
+        """ Save the corpus in a folder (created if necessary): one .npy
+        file per array, including the synsets column if set. """
+        os.makedirs(folder, exist_ok=True)
+
+        strings = self.strings if isinstance(self.strings, StringTable) \
+            else StringTable.from_list(self.strings)
+        np.save(os.path.join(folder, 'strings.npy'), strings.blob)
+        np.save(os.path.join(folder, 'string_offsets.npy'), strings.offsets)
+
+        for column in self.COLUMNS:
+            np.save(os.path.join(folder, column + '.npy'), getattr(self, column))
+
+        if self.synsets is not None:
+            np.save(os.path.join(folder, 'synsets.npy'), self.synsets)
+
+        with open(os.path.join(folder, 'vocabulary.pickle'), 'wb') as f:
+            pickle.dump({'tags': self.tags, 'synset_names': self.synset_names},
+                f, -1)
+
+    @classmethod
+    def load(cls, folder, mmap_mode=None):
+        """ Load a corpus saved with save().
+
+        Args:
+            mmap_mode - optional - see numpy.load. With 'r', the arrays are
+                memory-mapped read-only and shared by every process that
+                loads them.
+        """
+        def load_array(name):
+            return np.load(os.path.join(folder, name + '.npy'),
+                mmap_mode=mmap_mode)
+
+        with open(os.path.join(folder, 'vocabulary.pickle'), 'rb') as f:
+            vocabulary = pickle.load(f)
+
+        corpus = cls(StringTable(load_array('strings'),
+            load_array('string_offsets')), vocabulary['tags'],
+            *[load_array(column) for column in cls.COLUMNS])
+
+        if os.path.exists(os.path.join(folder, 'synsets.npy')):
+            corpus.synsets = load_array('synsets')
+            corpus.synset_names = vocabulary['synset_names']
+
+        if mmap_mode is not None:
+            corpus.path = folder
+
+        return corpus
+
+
+class CorpusHandle(object):
+    """ A picklable reference to a corpus on disk, which worker processes
+    open memory-mapped (see shared_corpus). """
+
+    def __init__(self, path, synsets_path=None, synset_names=None):
+        self.path = path
+        self.synsets_path = synsets_path
+        self.synset_names = synset_names
+
+    def open(self):
+        corpus = TaggedCorpus.load(self.path, mmap_mode='r')
+        if self.synsets_path is not None:
+            corpus.synsets = np.load(self.synsets_path, mmap_mode='r')
+            corpus.synset_names = self.synset_names
+        return corpus
+
+
+@contextmanager
+def shared_corpus(corpus, tmpdir=None):
+    """ Make a corpus readable by worker processes without copying it.
+
+    Yields a CorpusHandle. If the corpus was loaded memory-mapped, workers
+    map the same files (only a synsets column set afterwards is written to
+    a temporary folder); otherwise, the corpus is saved to a temporary
+    folder first. Temporary files are removed on exit.
+
+    Args:
+        tmpdir - optional - where to create the temporary folder
+    """
+    with tempfile.TemporaryDirectory(dir=tmpdir) as folder:
+        if corpus.path is None:
+            path = os.path.join(folder, 'corpus')
+            corpus.save(path)
+            yield CorpusHandle(path)
+        elif corpus.synsets is not None and \
+                not isinstance(corpus.synsets, np.memmap):
+            synsets_path = os.path.join(folder, 'synsets.npy')
+            np.save(synsets_path, corpus.synsets)
+            yield CorpusHandle(corpus.path, synsets_path, corpus.synset_names)
+        else:
+            yield CorpusHandle(corpus.path)
+
+
+class CorpusBuilder(object):
+    """ Accumulates tagged passwords (e.g., as batches arrive from workers)
+    and builds a TaggedCorpus. """
+
+    SAMPLE_SIZE = 10000  # passwords measured to estimate the size as lists
+
+    def __init__(self):
+        self.string_ids = dict()
+        self.tag_ids    = dict()
+        self.tokens  = array.array('i')
+        self.pos     = array.array('h')
+        self.lengths = array.array('i')
+        self.counts  = array.array('q')
+
+        # to estimate the memory the corpus would take as lists of tuples
+        self.sampled_bytes  = 0
+        self.sampled_chunks = 0
+
+    def add(self, chunks, count):
+        """
+        Args:
+            chunks - list of (string, pos) tuples
+            count - the password's count
+        """
+        string_ids, tag_ids = self.string_ids, self.tag_ids
+
+        for string, pos in chunks:
+            i = string_ids.get(string)
+            if i is None:
+                i = string_ids[string] = len(string_ids)
+            self.tokens.append(i)
+
+            j = tag_ids.get(pos)
+            if j is None:
+                j = tag_ids[pos] = len(tag_ids)
+            self.pos.append(j)
+
+        self.lengths.append(len(chunks))
+        self.counts.append(count)
+
+        if len(self.counts) <= self.SAMPLE_SIZE:
+            self.sampled_bytes += _tuple_size(chunks, count)
+            self.sampled_chunks += len(chunks)
+
+    def extend(self, passwords):
+        for chunks, count in passwords:
+            self.add(chunks, count)
+
+    def list_nbytes(self):
+        """Estimate the memory the corpus would use as a list of tuples."""
+        if not self.sampled_chunks:
+            return 0
+        return self.sampled_bytes / self.sampled_chunks * len(self.tokens)
+
+    def build(self):
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(self.lengths, dtype=np.int32), out=offsets[1:])
+
+        corpus = TaggedCorpus(
+            strings = StringTable.from_list(self.string_ids),
+            tags    = list(self.tag_ids),
+            tokens  = np.frombuffer(self.tokens, dtype=np.int32).copy(),
+            pos     = np.frombuffer(self.pos, dtype=np.int16).copy(),
+            offsets = offsets,
+            counts  = np.frombuffer(self.counts, dtype=np.int64).copy())
+
+        log.info("Tagged corpus: {} passwords, {} chunks, {} distinct strings "
+            "in {:.1f} MB (about {:.1f} MB as lists of tuples)".format(
+            len(corpus), corpus.num_chunks, len(corpus.strings),
+            corpus.nbytes() / 2**20, self.list_nbytes() / 2**20))
+
+        return corpus
+
+
+def _tuple_size(chunks, count):
+    """Size of a (list of (string, pos), count) tuple and its contents."""
+    size = sys.getsizeof((chunks, count)) + sys.getsizeof(chunks) + \
+        sys.getsizeof(count)
+    for chunk in chunks:
+        size += sys.getsizeof(chunk) + sum(sys.getsizeof(x) for x in chunk)
+    return size
@@ -1,6 +1,10 @@
-from learning.tree.wordnet      import IndexedWordNetTree
+from learning.tree.wordnet      import IndexedWordNetTree, load_tree
 from learning.tree.default_tree import TreeCut
-from learning.tree.cut          import wagner, li_abe
+from learning.tree.array_tree   import ArrayTree
+from learning.tree.cut          import wagner, li_abe, findcuts
+from learning.terminals         import TerminalStore
+from learning.rules             import RuleTable
+from learning                   import binfile
 from collections                import defaultdict, Counter
 from multiprocessing            import Process, Manager, Pool, Queue
 
@@ -14,6 +18,9 @@ import logging
 import numpy as np
 import pickle
 import math
+import itertools
+import copy
+import array
 import multiprocessing
 
 
@@ -24,13 +31,38 @@ class TreeCutModel():
         """
         Args:
             pos: the part-of-speech of this tree: 'v' (verb) or 'n' (noun)
+            specificity: None for Li & Abe's cut, an integer > 0 for Wagner's
+                cut with that weight, or a list of those to fit one cut per
+                value (the levels of the model, see predict)
         """
+        if isinstance(specificity, (list, tuple)):
+            specificities = list(specificity)
+        else:
+            specificities = [specificity]
+
         self.pos  = pos
         self.tree = None
-        self.treecut = None
-        self.specificity = specificity
+        self.specificities = specificities
+        self.treecuts = []
+        self.description_lengths = []
+        self.level = 0  # default level for predict
         self.estimator = estimator
 
+    @property
+    def specificity(self):
+        return self.specificities[self.level]
+
+    @property
+    def treecut(self):
+        return self.treecuts[self.level] if self.treecuts else None
+
+    def at_level(self, level):
+        """ Return a copy of this model (sharing the tree and cuts) whose
+        default level is level. """
+        model = copy.copy(self)
+        model.level = level
+        return model
+
     def fit(self, X):
         """ Fit a tree cut model.
 
@@ -41,32 +73,19 @@ class TreeCutModel():
           self
         """
         pos  = self.pos
-        specificity = self.specificity
 
-        self.tree = tree = IndexedWordNetTree(pos)
+        self.tree = tree = load_tree(pos)
         for synset, count in X:
             if synset.pos() == pos:
                 self._increment_synset_count(synset, count)
         tree.updateCounts()
 
-        N = tree.root.value
-        if self.estimator == 'mle':
-            estimator = MleEstimator(N)
-        else:
-            k = tree.root.leaf_count
-            estimator = LaplaceEstimator(N, k, 1)
-
-        if specificity:
-            cut = wagner.findcut(tree, specificity, estimator)
-        else:
-            cut = li_abe.findcut(tree, estimator)
-
-        self.treecut = TreeCut(tree, cut)
+        self.fit_tree(tree)
+        return self
 
 
     def fit_tree(self, tree):
-        pos  = self.pos
-        specificity = self.specificity
+        """ Fit the cuts of every level on a tree with updated counts. """
         self.tree = tree
 
         N = tree.root.value
@@ -76,37 +95,108 @@ class TreeCutModel():
             k = tree.root.leaf_count
             estimator = LaplaceEstimator(N, k, 1)
 
-        if specificity:
-            cut = wagner.findcut(tree, specificity, estimator)
+        # 0 used to mean Li & Abe's cut
+        specificities = [s if s else None for s in self.specificities]
+        cuts = findcuts(tree, specificities, estimator)
+
+        self.treecuts = [TreeCut(tree, cut) for cut, dl in cuts]
+        self.description_lengths = [dl for cut, dl in cuts]
+
+
+    def update(self, tree):
+        """ Fold the counts of another tree (e.g., counted on a new password
+        list) into this model and refit the tree cut if there are new counts.
+
+        Args:
+            tree: a WordNetTree (or ArrayWordNetTree) of the same
+                part-of-speech and WordNet version
+
+        Returns:
+            a dict mapping the key of every class of the previous cut that is
+            not preserved by the new cut to a Counter of the new classes that
+            replace it, weighted by their share of the class' leaf counts.
+        """
+        if isinstance(self.tree, ArrayTree) and isinstance(tree, ArrayTree):
+            if len(self.tree) != len(tree):
+                raise ValueError("Trees do not match: {} and {} nodes."
+                    .format(len(self.tree), len(tree)))
+
+            new_values = np.where(tree.is_leaf, tree.value, 0)
+            if not new_values.any():
+                return dict()  # the cut cannot change
+
+            self.tree.value += new_values
         else:
-            cut = li_abe.findcut(tree, estimator)
+            leaves = self.tree.leaves()
+            new_leaves = tree.leaves()
 
-        self.treecut = TreeCut(tree, cut)
+            if len(leaves) != len(new_leaves):
+                raise ValueError("Trees do not match: {} and {} leaves."
+                    .format(len(leaves), len(new_leaves)))
 
+            if not any(leaf.value for leaf in new_leaves):
+                return dict()  # the cut cannot change
 
-    def predict(self, X):
+            for leaf, new_leaf in zip(leaves, new_leaves):
+                leaf.value += new_leaf.value
+        self.tree.root.updateCounts()
+
+        old_treecut = self.treecut
+        self.fit_tree(self.tree)
+
+        return self._cut_changes(old_treecut, self.treecut)
+
+    @staticmethod
+    def _cut_changes(old_treecut, new_treecut):
+        """ See update(). Both cuts must be on the same tree. """
+        changes = defaultdict(Counter)
+
+        for node in old_treecut:
+            if node in new_treecut:
+                changes[node.key][node.key] += 1
+                continue
+
+            # each leaf is dominated by exactly one node in the new cut,
+            # either an ancestor (generalization) or a descendant (refinement)
+            # of the old class
+            for leaf in node.leaves():
+                x = leaf
+                while x not in new_treecut:
+                    x = x.parent
+                changes[node.key][x.key] += leaf.value + 1
+
+        return {key: targets for key, targets in changes.items()
+            if set(targets) != {key}}
+
+    def predict(self, X, level=None):
         """
         For each synset, return a list of classes that represent it in the tree
         cut model. The *list* is due to a synset potentially being present in
         multiple subtrees (multiple inheritance).
 
         Args:
-            X - an iterable or a wordnet.Synset
+            X - an iterable or a wordnet.Synset or a synset name (str)
+            level - optional - the index of the cut in self.specificities
+                (default: self.level)
 
         Return:
             if X is an iterable, return a list of lists of node keys (str)
-            if X is a Synset, return a list of node keys (str)
+            if X is a Synset or name, return a list of node keys (str)
         """
 
+        treecut = self.treecuts[self.level if level is None else level]
+
         try:
+            if isinstance(X, str):
+                raise TypeError
             iter(X)
         except:
-            return list(set([node.key for node in self.treecut.abstract_synset(X)]))
+            return list(set([node.key for node in treecut.abstract_synset(X)]))
 
         labels = []
 
         for synset in X:
-            keys = set([node.key for node in self.treecut.abstract_synset(synset)])
+            keys = set([node.key for node in treecut.abstract_synset(synset)])
             labels.append(list(keys))
 
         return labels
@@ -141,23 +231,34 @@ class TreeCutModel():
             # the line below would insert the synset in the tree
             # I kept this line just in case there is problem with WordNetTree
             # coverage
-            print(synset, count)
+            log.warning("{} is not fully indexed in the tree, inserting it "
+                "(count {})".format(key, count))
             self.tree.increment_synset(synset, count, cumulative=False)
 
     def __getstate__(self):
         return {
             'pos': self.pos,
-            'treecut': self.treecut,
-            'specificity': self.specificity,
+            'treecuts': self.treecuts,
+            'specificities': self.specificities,
+            'description_lengths': self.description_lengths,
+            'level': self.level,
             'estimator': self.estimator
         }
 
     def __setstate__(self, d):
         self.pos = d['pos']
-        self.treecut = d['treecut']
-        self.specificity = d['specificity']
+        if 'treecuts' in d:
+            self.treecuts = d['treecuts']
+            self.specificities = d['specificities']
+            self.description_lengths = d['description_lengths']
+            self.level = d['level']
+        else:  # a model with a single cut
+            self.treecuts = [d['treecut']]
+            self.specificities = [d['specificity']]
+            self.description_lengths = [None]
+            self.level = 0
         self.estimator = d['estimator']
-        self.tree = self.treecut.tree
+        self.tree = self.treecuts[0].tree
 
     def pickle(self, outfolder):
         name = 'noun_treecut.pickle' if self.pos == 'n' else 'verb_treecut.pickle'
@@ -196,6 +297,10 @@ class MleEstimator(Estimator):
     def _probability(self, f, n):
         return float(f)/n
 
+    def probabilities(self, f, c=None):
+        """Vectorized probability, for arrays of class frequencies f."""
+        return f / self.n
+
 
 class LaplaceEstimator(Estimator):
     """
@@ -227,6 +332,11 @@ class LaplaceEstimator(Estimator):
     def _probability(self, f, c, n, k, alpha, *args):
         return float(f + c*alpha)/(n + k*alpha)
 
+    def probabilities(self, f, c):
+        """Vectorized probability, for arrays of class frequencies f and
+        leaf counts c."""
+        return (f + c*self.alpha)/(self.n + self.k*self.alpha)
+
 
 def _datafile(name):
     return open(os.path.join(os.path.dirname(__file__), '../data/'+name),
@@ -375,41 +485,353 @@ class GrammarTagger(object):
             string in GrammarTagger.Surnames or \
             string in GrammarTagger.Countries
 
-class Processor(object):
+def count_factorized(tagger, tagtype, x, count, tags, base_structures):
+    """ Add the counts of an observation in factorized form to tags and
+    base_structures.
 
-    def __init__(self, tagger, tagtype):
-        self.tagger = tagger
-        self.tagtype = tagtype
+    x has, for each chunk, the list of its variants (string, pos, synset),
+    e.g., one per class of a polysemous word. It stands for every combination
+    of variants, each with an equal share of count, but the combinations are
+    never listed: a variant's terminal count is count/len(variants), and base
+    structures are only expanded over the distinct tags of each chunk.
+    """
+    options = []
+    for variants in x:
+        share = count / len(variants)
+        weights = Counter()
+        for string, pos, synset in variants:
+            tag = tagger._get_tag(string, pos, synset, tagtype)
+            tags[tag][string] += share
+            weights[tag] += 1 / len(variants)
+        options.append(list(weights.items()))
+
+    for combination in itertools.product(*options):
+        weight = count
+        base_structure = ''
+        for tag, share in combination:
+            weight *= share
+            base_structure += '({})'.format(tag)
+        base_structures[base_structure] += weight
 
-    def __call__(self, data):
 
-        process_id = multiprocessing.current_process()._identity[0]
+class GrammarCounts(object):
+    """
+    The counts of a grammar over a set of observations (e.g., a shard of a
+    password list), with tags and terminals encoded as integers:
+
+    - tags - list of the distinct tags (tag ID -> tag)
+    - strings - sequence of terminals (string ID -> str), or None if the
+        IDs refer to a table kept elsewhere (e.g., the strings of a
+        TaggedCorpus)
+    - terminal_tags, terminal_strings, terminal_counts - arrays with the
+        count of every distinct (tag ID, string ID) pair
+    - structure_tags, structure_offsets - the distinct base structures as
+        sequences of tag IDs: base structure i is
+        structure_tags[structure_offsets[i]:structure_offsets[i+1]]
+    - structure_counts - array with their counts
+
+    Counts are aggregated by sorting (numpy.unique) and summing groups
+    (numpy.bincount), rather than by updating dicts once per observation.
+    Partial counts are combined the same way (see reduce).
+    """
+
+    def __init__(self, tags, strings, terminal_tags, terminal_strings,
+        terminal_counts, structure_tags, structure_offsets, structure_counts):
+        self.tags    = tags
+        self.strings = strings
+        self.terminal_tags    = terminal_tags
+        self.terminal_strings = terminal_strings
+        self.terminal_counts  = terminal_counts
+        self.structure_tags    = structure_tags
+        self.structure_offsets = structure_offsets
+        self.structure_counts  = structure_counts
+
+    @classmethod
+    def from_chunks(cls, tagger, tagtype, chunk_keys, variants, offsets,
+        counts, key_strings=None, single_full_count=False):
+        """ Count observations given as chunks with integer keys.
+
+        Args:
+            chunk_keys - array with the key of every chunk, in [0, K)
+            variants - for each of the K keys, the list of the chunk's
+                variants (string, pos, synset), e.g., one per class of a
+                polysemous word. As in count_factorized, an observation
+                stands for every combination of the variants of its
+                chunks, with equal shares of its count.
+            offsets - array of observation boundaries: the chunks of
+                observation i are chunk_keys[offsets[i]:offsets[i+1]]
+            counts - array with the count of every observation
+            key_strings - optional - for each key, the ID of its string in a
+                table kept elsewhere (strings is then None); otherwise,
+                strings are numbered here
+            single_full_count - if True, each variant of an observation of a
+                single chunk gets its whole count, rather than a share
+        """
+        K = len(variants)
+        tag_ids, string_ids = dict(), dict()
+
+        # tag each distinct chunk once: rows for the terminal counts of
+        # each variant, and options (tag ID, weight) for base structures,
+        # merging variants with the same tag
+        term_key, term_tag, term_string = [], [], []
+        options = []
+        num_variants = np.zeros(K, dtype=np.float64)
+        first_tag = np.zeros(K, dtype=np.int32)
+        ambiguous = np.zeros(K, dtype=bool)
+
+        for k, chunk in enumerate(variants):
+            weights = dict()
+            for string, pos, synset in chunk:
+                tag = tagger._get_tag(string, pos, synset, tagtype)
+                t = tag_ids.setdefault(tag, len(tag_ids))
+                s = key_strings[k] if key_strings is not None \
+                    else string_ids.setdefault(string, len(string_ids))
+                term_key.append(k)
+                term_tag.append(t)
+                term_string.append(s)
+                weights[t] = weights.get(t, 0) + 1 / len(chunk)
+
+            options.append(list(weights.items()))
+            num_variants[k] = len(chunk)
+            first_tag[k] = options[k][0][0]
+            ambiguous[k] = len(weights) > 1
+
+        term_key = np.array(term_key, dtype=np.int64)
+        chunk_keys = np.asarray(chunk_keys, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.float64)
+        lengths = np.diff(offsets)
+        single = np.repeat(lengths == 1, lengths)
+
+        weights = np.repeat(counts, lengths)
+        if single_full_count:
+            weights = np.where(single, weights * num_variants[chunk_keys],
+                weights)
+
+        # terminals: the total weight of each key, shared by its variants
+        totals = np.bincount(chunk_keys, weights=weights, minlength=K)
+        terminals = _group_pairs(np.array(term_tag, dtype=np.int64),
+            np.array(term_string, dtype=np.int64),
+            totals[term_key] / num_variants[term_key])
+
+        # base structures of single chunks: one per option of their key
+        option_key = np.array([k for k, o in enumerate(options) for _ in o],
+            dtype=np.int64)
+        option_tag = np.array([t for o in options for t, w in o],
+            dtype=np.int64)
+        option_weight = np.array([w for o in options for t, w in o],
+            dtype=np.float64)
+        single_totals = np.bincount(chunk_keys[single],
+            weights=weights[single], minlength=K)
+        found = np.bincount(chunk_keys[single], minlength=K)[option_key] > 0
+        sequences = [(option_tag[found], np.ones(found.sum(), dtype=np.int64),
+            (single_totals[option_key] * option_weight)[found])]
+
+        # of several chunks, each with a single tag: one tag sequence each
+        observation = np.repeat(np.arange(len(counts)), lengths)
+        mixed = np.bincount(observation, weights=ambiguous[chunk_keys],
+            minlength=len(counts)) > 0
+        plain = (lengths > 1) & ~mixed
+        plain_chunks = np.repeat(plain, lengths)
+        sequences.append((first_tag[chunk_keys[plain_chunks]], lengths[plain],
+            counts[plain]))
+
+        # with a chunk of several tags: expand the combinations of tags
+        expanded_tags, expanded_lengths, expanded_counts = [], [], []
+        for i in np.flatnonzero((lengths > 1) & mixed).tolist():
+            keys = chunk_keys[offsets[i]:offsets[i+1]].tolist()
+            for combination in itertools.product(*[options[k] for k in keys]):
+                weight = counts[i]
+                for t, share in combination:
+                    expanded_tags.append(t)
+                    weight *= share
+                expanded_lengths.append(len(keys))
+                expanded_counts.append(weight)
+        sequences.append((np.array(expanded_tags, dtype=np.int64),
+            np.array(expanded_lengths, dtype=np.int64),
+            np.array(expanded_counts, dtype=np.float64)))
+
+        if np.any(lengths == 0):
+            log.warning("Unable to feed {} observations without chunks to "
+                "grammar.".format(np.count_nonzero(lengths == 0)))
+
+        structures = _group_sequences(*[np.concatenate(column)
+            for column in zip(*sequences)])
+
+        strings = None if key_strings is not None else list(string_ids)
+        return cls(list(tag_ids), strings, *terminals, *structures)
+
+    @classmethod
+    def from_observations(cls, tagger, tagtype, X, factorized=False):
+        """ Count observations in the form taken by Grammar.fit: tuples
+        (x, count), where x is a list of (string, pos, synset), or a list
+        of lists of them if factorized is True. """
+        key_ids = dict()
+        key_id = key_ids.setdefault
+        chunk_keys, lengths, counts = array.array('q'), [], []
+
+        for x, count in X:
+            if factorized:
+                x = [tuple(chunk) for chunk in x]
+            chunk_keys.extend([key_id(chunk, len(key_ids)) for chunk in x])
+            lengths.append(len(x))
+            counts.append(count)
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        variants = [list(key) if factorized else [key] for key in key_ids]
+
+        return cls.from_chunks(tagger, tagtype,
+            np.frombuffer(chunk_keys, dtype=np.int64), variants, offsets,
+            counts)
 
-        # log.info("Process {} received {} items.".format(process_id, len(data)))
+    @classmethod
+    def reduce(cls, parts):
+        """ Combine partial counts (e.g., of the shards of a list) into one.
+
+        Tag and string IDs are mapped to common vocabularies, then the
+        counts of all parts are aggregated at once. Parts whose strings are
+        None must refer to the same table.
+        """
+        parts = list(parts)
+        tag_ids = dict()
+        shared_strings = all(part.strings is None for part in parts)
+        string_ids = dict()
+
+        terminals, structures = [], []
+        for part in parts:
+            tag_map = np.array([tag_ids.setdefault(tag, len(tag_ids))
+                for tag in part.tags], dtype=np.int64)
+            strings = part.terminal_strings
+            if not shared_strings:
+                string_map = np.array([string_ids.setdefault(s,
+                    len(string_ids)) for s in part.strings], dtype=np.int64)
+                strings = string_map[strings]
+
+            terminals.append((tag_map[part.terminal_tags], strings,
+                part.terminal_counts))
+            structures.append((tag_map[part.structure_tags],
+                np.diff(part.structure_offsets), part.structure_counts))
+
+        if not parts:
+            terminals = structures = [(np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64), np.zeros(0))]
+
+        return cls(list(tag_ids), None if shared_strings else list(string_ids),
+            *_group_pairs(*[np.concatenate(c) for c in zip(*terminals)]),
+            *_group_sequences(*[np.concatenate(c) for c in zip(*structures)]))
+
+    def to_dicts(self, strings=None):
+        """ Return the counts in the form of Grammar.add_counts: a dict of
+        Counters of strings by tag, and a Counter of base structures.
+
+        Args:
+            strings - the table of strings, if self.strings is None
+        """
+        tags = self.tags
+        strings = self.strings if strings is None else strings
+
+        tag_dicts = defaultdict(Counter)
+        for t, s, count in zip(self.terminal_tags.tolist(),
+                self.terminal_strings.tolist(), self.terminal_counts.tolist()):
+            tag_dicts[tags[t]][strings[s]] += count
 
-        tags = defaultdict(Counter)
         base_structures = Counter()
+        flat, offsets = self.structure_tags.tolist(), \
+            self.structure_offsets.tolist()
+        for i, count in enumerate(self.structure_counts.tolist()):
+            base_structures[''.join('({})'.format(tags[t])
+                for t in flat[offsets[i]:offsets[i+1]])] += count
 
-        for x, count in data:
-            base_structure = ''
-            for string, pos, synset in x:
-                tag = self.tagger._get_tag(string, pos, synset, self.tagtype)
-                tags[tag][string] += count
-                base_structure += '({})'.format(tag)
+        return tag_dicts, base_structures
 
-            base_structures[base_structure] += count
 
+def _group_pairs(first, second, weights):
+    """ Sum the weights of equal (first, second) pairs of IDs.
 
-        # log.info("Process {} has done its share. Time to rest.".format(process_id))
-        return (tags, base_structures)
+    Returns:
+        tuple of arrays (first, second, sums), one entry per distinct pair
+    """
+    if len(first) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+            np.zeros(0))
+    n = int(second.max()) + 1
+    keys, inverse = np.unique(first * n + second, return_inverse=True)
+    sums = np.bincount(inverse.reshape(-1), weights=weights,
+        minlength=len(keys))
+    return keys // n, keys % n, sums
+
+
+def _group_sequences(flat, lengths, weights):
+    """ Sum the weights of equal sequences of IDs, given concatenated in
+    flat, with their lengths. Sequences of each length are compared as the
+    rows of a matrix.
+
+    Returns:
+        tuple of arrays (flat, offsets, sums), one sequence per distinct
+        sequence
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    groups, group_lengths, sums = [], [], []
+    for length in np.unique(lengths).tolist():
+        rows = np.flatnonzero(lengths == length)
+        matrix = flat[offsets[rows][:, None] + np.arange(length)]
+        unique, inverse = np.unique(matrix, axis=0, return_inverse=True)
+        groups.append(unique.reshape(-1))
+        group_lengths.append(np.full(len(unique), length, dtype=np.int64))
+        sums.append(np.bincount(inverse.reshape(-1), weights=weights[rows],
+            minlength=len(unique)))
+
+    if not groups:
+        return (np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+            np.zeros(0))
+
+    group_lengths = np.concatenate(group_lengths)
+    offsets = np.zeros(len(group_lengths) + 1, dtype=np.int64)
+    np.cumsum(group_lengths, out=offsets[1:])
+    return np.concatenate(groups), offsets, np.concatenate(sums)
+
+
+class Processor(object):
+
+    def __init__(self, tagger, tagtype, factorized=False):
+        """
+        Args:
+            factorized - if True, observations are in factorized form (see
+                count_factorized)
+        """
+        self.tagger = tagger
+        self.tagtype = tagtype
+        self.factorized = factorized
+
+    def __call__(self, data):
+        """Return the GrammarCounts of a list of observations."""
+        return GrammarCounts.from_observations(self.tagger, self.tagtype,
+            data, self.factorized)
 
 
 class Grammar(object):
 
+    # number of partial counts of workers combined at a time
+    REDUCE_EVERY = 8
+
+    # the binary form of a grammar in its folder (see write_binary)
+    BINARY_FILE = 'grammar.bin'
+
+    # tags whose tables are kept in memory by lazily loaded grammars
+    LAZY_CACHE_SIZE = 256
+
+    # samples drawn at a time (see sample)
+    SAMPLE_BATCH = 100000
+
     def __init__(self, tagtype='backoff', estimator='mle'):
-        self.base_structures = Counter()
+        self._base_structures = Counter()
+        self._rules           = None
         self.probabilities   = dict()
-        self.tag_dicts       = defaultdict(Counter)
+        self._tag_dicts      = defaultdict(Counter)
+        self._terminals      = None
         # self.verb_treecut = None
         # self.noun_treecut = None
         self.estimator = estimator
@@ -419,6 +841,58 @@ class Grammar(object):
         # booleans
         self.lowres = None
         self.tagtype = tagtype
+        self.lazy = False  # see from_binary
+
+    @property
+    def tag_dicts(self):
+        """ The counts of the terminals of each tag, as a dict of Counters,
+        for fitting and updating the grammar. If the grammar was loaded,
+        they are rebuilt from its TerminalStore, which is discarded: it is
+        built again from the counts when needed (see terminals). """
+        if self._tag_dicts is None:
+            self._tag_dicts = self._terminals.to_counters()
+        self._terminals = None
+        return self._tag_dicts
+
+    @tag_dicts.setter
+    def tag_dicts(self, tag_dicts):
+        self._tag_dicts = tag_dicts
+        self._terminals = None
+
+    @property
+    def base_structures(self):
+        """ The counts of the base structures, as a Counter of their string
+        forms, for fitting and updating the grammar. As tag_dicts, they are
+        rebuilt from the RuleTable of a loaded grammar, which is discarded
+        (see rules). """
+        if self._base_structures is None:
+            self._base_structures = self._rules.to_counter()
+        self._rules = None
+        return self._base_structures
+
+    @base_structures.setter
+    def base_structures(self, base_structures):
+        self._base_structures = base_structures
+        self._rules = None
+
+    @property
+    def rules(self):
+        """ The base structures as sequences of tag IDs with their
+        probabilities, in a RuleTable, for lookups and sampling. """
+        if self._rules is None:
+            self._rules = RuleTable.from_counts(self._base_structures)
+            self._base_structures = None
+        return self._rules
+
+    @property
+    def terminals(self):
+        """ The terminals of each tag with their probabilities, in a
+        TerminalStore, for lookups and sampling. """
+        if self._terminals is None:
+            self._terminals = TerminalStore.from_counts(self._tag_dicts,
+                alpha=1 if self.estimator == 'laplace' else 0)
+            self._tag_dicts = None
+        return self._terminals
 
     def add_vocabulary(self, vocab):
         tagger = GrammarTagger()
@@ -427,15 +901,13 @@ class Grammar(object):
             self.tag_dicts[tag][string] = 0
 
     def get_vocab(self):
-        vocab = set()
-        for tag_dict in self.tag_dicts.values():
-            for word in tag_dict.keys():
-                vocab.add(word)
-        return vocab
+        if self.lazy:
+            return self.terminals.vocabulary_set()
+        return set(self.terminals.vocabulary)
 
     def _get_tag_prob_estimator(self,tag):
-        samplesize          = sum(self.tag_dicts[tag].values())
-        vocabsize           = len(self.tag_dicts[tag])
+        samplesize          = self.terminals.total(tag)
+        vocabsize           = self.terminals.size(tag)
         if self.estimator == 'laplace':
             estimator = LaplaceEstimator(samplesize, vocabsize, 1)
         else:
@@ -443,13 +915,108 @@ class Grammar(object):
 
         return estimator
 
-    def fit_parallel(self, X, num_workers=4):
-        import gc
-        gc.collect()
-        pool = Pool(num_workers, maxtasksperchild=2)
+    def merge(self, other):
+        """ Add the counts of another grammar (e.g., fitted on a new password
+        list with the same tree cut models) to this one. """
+        self.base_structures.update(other.base_structures)
+        for tag, terminals in other.tag_dicts.items():
+            self.tag_dicts[tag].update(terminals)
+        self.counter += other.counter
+
+    def relabel(self, changes, resolve=None):
+        """ Replace semantic classes in tags, e.g., after a tree cut model
+        was refitted (see TreeCutModel.update).
+
+        Args:
+            changes - a dict mapping old classes to Counters of the new
+                classes replacing them, with weights
+            resolve - optional - a function (word, old class, set of new
+                classes) that returns the new classes a word belongs to. The
+                counts of a word are split evenly among them. When not given
+                or when it returns an empty list, counts are split according
+                to the weights in changes.
+        """
+        def relabel_tag(tag):
+            """Return (prefix, class) if tag has a class in changes."""
+            if tag in changes:
+                return '', tag
+            # pos_semantic tags have the form pos_class; in other tag types,
+            # '_' is part of a class (e.g., ice_cream.n.01)
+            if self.tagtype != 'pos_semantic':
+                return None
+            prefix, _, classy = tag.partition('_')
+            if classy in changes:
+                return prefix + '_', classy
+            return None
+
+        # share of each new tag in the counts of each relabeled tag
+        tag_shares = dict()
+
+        for tag in list(self.tag_dicts.keys()):
+            relabeled = relabel_tag(tag)
+            if relabeled is None:
+                continue
+
+            prefix, classy = relabeled
+            targets = changes[classy]
+            total_weight = sum(targets.values())
+            candidates = set(targets)
+            shares = Counter()
+
+            for word, count in self.tag_dicts.pop(tag).items():
+                classes = resolve(word, classy, candidates) if resolve else []
+                if classes:
+                    weights = [(c, 1 / len(classes)) for c in classes]
+                else:
+                    weights = [(c, w / total_weight) for c, w in targets.items()]
+
+                for new_class, weight in weights:
+                    new_tag = prefix + new_class
+                    self.tag_dicts[new_tag][word] += count * weight
+                    shares[new_tag] += count * weight
+
+            total = sum(shares.values())
+            if total == 0:  # only unseen words, so split by class weights
+                shares = Counter({prefix + c: w for c, w in targets.items()})
+                total = total_weight
+            tag_shares[tag] = [(t, c / total) for t, c in shares.items()]
+
+        if not tag_shares:
+            return
+
+        for struct in list(self.base_structures.keys()):
+            tags = RuleTable.parse(struct)
+            if not any(tag in tag_shares for tag in tags):
+                continue
+
+            count = self.base_structures.pop(struct)
+            options = [tag_shares.get(tag, [(tag, 1)]) for tag in tags]
+            for combination in itertools.product(*options):
+                weight = 1
+                new_struct = ''
+                for tag, share in combination:
+                    weight *= share
+                    new_struct += '({})'.format(tag)
+                self.base_structures[new_struct] += count * weight
+
+    def fit_parallel(self, X, num_workers=4, pool=None):
+        """
+        Args:
+            pool - optional - a pool of processes to run on, with a
+                multiprocessing.Pool-like imap_unordered (e.g., the
+                learning.train.WorkerPool of a training run). If not
+                given, a Pool of num_workers is started for this call.
+        """
+        if pool is None:
+            import gc
+            gc.collect()
+            with Pool(num_workers) as pool:
+                return self.fit_parallel(X, num_workers, pool)
+
+        num_workers = getattr(pool, 'num_workers', num_workers)
 
-        share = min(int(2e5), math.ceil(len(X)/num_workers))
-        # share = int(1e5)
+        # small batches, handed out as workers become free
+        share = max(1, min(int(2e4), math.ceil(len(X)/(num_workers * 8))))
         tagger = GrammarTagger()
 
         num_parts = math.ceil(len(X)/share)
@@ -457,23 +1024,48 @@ class Grammar(object):
 
         # delegate work to all available processes
         i  = 0
-        for result in pool.imap(Processor(tagger, self.tagtype), x_gen):
-            tag_results, base_struct_results = result
-            for base_struct, count in base_struct_results.items():
-                self.base_structures[base_struct] += count
-                self.counter += count
-            for tag, terminals in tag_results.items():
-                for string, count in terminals.items():
-                    self.tag_dicts[tag][string] += count
+        pending = []
+        for counts in pool.imap_unordered(Processor(tagger, self.tagtype),
+                x_gen):
+            # combine partial counts a group at a time, as they arrive
+            pending.append(counts)
+            if len(pending) == self.REDUCE_EVERY:
+                pending = [GrammarCounts.reduce(pending)]
             i += 1
             log.info("Processed {}/{} result batches...".format(i, num_parts))
 
+        self.add_counts(*GrammarCounts.reduce(pending).to_dicts())
 
         log.info("Fitting completed.")
 
-    def fit(self, X, num_workers=None):
-        if num_workers:
-            self.fit_parallel(X, num_workers)
+    def add_counts(self, tag_results, base_struct_results):
+        """ Add partial counts (e.g., GrammarCounts.to_dicts()) to this
+        grammar. """
+        base_structures = self.base_structures
+        for base_struct, count in base_struct_results.items():
+            base_structures[base_struct] += count
+            self.counter += count
+        tag_dicts = self.tag_dicts
+        for tag, terminals in tag_results.items():
+            for string, count in terminals.items():
+                tag_dicts[tag][string] += count
+
+    def fit(self, X, num_workers=None, factorized=False, pool=None):
+        """
+        Args:
+            X - an iterable of tuples (x, count), where x is a list of tuples
+                (string, pos, str(synset)), or a list of lists of them if
+                factorized is True (see count_factorized)
+            num_workers, pool - optional - fit in parallel (see
+                fit_parallel)
+        """
+        if factorized:
+            counts = Processor(self.tagger, self.tagtype, factorized=True)(X)
+            self.add_counts(*counts.to_dicts())
+            return
+
+        if num_workers or pool is not None:
+            self.fit_parallel(X, num_workers or 4, pool)
             return
 
         for x, count in X:
@@ -494,57 +1086,64 @@ class Grammar(object):
         self.base_structures[base_structure] += count
         log.debug(base_structure)
 
-    def sample(self, N):
+    def sample(self, N, rng=None):
         """ Sample N observations from this probabilistic model.
 
-        Return:
-            list of tuples (password, base_struct, probability)
-        """
-        # Prepare data structures for fast-ish sampling
-
-        base_structs      = []
-        base_struct_probs = []
-        tag2words         = dict() # tag2words['jj'] = ['hot', 'cold', ...]
-        tag2probs         = dict() # tag2probs['jj'] = np.array([.1, .005, ...])
-
-        for k, v in self.base_structures.items():
-            base_structs.append(k)
-            base_struct_probs.append(v)
-        base_struct_probs = np.array(base_struct_probs)
-        base_struct_probs = base_struct_probs/np.sum(base_struct_probs) # calculate MLE
+        Samples are drawn in batches of SAMPLE_BATCH: the base structures of
+        a batch are drawn at once, then, for each tag, the terminals of all
+        the slots of the batch's base structures with that tag (see
+        TerminalStore.draw_many).
 
-        for tag, v in self.tag_dicts.items():
-            W = []
-            P = []
-            estimator = self._get_tag_prob_estimator(tag)
-            for word, count in v.items():
-                W.append(word)
-                P.append(estimator.probability(count))
-            tag2words[tag] = W
-            tag2probs[tag] = P
-
-        # Sample
-
-        base_struct_sample_indices = np.random.choice(  # sample from base structures
-            len(base_structs), size=N,
-            replace=True, p=base_struct_probs
-        )
-
-        # outcomes = []                            # final sample outcome:
-        #                                          # list of tuples (string, prob)
-
-        for i in base_struct_sample_indices:     # for each base structure,
-            base_struct  = base_structs[i]       # sample a word from each of its tags
-            outcome      = ''                    # one sampling outcome
-            outcome_prob = base_struct_probs[i]
-
-            for tag in re.findall('\(([^\(\)]+)\)', base_struct):
-                pdist          = tag2probs[tag]
-                j              = np.random.choice(len(pdist), replace=True, p=pdist)
-                outcome       += tag2words[tag][j]
-                outcome_prob  *= pdist[j]
+        Args:
+            rng - optional - a numpy.random.Generator or a seed for one
+                (default: seeded by the OS)
 
-            yield (outcome, base_struct, outcome_prob)
+        Return:
+            generator of tuples (password, base_struct, probability)
+        """
+        rng        = np.random.default_rng(rng)
+        rules      = self.rules
+        terminals  = self.terminals
+        vocabulary = terminals.vocabulary
+        tags       = rules.tags
+
+        for start in range(0, N, self.SAMPLE_BATCH):
+            n = min(self.SAMPLE_BATCH, N - start)
+            drawn = rng.choice(len(rules), size=n, p=rules.probabilities)
+
+            # the slots (tags) of the base structures drawn, concatenated:
+            # those of sample i are slots[offsets[i]:offsets[i+1]]
+            firsts  = rules.offsets[drawn]
+            lengths = rules.offsets[drawn + 1] - firsts
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            slots = rules.rule_tags[np.repeat(firsts - offsets[:-1], lengths)
+                + np.arange(offsets[-1])]
+
+            # draw the terminals of all the slots of each tag at once
+            words = np.zeros(len(slots), dtype=np.int64)
+            q     = np.ones(len(slots))
+            order = np.argsort(slots, kind='stable')
+            slot_tags, starts, sizes = np.unique(slots[order],
+                return_index=True, return_counts=True)
+            for t, first, size in zip(slot_tags.tolist(), starts.tolist(),
+                    sizes.tolist()):
+                positions = order[first:first+size]
+                words[positions], q[positions] = terminals.draw_many(
+                    tags[t], rng, size)
+
+            probabilities = rules.probabilities[drawn]
+            nonempty = lengths > 0
+            if nonempty.any():
+                probabilities[nonempty] *= np.multiply.reduceat(q,
+                    offsets[:-1][nonempty])
+
+            strings = [vocabulary[w] for w in words.tolist()]
+            offsets = offsets.tolist()
+            for i, (r, p) in enumerate(zip(drawn.tolist(),
+                    probabilities.tolist())):
+                yield (''.join(strings[offsets[i]:offsets[i+1]]),
+                    rules.format(r), p)
 
 
     def predict(self, X):
@@ -556,37 +1155,19 @@ class Grammar(object):
             X - a list of lists of tuples in the form (string, pos, str(synset))
         """
 
-        tag_prob_cache = dict()         # tag_prob_cache[tag][word] = p
-
-        def prob(tag, string):
-            if tag not in tag_prob_cache:
-                tag_prob_cache[tag] = dict()
-                samplesize          = sum(self.tag_dicts[tag].values())
-                vocabsize           = len(self.tag_dicts[tag].keys())
-
-                if self.estimator == 'laplace':
-                    estimator = LaplaceEstimator(samplesize, vocabsize, 1)
-                else:
-                    estimator = MleEstimator(samplesize)
-
-                for k, count in self.tag_dicts[tag].items():
-                    tag_prob_cache[tag][k] = estimator.probability(count)
-
-            try:
-                return tag_prob_cache[tag][string]
-            except KeyError:
-                return 0
+        prob  = self.terminals.prob
+        rules = self.rules
 
         for x in X:
-            base_structure = ''
+            base_structure = []
             p = 1
             for string, pos, synset in x:
                 tag = self.tagger._get_tag(string, pos, synset, self.tagtype)
-                base_structure += '({})'.format(tag)
+                base_structure.append(tag)
 
                 p *= prob(tag, string)
 
-            p *= self.base_structures[base_structure]/self.counter
+            p *= rules.count(base_structure)/self.counter
 
             yield p
 
@@ -607,101 +1188,152 @@ class Grammar(object):
             x - a list of tuples in the form (string, pos, str(synset))
         """
 
-        tag_prob_cache = dict()         # tag_prob_cache[tag][word] = p
-
-        def prob(tag, string):
-            if tag not in tag_prob_cache:
-                tag_prob_cache[tag] = dict()
-                samplesize          = sum(self.tag_dicts[tag].values())
-                vocabsize           = len(self.tag_dicts[tag].keys())
-
-                if self.estimator == 'laplace':
-                    estimator = LaplaceEstimator(samplesize, vocabsize, 1)
-                else:
-                    estimator = MleEstimator(samplesize)
-
-                for k, count in self.tag_dicts[tag].items():
-                    tag_prob_cache[tag][k] = estimator.probability(count)
-
-            try:
-                return tag_prob_cache[tag][string]
-            except KeyError:
-                return 0
+        prob  = self.terminals.prob
+        rules = self.rules
 
         while True:
             x = yield
-            base_structure = ''
+            base_structure = []
             p = 1
             for string, pos, synset in x:
                 tag = self.tagger._get_tag(string, pos, synset, self.tagtype)
-                base_structure += '({})'.format(tag)
+                base_structure.append(tag)
 
                 p *= prob(tag, string)
 
-            p *= self.base_structures[base_structure]/self.counter
+            p *= rules.count(base_structure)/self.counter
 
             yield p
 
 
     def base_structure_probabilities(self):
-        total = 0
-        rank = self.base_structures.most_common()
-        for struct, count in rank:
-            total += count
-
-        return [(struct, count/total) for struct, count in rank]
+        rules = self.rules
+        return [(rules.format(i), p)
+            for i, p in enumerate(rules.probabilities.tolist())]
 
     def tag_probabilities(self):
-        tag_dicts     = self.tag_dicts
+        terminals     = self.terminals
         probabilities = defaultdict(Counter)
 
-        for tag in tag_dicts.keys():
-            samplesize = sum(tag_dicts[tag].values())
-            vocabsize  = len(tag_dicts[tag].keys())
-
-            if self.estimator == 'laplace':
-                est = LaplaceEstimator(samplesize, vocabsize, 1)
-            else:
-                est = MleEstimator(samplesize)
-
-            for lemma, freq in tag_dicts[tag].most_common():
-                probabilities[tag][lemma] = est.probability(freq)
+        for tag in terminals:
+            probabilities[tag] = terminals.distribution(tag)
 
         return probabilities
 
-    # def __getstate__(self):
-    #     d = dict(self.__dict__)
-    #     # these attributes will be saved in plain text (not pickled)
-    #     d['base_structures'] = Counter()
-    #     d['tag_dicts'] =  defaultdict(Counter)
-    #     return d
+    def __getstate__(self):
+        # terminals and rules are saved in the compact form only
+        d = dict(self.__dict__)
+        d['_terminals'] = self.terminals
+        d['_tag_dicts'] = None
+        d['_rules'] = self.rules
+        d['_base_structures'] = None
+        return d
+
+    def __setstate__(self, state):
+        # grammars pickled before the TerminalStore have tag_dicts, and
+        # before the RuleTable, base_structures
+        if 'tag_dicts' in state:
+            state['_tag_dicts'] = state.pop('tag_dicts')
+            state['_terminals'] = None
+        if 'base_structures' in state:
+            state['_base_structures'] = state.pop('base_structures')
+            state['_rules'] = None
+        state.setdefault('lazy', False)
+        self.__dict__.update(state)
+
+    def write_to_disk(self, path, text=True):
+        """ Save the grammar in a folder, as a binary file (see
+        write_binary) and, if text is True, as human-readable files:
+        rules.txt and a file per tag in nonterminals/ (read by guessmaker).
+        """
+        os.makedirs(path, exist_ok=True)
+
+        # remove files of a previous grammar
+        shutil.rmtree(os.path.join(path, 'nonterminals'), ignore_errors=True)
+        for name in ('rules.txt', 'grammar.pickle'):
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError: # in case the file does not exist
+                pass
 
-    # def __setstate__(self, state):
-    #
+        self.write_binary(os.path.join(path, self.BINARY_FILE))
 
-    def write_to_disk(self, path):
-        # remove previous grammar
-        try:
-            shutil.rmtree(path)
-        except OSError: # in case the above folder does not exist
-            pass
+        if text:
+            self.write_text(path)
 
-        # recreate the folders empty
+    def write_text(self, path):
         os.makedirs(os.path.join(path, 'nonterminals'))
 
         with open(os.path.join(path, 'rules.txt'), 'w+') as f:
             for struct, p in self.base_structure_probabilities():
                 f.write('{}\t{}\n'.format(struct, p))
 
-        tags = self.tag_probabilities()
-        for tag in tags.keys():
+        terminals = self.terminals
+        for tag in terminals:
             with open(os.path.join(path, 'nonterminals', str(tag) + '.txt'), 'w+') as f:
-                for lemma, p in tags[tag].most_common():
+                for lemma, p in terminals.top(tag):
                     f.write("{}\t{}\n".format(lemma, p))
 
-        self_filepath = os.path.join(path, 'grammar.pickle')
-        pickle.dump(self, open(self_filepath, 'wb'), -1)
+    def write_binary(self, filepath):
+        """ Save the rule table (tags, counts and probabilities of the base
+        structures) and the terminals (counts and per-tag totals, see
+        TerminalStore) in one file that from_binary maps into memory (see
+        learning.binfile). """
+        rules_meta, rules_arrays = self.rules.to_arrays()
+        terminals_meta, terminals_arrays = self.terminals.to_arrays()
+
+        arrays = dict()
+        arrays.update(('rules.' + k, a) for k, a in rules_arrays.items())
+        arrays.update(('terminals.' + k, a) for k, a
+            in terminals_arrays.items())
+
+        meta = {
+            'tagtype': self.tagtype,
+            'estimator': self.estimator,
+            'counter': np.asarray(self.counter).item(),
+            'lowres': self.lowres,
+            'rules': rules_meta,
+            'terminals': terminals_meta
+        }
+        binfile.write_arrays(filepath, arrays, meta)
 
+    @classmethod
+    def from_binary(cls, filepath, lazy=False, cache_size=None):
+        """ Load a grammar saved with write_binary. Its arrays are
+        memory-mapped, so loading is fast and the pages are shared by every
+        process that loads the same file.
+
+        Args:
+            lazy - optional - for jobs that use few tags (e.g., scoring a
+                short list): rule probabilities are read into memory at
+                once, but a tag's terminals are only read, and its lookup
+                and sampling tables built, on first use; at most cache_size
+                tags keep their tables. get_vocab tests membership by
+                binary search instead of building a set of all terminals.
+            cache_size - optional - default: LAZY_CACHE_SIZE if lazy, else
+                unbounded
+        """
+        meta, arrays = binfile.read_arrays(filepath)
+        if lazy:
+            cache_size = cache_size or cls.LAZY_CACHE_SIZE
+            for name, a in arrays.items():
+                if name.startswith('rules.'):
+                    arrays[name] = np.array(a)
+
+        def section(prefix):
+            return {k[len(prefix):]: a for k, a in arrays.items()
+                if k.startswith(prefix)}
+
+        g = cls(meta['tagtype'], meta['estimator'])
+        g.counter = meta['counter']
+        g.lowres  = meta['lowres']
+        g._rules  = RuleTable.from_arrays(meta['rules'], section('rules.'))
+        g._terminals = TerminalStore.from_arrays(meta['terminals'],
+            section('terminals.'), cache_size)
+        g._base_structures = None
+        g._tag_dicts = None
+        g.lazy = lazy
+        return g
 
     def read(self, path):
         grammar_dir = util.abspath(path)
@@ -732,7 +1364,20 @@ class Grammar(object):
 
 
     @classmethod
-    def from_files(cls, path):
+    def from_files(cls, path, lazy=False):
+        """
+        Args:
+            lazy - optional - see from_binary. Grammars saved before the
+                binary format are loaded whole.
+        """
+        bpath = os.path.join(path, cls.BINARY_FILE)
+        if os.path.exists(bpath):
+            return cls.from_binary(bpath, lazy)
+
+        # grammars saved before the binary format
+        if lazy:
+            log.warning("{} not found, loading the whole grammar".format(
+                bpath))
         gpath = os.path.join(path, 'grammar.pickle')
         g = pickle.load(open(gpath, "rb"))
         # g.read(path)
@@ -3,6 +3,7 @@ import sys
 import traceback
 import csv
 import os
+import hashlib
 from nltk.corpus import wordnet
 
 from nltk.tag.sequential import DefaultTagger, \
@@ -12,6 +13,17 @@ from nltk.tag.sequential import DefaultTagger, \
                                 SequentialBackoffTagger
 from nltk.probability import FreqDist
 
+
+def file_digest(path):
+    """Return a digest of a file's contents. Used to version the results
+    of taggers loaded from data files (e.g., in a persistent cache)."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
 class ExhaustiveTagger():
     """
     Returns a comprehensive list of tags for a word. Does not tag
@@ -69,6 +81,11 @@ class ExhaustiveTagger():
 
         return pickle.load(open(path, 'rb'))
 
+    @classmethod
+    def version(cls, path=None):
+        """Return a string identifying the pickled tagger."""
+        return file_digest(path if path else cls.pickle_path)
+
 
 class BackoffTagger(SequentialBackoffTagger):
 
@@ -138,6 +155,11 @@ class BackoffTagger(SequentialBackoffTagger):
 
         return pickle.load(open(path, 'rb'))
 
+    @classmethod
+    def version(cls, path=None):
+        """Return a string identifying the pickled tagger."""
+        return file_digest(path if path else cls.pickle_path)
+
 
 class MyUnigramTagger(UnigramTagger):
     def __init__(self, *args, **kwargs):
@@ -259,10 +281,12 @@ class NamesTagger(SequentialBackoffTagger):
 
 
 class COCATagger(SequentialBackoffTagger):
+
+    coca_path = os.path.join(os.path.dirname(__file__),'../data/coca_500k.csv')
+
     def __init__(self, *args, **kwargs):
         SequentialBackoffTagger.__init__(self, *args, **kwargs)
-        coca_path = os.path.join(os.path.dirname(__file__),'../data/coca_500k.csv')
-        coca_list = csv.reader(open(coca_path), delimiter='\t')
+        coca_list = csv.reader(open(COCATagger.coca_path), delimiter='\t')
         self.tag_map = dict()
         for row in coca_list:
             freq = int(row[0])
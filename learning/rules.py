@@ -0,0 +1,179 @@
+"""
+The base structures (rules) of a grammar in parsed form.
+
+A rule is a sequence of tag IDs; rules are stored concatenated, sorted by
+decreasing probability:
+
+    the tags of rule i are rule_tags[offsets[i]:offsets[i+1]]
+
+Probabilities are computed once, when the table is built. The string form
+of a rule, e.g., '(number3)(s.love.v.01)', is only produced for output
+(see format).
+"""
+
+from collections import Counter
+
+import re
+import array
+import numpy as np
+
+
+class RuleTable(object):
+
+    def __init__(self, tags, rule_tags, offsets, counts, total=None,
+        probabilities=None):
+        """
+        Args:
+            tags - list of tags (tag ID -> tag)
+            rule_tags - array with the tag IDs of every rule, concatenated
+            offsets - array of len(counts) + 1 rule boundaries
+            counts - array with the count of every rule, decreasing
+            total, probabilities - optional - the sum of the counts and the
+                probability of every rule, if known (see to_arrays)
+        """
+        self.tags      = tags
+        self.rule_tags = rule_tags
+        self.offsets   = offsets
+        self.counts    = counts
+
+        if total is None:
+            # summed in order, as Counter.most_common() by the text format
+            total = float(sum(counts.tolist()))
+        if probabilities is None:
+            probabilities = counts / total if len(counts) else np.zeros(0)
+        self.total = total
+        self.probabilities = probabilities
+
+        self._init_caches()
+
+    def _init_caches(self):
+        self.tag_ids  = {tag: i for i, tag in enumerate(self.tags)}
+        self._index   = None    # tuple of tag IDs -> rule
+        self._strings = dict()  # rule -> string form
+
+    @staticmethod
+    def parse(string):
+        """Return the tags of a rule in string form."""
+        return re.findall('\(([^\(\)]+)\)', string)
+
+    @classmethod
+    def from_counts(cls, base_structures):
+        """
+        Args:
+            base_structures - a Counter of rules in string form
+        """
+        tag_ids = dict()
+        tag_id  = tag_ids.setdefault
+        rule_tags, lengths = array.array('i'), []
+
+        rules = base_structures.most_common()
+        for string, count in rules:
+            tags = [tag_id(tag, len(tag_ids)) for tag in cls.parse(string)]
+            rule_tags.extend(tags)
+            lengths.append(len(tags))
+
+        offsets = np.zeros(len(rules) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        counts = np.array([count for string, count in rules],
+            dtype=np.float64)
+
+        return cls(list(tag_ids), np.frombuffer(rule_tags,
+            dtype=np.int32).copy(), offsets, counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, i):
+        """Return rule i as a tuple of tag IDs."""
+        return tuple(self.rule_tags[self.offsets[i]:self.offsets[i+1]]
+            .tolist())
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def tag_names(self, i):
+        """Return rule i as a tuple of tags."""
+        tags = self.tags
+        return tuple(tags[t] for t in self[i])
+
+    def format(self, rule):
+        """Return the string form of a rule, given as an index or as a tuple
+        of tag IDs."""
+        if not isinstance(rule, tuple):
+            string = self._strings.get(rule)
+            if string is None:
+                string = self._strings[rule] = self.format(self[rule])
+            return string
+        return ''.join('({})'.format(self.tags[t]) for t in rule)
+
+    @property
+    def index(self):
+        """ A dict mapping rules (tuples of tag IDs) to their index. """
+        if self._index is None:
+            self._index = {rule: i for i, rule in enumerate(self)}
+        return self._index
+
+    def find(self, tags):
+        """Return the index of the rule made of a sequence of tags, or None
+        if there is none."""
+        tag_ids = self.tag_ids
+        rule = []
+        for tag in tags:
+            t = tag_ids.get(tag)
+            if t is None:
+                return None
+            rule.append(t)
+        return self.index.get(tuple(rule))
+
+    def count(self, tags):
+        """Return the count of the rule made of a sequence of tags."""
+        i = self.find(tags)
+        return 0 if i is None else float(self.counts[i])
+
+    def prefixes(self):
+        """Return the set of the prefixes of every rule, as tuples of tag
+        IDs (the rules included)."""
+        prefixes = set()
+        for rule in self:
+            for j in range(1, len(rule) + 1):
+                prefixes.add(rule[:j])
+        return prefixes
+
+    def to_counter(self):
+        """Return the counts as a Counter of rules in string form."""
+        return Counter({self.format(i): c
+            for i, c in enumerate(self.counts.tolist())})
+
+    def nbytes(self):
+        """Approximate memory used by the table's arrays, in bytes."""
+        return sum(a.nbytes for a in (self.rule_tags, self.offsets,
+            self.counts, self.probabilities))
+
+    def to_arrays(self):
+        """ Return the table as (metadata, dict of arrays), e.g., for
+        learning.binfile (see from_arrays). """
+        meta = {'tags': list(self.tags), 'total': self.total}
+        arrays = {
+            'tags': self.rule_tags,
+            'offsets': self.offsets,
+            'counts': self.counts,
+            'probabilities': self.probabilities
+        }
+        return meta, arrays
+
+    @classmethod
+    def from_arrays(cls, meta, arrays):
+        return cls(meta['tags'], arrays['tags'], arrays['offsets'],
+            arrays['counts'], meta['total'], arrays['probabilities'])
+
+    def __getstate__(self):
+        return {
+            'tags': self.tags,
+            'rule_tags': self.rule_tags,
+            'offsets': self.offsets,
+            'counts': self.counts
+        }
+
+    def __setstate__(self, d):
+        RuleTable.__init__(self, d['tags'], d['rule_tags'], d['offsets'],
+            d['counts'])
@@ -0,0 +1,386 @@
+"""
+Compact storage of the terminals of a grammar: the strings produced by each
+tag (nonterminal), with their counts, from which their probabilities are
+computed.
+
+Strings are interned in one vocabulary shared by all tags. The terminals of
+each tag occupy a contiguous range of flat arrays, sorted by decreasing
+count (hence probability):
+
+    the terminals of tag t are words[offsets[t]:offsets[t+1]]
+
+so the k most probable terminals of a tag are a slice. Only counts and the
+total count of each tag are stored (also in binary grammar files, see
+to_arrays), not probabilities: a probability is a count over its tag's
+normalizer (the total plus the smoothing of its terminals), which is
+computed once per tag when the store is created. Lookups by string go through a dict per tag and
+sampling through the cumulative probabilities of a tag, both built on first
+use of the tag and kept in a TagCache, which can be bounded. Batches of
+terminals are drawn from alias tables (see alias_table and draw_many).
+
+The vocabulary is sorted (by UTF-8 bytes), so that membership can be tested
+by binary search, without decoding it (see Vocabulary).
+"""
+
+from learning.corpus import StringTable
+from collections import defaultdict, Counter, OrderedDict
+
+import array
+import numpy as np
+
+
+def alias_table(weights):
+    """ Build the alias table of a discrete distribution with Vose's
+    method: drawing i uniformly, then keeping i with probability prob[i] or
+    else taking alias[i], samples the distribution in constant time.
+
+    Args:
+        weights - array of nonnegative weights (uniform if they sum to 0)
+
+    Returns:
+        (prob, alias) - arrays of len(weights)
+    """
+    n = len(weights)
+    total = float(np.sum(weights))
+    scaled = (weights * (n / total)).tolist() if total > 0 else [1.0] * n
+    prob  = [1.0] * n
+    alias = list(range(n))
+
+    small = [i for i, q in enumerate(scaled) if q < 1]
+    large = [i for i, q in enumerate(scaled) if q >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s]  = scaled[s]
+        alias[s] = l
+        scaled[l] = (scaled[l] + scaled[s]) - 1
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    # what remains is 1 up to rounding errors, and keeps prob 1
+
+    return np.array(prob), np.array(alias, dtype=np.int64)
+
+
+class TagCache(object):
+    """ The tables built for each tag (by tag ID), keeping those of at most
+    maxsize tags: the least recently used are dropped. Unbounded if maxsize
+    is None. """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.tables  = OrderedDict()
+
+    def get(self, t):
+        table = self.tables.get(t)
+        if table is not None:
+            self.tables.move_to_end(t)
+        return table
+
+    def __setitem__(self, t, table):
+        self.tables[t] = table
+        if self.maxsize is not None and len(self.tables) > self.maxsize:
+            self.tables.popitem(last=False)
+
+    def __len__(self):
+        return len(self.tables)
+
+
+class Vocabulary(object):
+    """ A read-only set of the terminals of a TerminalStore. If the store's
+    vocabulary is sorted, membership is tested by binary search over the
+    (possibly memory-mapped) table; otherwise, the table is decoded into a
+    set on first use. """
+
+    def __init__(self, table, is_sorted):
+        self.table = table
+        self.is_sorted = is_sorted
+        self._set = None
+
+    def __len__(self):
+        return len(self.table)
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def __contains__(self, string):
+        if not self.is_sorted:
+            if self._set is None:
+                self._set = set(self.table)
+            return string in self._set
+
+        key = string.encode('utf-8', 'surrogatepass')
+        blob, offsets = self.table.blob, self.table.offsets
+        lo, hi = 0, len(self.table)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if blob[offsets[mid]:offsets[mid+1]].tobytes() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(self.table) and \
+            blob[offsets[lo]:offsets[lo+1]].tobytes() == key
+
+
+class TerminalStore(object):
+
+    def __init__(self, vocabulary, tags, offsets, words, counts, alpha=0,
+        totals=None, sorted_vocabulary=False, cache_size=None):
+        """
+        Args:
+            vocabulary - sequence of the distinct terminals (word ID -> str),
+                e.g., a StringTable
+            tags - list of tags (tag ID -> tag)
+            offsets - array of len(tags) + 1 boundaries in the arrays below
+            words - array with the word ID of every terminal of every tag
+            counts - array with their counts, decreasing within each tag
+            alpha - additive smoothing of probabilities: 0 for maximum
+                likelihood estimates, 1 for Laplace estimates (see
+                MleEstimator and LaplaceEstimator)
+            totals - optional - the sum of the counts of each tag, if known
+                (see to_arrays)
+            sorted_vocabulary - whether vocabulary is sorted by UTF-8 bytes
+                (see from_counts)
+            cache_size - optional - the max. number of tags whose lookup
+                and sampling tables are kept in memory (default: all)
+        """
+        self.vocabulary = vocabulary
+        self.tags    = tags
+        self.offsets = offsets
+        self.words   = words
+        self.counts  = counts
+        self.alpha   = alpha
+        self.sorted_vocabulary = sorted_vocabulary
+        self.cache_size = cache_size
+
+        # the normalizer of each tag: its sample size plus alpha for each
+        # terminal of its vocabulary
+        sizes = np.diff(offsets)
+        if totals is None:
+            totals = np.zeros(len(tags))
+            if len(counts):
+                totals[sizes > 0] = np.add.reduceat(counts,
+                    offsets[:-1][sizes > 0])
+        self.totals = totals
+        self.normalizers = self.totals + alpha * sizes
+
+        self._init_caches()
+
+    def _init_caches(self):
+        self.tag_ids = {tag: i for i, tag in enumerate(self.tags)}
+        # tag ID -> dict of string -> position
+        self._lookups    = TagCache(self.cache_size)
+        # tag ID -> cumulative probabilities
+        self._cumulative = TagCache(self.cache_size)
+        # tag ID -> alias table
+        self._aliases    = TagCache(self.cache_size)
+
+    @classmethod
+    def from_counts(cls, tag_dicts, alpha=0):
+        """
+        Args:
+            tag_dicts - a dict of Counters of terminals by tag
+        """
+        word_ids = dict()
+        word_id  = word_ids.setdefault
+        tags, lengths, counts = [], [], []
+        words = array.array('i')
+
+        for tag, terminals in tag_dicts.items():
+            c = np.fromiter(terminals.values(), dtype=np.float64,
+                count=len(terminals))
+            ids = np.array([word_id(w, len(word_ids)) for w in terminals],
+                dtype=np.int32)
+
+            # stable, so that ties keep their order (as Counter.most_common)
+            order = np.argsort(-c, kind='stable')
+            tags.append(tag)
+            lengths.append(len(c))
+            words.extend(ids[order].tolist())
+            counts.append(c[order])
+
+        offsets = np.zeros(len(tags) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # renumber words in the order of the sorted vocabulary
+        strings = list(word_ids)
+        encoded = [w.encode('utf-8', 'surrogatepass') for w in strings]
+        order = sorted(range(len(encoded)), key=encoded.__getitem__)
+        rank = np.zeros(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)
+
+        return cls(StringTable.from_list([strings[i] for i in order]), tags,
+            offsets, rank[np.frombuffer(words, dtype=np.int32)],
+            np.concatenate(counts) if counts else np.zeros(0), alpha,
+            sorted_vocabulary=True)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, tag):
+        return tag in self.tag_ids
+
+    def __iter__(self):
+        return iter(self.tags)
+
+    def vocabulary_set(self):
+        """Return the terminals of all tags as a read-only set."""
+        return Vocabulary(self.vocabulary, self.sorted_vocabulary)
+
+    def range(self, tag):
+        """Return the (start, end) positions of a tag's terminals."""
+        t = self.tag_ids[tag]
+        return int(self.offsets[t]), int(self.offsets[t+1])
+
+    def size(self, tag):
+        start, end = self.range(tag)
+        return end - start
+
+    def total(self, tag):
+        """The sample size of a tag: the sum of its terminals' counts."""
+        return float(self.totals[self.tag_ids[tag]])
+
+    def _lookup(self, tag):
+        t = self.tag_ids[tag]
+        lookup = self._lookups.get(t)
+        if lookup is None:
+            start, end = int(self.offsets[t]), int(self.offsets[t+1])
+            vocabulary = self.vocabulary
+            lookup = self._lookups[t] = {vocabulary[w]: i for i, w
+                in enumerate(self.words[start:end].tolist(), start)}
+        return lookup
+
+    def prob(self, tag, string):
+        """The probability of a tag producing string (0 if it does not)."""
+        t = self.tag_ids.get(tag)
+        if t is None:
+            return 0
+        i = self._lookup(tag).get(string)
+        if i is None:
+            return 0
+        return (float(self.counts[i]) + self.alpha) / \
+            float(self.normalizers[t])
+
+    def probabilities(self, tag):
+        """Return the probabilities of a tag's terminals (an array, in
+        decreasing order)."""
+        t = self.tag_ids[tag]
+        start, end = int(self.offsets[t]), int(self.offsets[t+1])
+        return (self.counts[start:end] + self.alpha) / self.normalizers[t]
+
+    def terminals(self, tag):
+        """Return the terminals of a tag, most probable first."""
+        start, end = self.range(tag)
+        vocabulary = self.vocabulary
+        return [vocabulary[w] for w in self.words[start:end].tolist()]
+
+    def top(self, tag, k=None):
+        """Return the k most probable terminals of a tag (all if k is None)
+        as a list of (string, probability), most probable first."""
+        start, end = self.range(tag)
+        if k is not None:
+            end = min(end, start + k)
+        vocabulary = self.vocabulary
+        return [(vocabulary[w], p) for w, p in zip(
+            self.words[start:end].tolist(),
+            self.probabilities(tag)[:end - start].tolist())]
+
+    def draw(self, tag, u):
+        """ Return the terminal of a tag at cumulative probability u, in
+        [0, 1), as (string, probability), e.g., with u uniformly random to
+        sample the tag's distribution. """
+        t = self.tag_ids[tag]
+        cumulative = self._cumulative.get(t)
+        if cumulative is None:
+            cumulative = self._cumulative[t] = np.cumsum(
+                self.probabilities(tag))
+
+        j = min(len(cumulative) - 1, int(np.searchsorted(cumulative,
+            u * cumulative[-1], side='right')))
+        i = int(self.offsets[t]) + j
+        return self.vocabulary[self.words[i]], \
+            (float(self.counts[i]) + self.alpha) / float(self.normalizers[t])
+
+    def draw_many(self, tag, rng, size):
+        """ Sample size terminals of a tag from its alias table.
+
+        Args:
+            rng - a numpy.random.Generator
+
+        Returns:
+            (words, probabilities) - arrays of the word IDs drawn (see
+                vocabulary) and their probabilities
+        """
+        t = self.tag_ids[tag]
+        table = self._aliases.get(t)
+        if table is None:
+            table = self._aliases[t] = alias_table(self.probabilities(tag))
+        prob, alias = table
+
+        j = rng.integers(len(prob), size=size)
+        j = np.where(rng.random(size) < prob[j], j, alias[j])
+        i = int(self.offsets[t]) + j
+        return self.words[i], (self.counts[i] + self.alpha) / \
+            self.normalizers[t]
+
+    def distribution(self, tag):
+        """Return the probabilities of a tag's terminals as a Counter."""
+        return Counter(dict(self.top(tag)))
+
+    def to_counters(self):
+        """Return the counts as a defaultdict of Counters of terminals."""
+        tag_dicts = defaultdict(Counter)
+        vocabulary = self.vocabulary
+        for t, tag in enumerate(self.tags):
+            start, end = int(self.offsets[t]), int(self.offsets[t+1])
+            tag_dicts[tag] = Counter({vocabulary[w]: c for w, c in zip(
+                self.words[start:end].tolist(),
+                self.counts[start:end].tolist())})
+        return tag_dicts
+
+    def nbytes(self):
+        """Approximate memory used by the store's arrays, in bytes."""
+        return self.vocabulary.nbytes + sum(a.nbytes for a in (self.offsets,
+            self.words, self.counts, self.totals, self.normalizers))
+
+    def to_arrays(self):
+        """ Return the store as (metadata, dict of arrays), e.g., for
+        learning.binfile (see from_arrays). """
+        vocabulary = self.vocabulary
+        if not isinstance(vocabulary, StringTable):
+            vocabulary = StringTable.from_list(vocabulary)
+
+        meta = {'tags': list(self.tags), 'alpha': self.alpha,
+            'sorted_vocabulary': self.sorted_vocabulary}
+        arrays = {
+            'strings': vocabulary.blob,
+            'string_offsets': vocabulary.offsets,
+            'offsets': self.offsets,
+            'words': self.words,
+            'counts': self.counts,
+            'totals': self.totals
+        }
+        return meta, arrays
+
+    @classmethod
+    def from_arrays(cls, meta, arrays, cache_size=None):
+        return cls(StringTable(arrays['strings'], arrays['string_offsets']),
+            meta['tags'], arrays['offsets'], arrays['words'], arrays['counts'],
+            meta['alpha'], arrays['totals'],
+            meta.get('sorted_vocabulary', False), cache_size)
+
+    def __getstate__(self):
+        return {
+            'vocabulary': self.vocabulary,
+            'tags': self.tags,
+            'offsets': self.offsets,
+            'words': self.words,
+            'counts': self.counts,
+            'alpha': self.alpha,
+            'sorted_vocabulary': self.sorted_vocabulary
+        }
+
+    def __setstate__(self, d):
+        TerminalStore.__init__(self, d['vocabulary'], d['tags'], d['offsets'],
+            d['words'], d['counts'], d['alpha'],
+            sorted_vocabulary=d.get('sorted_vocabulary', False))
@@ -7,12 +7,18 @@ import multiprocessing
 import argparse
 import pickle
 import os
+import tempfile
+import threading
+import queue
+import time
+import functools
 
 import wordsegment as ws
 import numpy as np
 
-from collections import Counter
+from collections import Counter, defaultdict
 from functools import reduce
+from contextlib import contextmanager
 from multiprocessing import Process, Manager
 from multiprocessing.managers import BaseManager
 from importlib import reload
@@ -22,14 +28,17 @@ from nltk.corpus.reader.api import CorpusReader
 from nltk.corpus.util import LazyCorpusLoader
 from nltk.corpus.reader.wordnet import WordNetCorpusReader
 
-from learning.pos import BackoffTagger, SpacyTagger, COCATagger
+from learning.pos import BackoffTagger, SpacyTagger, COCATagger, file_digest
 from learning.tagset_conversion import TagsetConverter
-from learning.tree.wordnet import IndexedWordNetTree
-from learning.model import TreeCutModel, Grammar, GrammarTagger
+from learning.tree.wordnet import IndexedWordNetTree, load_tree
+from learning.model import TreeCutModel, Grammar, GrammarTagger, GrammarCounts
+from learning.checkpoint import Checkpoints, input_digest
+from learning.corpus import CorpusBuilder, TaggedCorpus, shared_corpus
 
 from pattern.en import pluralize, lexeme
 
 from misc.util import Timer
+from misc.cache import PersistentCache
 
 # load global resources
 
@@ -53,15 +62,147 @@ def new_wordnet_instance():
     )
 
 
+def read_passwords(password_file):
+    """Iterate over the lowercased, non-blank lines of a password list."""
+    return (line.rstrip('\n').lower() for line in password_file
+        if not re.fullmatch('\s+', line))
+
+
 def tally(password_file, lowercase=True):
     """Return a Counter for passwords."""
-    pwditer = (line.rstrip('\n').lower() for line in password_file
-        if not re.fullmatch('\s+', line))
+    return Counter(read_passwords(password_file))
+
+
+# approximate cost, in bytes, of one Counter entry besides the string itself
+# (hash table slot, key/value pointers and the int count)
+COUNTER_ENTRY_OVERHEAD = 100
+
+# limits for the number of shard files open at the same time and for how
+# many times an oversized shard can be split again
+MAX_SHARDS = 256
+MAX_SHARD_DEPTH = 8
+
+
+def _partition(passwords, folder, num_shards, depth, name='shard'):
+    """Hash-partition an iterable of passwords into num_shards files,
+    folder/<name>-<i>.txt. Every depth uses a different hash, so that a
+    shard can be partitioned again if it turns out to be too large; its
+    shards are named after it, so that no two shards share a file.
+
+    Returns:
+        list of tuples (path, depth) of non-empty shards
+    """
+    paths = [os.path.join(folder, '{}-{}.txt'.format(name, i))
+        for i in range(num_shards)]
+    files = [open(path, 'w', encoding='utf-8', errors='surrogateescape',
+        newline='') for path in paths]
+    used = [False] * num_shards
+
+    try:
+        for password in passwords:
+            i = hash((depth, password)) % num_shards
+            files[i].write(password + '\n')
+            used[i] = True
+    finally:
+        for f in files:
+            f.close()
+
+    shards = []
+    for path, is_used in zip(paths, used):
+        if is_used:
+            shards.append((path, depth))
+        else:
+            os.remove(path)
+
+    return shards
+
+
+def _read_shard(path):
+    with open(path, encoding='utf-8', errors='surrogateescape',
+        newline='') as f:
+        for line in f:
+            yield line[:-1]
+
 
-    return Counter(pwditer)
+def _count_shard(path, memory_budget):
+    """Count the passwords in a shard file. Return None as soon as the
+    estimated size of the Counter exceeds memory_budget (bytes)."""
+    counts = Counter()
+    size = 0
+    for password in _read_shard(path):
+        if password not in counts:
+            size += sys.getsizeof(password) + COUNTER_ENTRY_OVERHEAD
+            if size > memory_budget:
+                return None
+        counts[password] += 1
+    return counts
 
 
-def getchunks(password):
+def tally_sharded(password_file, memory_budget, tmpdir=None):
+    """Count passwords without ever holding all distinct passwords in memory.
+
+    Passwords are hash-partitioned into shard files in a temporary folder
+    and each shard is counted separately. Shards whose distinct passwords do
+    not fit in memory_budget are partitioned again with a different hash.
+
+    Args:
+        password_file - a password list (file object)
+        memory_budget - max. size (bytes) of the Counter of a single shard
+        tmpdir - optional - where to create the shards (default: system's
+            temporary folder)
+
+    Returns:
+        generator of tuples (password, count)
+    """
+    # a shard file takes about 1/16 of the memory needed to count it
+    try:
+        size = os.fstat(password_file.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        size = 0
+    num_shards = math.ceil(size * 16 / memory_budget) if size else 64
+    num_shards = max(1, min(num_shards, MAX_SHARDS))
+
+    with tempfile.TemporaryDirectory(prefix='tally-', dir=tmpdir) as folder:
+        log.info("Partitioning passwords into {} shards in {}"
+            .format(num_shards, folder))
+        shards = _partition(read_passwords(password_file), folder,
+            num_shards, 0)
+
+        while shards:
+            path, depth = shards.pop()
+
+            if depth < MAX_SHARD_DEPTH:
+                counts = _count_shard(path, memory_budget)
+            else:
+                log.warning("Shard {} still exceeds the memory budget after "
+                    "{} partitions.".format(path, depth))
+                counts = Counter(_read_shard(path))
+
+            if counts is None:  # too large, split it again
+                log.info("Shard {} exceeds the memory budget, partitioning "
+                    "it again...".format(path))
+                name = os.path.splitext(os.path.basename(path))[0]
+                shards.extend(_partition(_read_shard(path), folder,
+                    MAX_SHARDS // 16, depth + 1, name))
+                os.remove(path)
+                continue
+
+            os.remove(path)
+            yield from counts.items()
+            del counts
+
+
+def getchunks(password, segment=None):
+    """Split a password into alphabetic, numeric and symbol chunks, further
+    splitting alphabetic runs into words.
+
+    Args:
+        segment - optional - a function that splits an alphabetic run into
+            a list of words (default: wordsegment's segment)
+    """
+    if segment is None:
+        segment = ws.segment
+
     # split into character/digit/symbols chunks
     temp = re.findall('([\W_]+|[a-zA-Z]+|[0-9]+)', password)
 
@@ -69,7 +210,7 @@ def getchunks(password):
     chunks = []
     for chunk in temp:
         if chunk[0].isalpha() and len(chunk) > 1:
-            words = ws.segment(chunk)
+            words = segment(chunk)
             chunks.extend(words)
         else:
             chunks.append(chunk)
@@ -177,6 +318,125 @@ def pos_tag(tokens, tagger, blacklist):
     return tags
 
 
+# bump when getchunks or pos_tag change in a way that alters their output,
+# so that persistent caches of their results are invalidated
+CHUNKING_VERSION = 1
+
+
+def segmenter_version():
+    return 'wordsegment-{}-{}'.format(ws.__version__, CHUNKING_VERSION)
+
+
+def tagger_version():
+    return '{}-{}-{}'.format(BackoffTagger.version(),
+        file_digest(COCATagger.coca_path), CHUNKING_VERSION)
+
+
+def open_persistent_caches(path, versions=None):
+    """Open the on-disk segmentation and POS tagging caches stored in path.
+
+    Args:
+        path - the cache file
+        versions - optional - tuple (segmenter version, tagger version),
+            computed if not given
+
+    Returns:
+        tuple of PersistentCache (segmentation cache, tagging cache)
+    """
+    if versions is None:
+        versions = (segmenter_version(), tagger_version())
+    return (PersistentCache(path, 'segment', versions[0]),
+            PersistentCache(path, 'pos_tag', versions[1]))
+
+
+class MemoChunkTagger(object):
+    """
+    Chunks and POS-tags passwords, memoizing the two expensive steps so that
+    the cost of tagging a password list depends on its number of distinct
+    alphabetic skeletons rather than on its number of distinct passwords.
+
+    - the segmentation of alphabetic runs is cached by run;
+    - the POS tags are cached by the password's skeleton, i.e., its chunks
+      with every non-alphabetic chunk replaced by None. pos_tag's output only
+      depends on the alphabetic tokens and on where they sit, so 'love123',
+      'love456' and 'love!!' share one entry: ('love', None).
+
+    Both caches are bounded and evict the least recently used entries.
+    Optionally, each can be backed by a PersistentCache shared across runs,
+    which is consulted before doing the actual work.
+    Instances are meant to be created once per worker process.
+    """
+
+    def __init__(self, postagger, blacklist, cache_size=100000,
+        segment_cache=None, tag_cache=None):
+        self.postagger = postagger
+        self.blacklist = blacklist
+        self.persistent_caches = [c for c in (segment_cache, tag_cache)
+            if c is not None]
+
+        segment = ws.segment
+        tag_skeleton = self._tag_skeleton
+        if segment_cache is not None:
+            segment = self._persisted(segment, segment_cache)
+        if tag_cache is not None:
+            tag_skeleton = self._persisted(tag_skeleton, tag_cache)
+
+        self.segment = functools.lru_cache(maxsize=cache_size)(segment)
+        self._tag_skeleton = functools.lru_cache(maxsize=cache_size)(
+            tag_skeleton)
+
+    @staticmethod
+    def _persisted(function, cache):
+        def persisted_function(key):
+            value = cache.get(key)
+            if value is None:
+                value = function(key)
+                cache[key] = value
+            return value
+        return persisted_function
+
+    def chunk(self, password):
+        return getchunks(password, self.segment)
+
+    def tag(self, chunks):
+        """Same as pos_tag(chunks, self.postagger, self.blacklist)."""
+        skeleton = tuple(c if c[0].isalpha() else None for c in chunks)
+        return list(zip(chunks, self._tag_skeleton(skeleton)))
+
+    def chunk_and_tag(self, password):
+        return self.tag(self.chunk(password))
+
+    def _tag_skeleton(self, skeleton):
+        # any non-alphabetic string can stand in for the numbers and symbols
+        tokens = [token if token is not None else '0' for token in skeleton]
+        tags = pos_tag(tokens, self.postagger, self.blacklist)
+        return tuple(tag for token, tag in tags)
+
+    def cache_info(self):
+        """Return a summary of the caches' hit rates for logging."""
+        summary = []
+        for name, cache in (('segmentation', self.segment),
+                            ('tagging', self._tag_skeleton)):
+            info = cache.cache_info()
+            lookups = info.hits + info.misses
+            summary.append("{} cache: {:.1%} hits, {} entries".format(name,
+                info.hits / lookups if lookups else 0, info.currsize))
+        for cache in self.persistent_caches:
+            summary.append("persistent {} cache: {:.1%} hits".format(
+                cache.namespace, cache.hit_rate()))
+        return '; '.join(summary)
+
+    def flush(self):
+        """Write pending entries to the persistent caches, if any."""
+        for cache in self.persistent_caches:
+            cache.flush()
+
+    def close(self):
+        """Write pending entries and close the persistent caches."""
+        for cache in self.persistent_caches:
+            cache.close()
+
+
 def lemmas(synset):
     lemmas = wn.synset(synset).lemmas()
     lemmas = [l.name() for l in lemmas]
@@ -298,67 +558,314 @@ def product(list_a, list_b):
                 yield [a, b]
 
 
-def tally_chunk_tag(path, num_workers):
-    def do_work(in_queue, out_list):
-        postagger = BackoffTagger.from_pickle()
-        blacklist = POSBlacklist()
-        postagger.set_wordnet_instance(new_wordnet_instance())
-        # postagger = SpacyTagger()
+# the resources of a WorkerPool process (see _init_worker)
+_worker = None
+
+
+def _init_worker(started, cache_size, cache_path, versions):
+    global _worker
+    with started.get_lock():
+        started.value += 1
+    _worker = _Worker(cache_size, cache_path, versions)
+
 
-        i = 0
-        while True:
-            batch = in_queue.get()
-            if len(batch) == 0: # exit signal
-                return
+class _Worker(object):
+    """
+    The resources of a WorkerPool process. Each is loaded by the first task
+    that needs it and kept for the rest of the run, so that a worker that
+    tags passwords and later resolves synsets loads the POS tagger and opens
+    WordNet only once.
+    """
 
-            result_buffer = []
-            for password, count in batch:
+    def __init__(self, cache_size, cache_path, versions):
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        self.versions   = versions
+        self.tagged     = 0  # number of passwords tagged so far
+
+        self._wordnet      = None
+        self._chunk_tagger = None
+        self._corpus = (None, None)  # (handle paths, memory-mapped corpus)
+        self._shared = (None, None)  # (path, object unpickled from it)
+
+    @property
+    def id(self):
+        return multiprocessing.current_process()._identity[0]
+
+    @property
+    def wordnet(self):
+        if self._wordnet is None:
+            self._wordnet = new_wordnet_instance()
+        return self._wordnet
+
+    @property
+    def chunk_tagger(self):
+        if self._chunk_tagger is None:
+            postagger = BackoffTagger.from_pickle()
+            postagger.set_wordnet_instance(self.wordnet)
+            # postagger = SpacyTagger()
+            persistent_caches = open_persistent_caches(self.cache_path,
+                self.versions) if self.cache_path else (None, None)
+            self._chunk_tagger = MemoChunkTagger(postagger, POSBlacklist(),
+                self.cache_size, *persistent_caches)
+        return self._chunk_tagger
+
+    def open_corpus(self, handle):
+        """Map the corpus of a CorpusHandle, once per stage."""
+        paths = (handle.path, handle.synsets_path)
+        if self._corpus[0] != paths:
+            self._corpus = (paths, handle.open())
+        return self._corpus[1]
+
+    def load(self, path):
+        """Unpickle a file shared by the tasks of a stage, once per stage."""
+        if self._shared[0] != path:
+            with open(path, 'rb') as f:
+                self._shared = (path, pickle.load(f))
+        return self._shared[1]
+
+
+class WorkerPool(object):
+    """
+    Worker processes shared by the stages of a training run: tagging,
+    synset resolution and grammar fitting. Workers load what they need once
+    (see _Worker) and take tasks from any stage. Tasks are handed out one at
+    a time as workers become free, so that uneven batches do not leave
+    cores idle.
+
+    The processes are started on first use (a run whose stages are all
+    checkpointed starts none) and stopped on close().
+    """
 
-                chunks = getchunks(password)
+    def __init__(self, num_workers, cache_size=100000, cache_path=None):
+        """
+        Args:
+            num_workers - number of processes
+            cache_size, cache_path - the tagging caches of every worker (see
+                MemoChunkTagger and open_persistent_caches)
+        """
+        self.num_workers = num_workers
+        self.cache_size  = cache_size
+        self.cache_path  = cache_path
+        self._pool    = None
+        self._started = None  # number of processes started, dead included
+
+    def _start(self):
+        # validate (and, if outdated, clear) the persistent caches only once,
+        # before the workers open them
+        versions = None
+        if self.cache_path:
+            versions = (segmenter_version(), tagger_version())
+            for cache in open_persistent_caches(self.cache_path, versions):
+                cache.close()
+
+        self._started = multiprocessing.Value('i', 0)
+        self._pool = multiprocessing.Pool(self.num_workers, _init_worker,
+            (self._started, self.cache_size, self.cache_path, versions))
+        log.info("Pool has {} workers".format(self.num_workers))
+
+    def imap_unordered(self, function, tasks, max_pending=None):
+        """ Apply a (module-level) function to every task in the workers and
+        yield the results as they complete.
+
+        Tasks are taken lazily from the iterable, at most max_pending
+        (default: two per worker) ahead of the results consumed, so that a
+        generator of tasks (e.g., batches of a password list) is never held
+        in memory at once.
+        """
+        if self._pool is None:
+            self._start()
+
+        max_pending = max_pending or 2 * self.num_workers
+        slots = threading.Semaphore(max_pending)
+        stopped = False
+
+        def throttled():
+            for task in tasks:
+                slots.acquire()
+                if stopped:
+                    return
+                yield task
+
+        results = self._pool.imap_unordered(function, throttled())
+        try:
+            while True:
                 try:
-                    postagged_chunks = pos_tag(chunks, postagger, blacklist)
-                except:
-                    log.error("Error: {}".format(chunks))
-                    raise
+                    result = results.next(timeout=10)
+                except StopIteration:
+                    return
+                except multiprocessing.TimeoutError:
+                    # the pool replaces dead workers, but their tasks are lost
+                    if self._started.value > self.num_workers:
+                        raise RuntimeError("A worker process terminated "
+                            "unexpectedly.")
+                    continue
+
+                slots.release()
+                yield result
+        finally:
+            # unblock the pool's thread feeding the tasks
+            stopped = True
+            for i in range(max_pending):
+                slots.release()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+@contextmanager
+def worker_pool(pool, num_workers, **args):
+    """Yield pool, or a new WorkerPool(num_workers, **args) if it is None."""
+    if pool is not None:
+        yield pool
+    else:
+        with WorkerPool(num_workers, **args) as pool:
+            yield pool
+
+
+def _tag_batch(batch):
+    """Chunk and POS-tag a batch of (password, count) (runs in a worker)."""
+    worker = _worker
+    chunk_tagger = worker.chunk_tagger
+
+    result = []
+    for password, count in batch:
+        chunks = chunk_tagger.chunk(password)
+        try:
+            postagged_chunks = chunk_tagger.tag(chunks)
+        except:
+            log.error("Error: {}".format(chunks))
+            raise
+
+        result.append((postagged_chunks, count))
+        worker.tagged += 1
+
+        if worker.tagged % 100000 == 0:
+            log.info("Process {} has worked on {} passwords ({})..."
+                .format(worker.id, worker.tagged, chunk_tagger.cache_info()))
+
+    # the worker may be stopped between stages, without a chance to close
+    chunk_tagger.flush()
+    return result
+
+
+def tally_chunk_tag(path, num_workers, memory_budget=None, tmpdir=None,
+    cache_size=100000, cache_path=None, pool=None):
+    """Count, chunk and POS-tag the passwords in a list.
+
+    Args:
+        path - a password list (file object)
+        num_workers - number of tagging processes
+        memory_budget - optional - if set, count passwords in on-disk shards
+            using at most this many bytes per shard (see tally_sharded)
+        tmpdir - optional - where to store the shards
+        cache_size - max. number of entries in each of a worker's
+            segmentation and tagging caches (see MemoChunkTagger)
+        cache_path - optional - a file with segmentations and POS tags
+            persisted across runs (see open_persistent_caches)
+        pool - optional - a WorkerPool to run on, in which case its own
+            num_workers, cache_size and cache_path apply
+
+    Returns:
+        a TaggedCorpus
+    """
+    def batches():
+        # runs in a thread of the pool, so that this process can collect
+        # results while passwords are still being counted
+        if memory_budget:
+            passwords = tally_sharded(path, memory_budget, tmpdir)
+        else:
+            passwords = tally(path).items()
+
+        buff = []
+        for password, count in passwords:
+            buff.append((password, count))
+            if len(buff) == 10000:
+                yield buff
+                buff = []
+
+        if len(buff): yield buff
+
+    start = time.time()
+    corpus = CorpusBuilder()
+
+    with worker_pool(pool, num_workers, cache_size=cache_size,
+            cache_path=cache_path) as pool:
+        for batch in pool.imap_unordered(_tag_batch, batches()):
+            corpus.extend(batch)
+
+    corpus = corpus.build()
+
+    elapsed = time.time() - start
+    log.info("Tagged {} distinct passwords with {} processes ({:.0f} passwords/s)"
+        .format(len(corpus), pool.num_workers,
+            len(corpus) / elapsed if elapsed else 0))
+
+    return corpus
 
-                result_buffer.append((postagged_chunks, count))
-                i += 1
 
-                if i % 100000 == 0:
-                    process_id = multiprocessing.current_process()._identity[0]
-                    log.info("Process {} has worked on {} passwords..."
-                        .format(process_id, i))
+def _resolve_synsets(pairs):
+    """Look up the synset of (string, pos) pairs (runs in a worker)."""
+    wordnet = _worker.wordnet
+    synsets = dict()
+    for string, pos in pairs:
+        syn = synset(string, pos, wordnet, tag_converter)
+        synsets[(string, pos)] = syn.name() if syn is not None else None
+    return synsets
 
-            out_list.extend(result_buffer)
 
-    manager = Manager()
+def resolve_synsets(corpus, num_workers, pool=None):
+    """ Resolve the synset of every distinct (string, pos) pair in a tagged
+    corpus, in parallel. This is the only pass over the corpus that queries
+    WordNet; later stages read the synsets from the returned table (see
+    TaggedCorpus.set_synsets).
 
-    results = manager.list()
-    work = manager.Queue(num_workers)
+    Args:
+        pool - optional - a WorkerPool to run on
 
-    # start for workers
-    pool = []
-    for i in range(num_workers):
-        p = Process(target=do_work, args=(work, results))
-        p.start()
-        pool.append(p)
+    Returns:
+        a dict mapping (string, pos) tuples to synset names. Pairs that have
+        no synset (see synset()) are absent.
+    """
+    pairs = [(string, pos) for string, pos in corpus.pairs()
+        if pos is not None and pos not in proper_noun_tags]
+
+    log.info("Resolving the synsets of {} distinct (string, pos) pairs..."
+        .format(len(pairs)))
 
+    table = dict()
+    with worker_pool(pool, num_workers) as pool:
+        share = max(1, math.ceil(len(pairs) / (pool.num_workers * 16)))
+        batches = (pairs[i:i+share] for i in range(0, len(pairs), share))
 
-    passwords = tally(path).items()
-    buff = []
-    for password, count in passwords:
-        buff.append((password, count))
-        if len(buff) == 10000:
-            work.put(buff)
-            buff = []
+        for synsets in pool.imap_unordered(_resolve_synsets, batches):
+            table.update((pair, name) for pair, name in synsets.items()
+                if name is not None)
 
-    if len(buff): work.put(buff)
-    for i in range(num_workers): work.put([]) # send exit signal
+    return table
 
-    for p in pool:
-        p.join()
 
-    return results
+def synset_pos(name):
+    """Return the part-of-speech of a synset name, e.g., 'n' for 'dog.n.01'."""
+    return name.rsplit('.', 2)[-2]
 
 
 def increment_synset_count(tree, synset, count=1):
@@ -372,9 +879,11 @@ def increment_synset_count(tree, synset, count=1):
     the count by the number of nodes matching the key.
     increment_node() resolves  ambiguity using the ancestor path
     received as argument.
+
+    - synset: a Synset or a synset name
     """
     index = tree.index
-    key = synset.name()
+    key = synset if isinstance(synset, str) else synset.name()
 
     if key in index:
         nodes = index[key]
@@ -385,59 +894,62 @@ def increment_synset_count(tree, synset, count=1):
             n.increment_value(count, cumulative=False)
 
 
-def fit_tree_cut_models(passwords, estimator, specificity, num_workers):
+def attach_synsets(corpus, num_workers, synsets=None, pool=None):
+    """Assign synsets to the chunks of a corpus, unless already done.
 
-    def do_work(passwords, noun_results, verb_results):
-        wn = new_wordnet_instance()
+    Args:
+        synsets - optional - the synset table of the corpus (see
+            resolve_synsets), computed if not given
+        pool - optional - a WorkerPool to compute it on
+    """
+    if corpus.synsets is not None and synsets is None:
+        return
+    if synsets is None:
+        synsets = resolve_synsets(corpus, num_workers, pool)
+    corpus.set_synsets(synsets)
 
-        grammar_tagger = GrammarTagger()
-        tag_converter = TagsetConverter()
-        noun_tree = IndexedWordNetTree('n', wordnet=wn)
-        verb_tree = IndexedWordNetTree('v', wordnet=wn)
 
-        for chunks, count in passwords:
-            for string, pos in chunks:
-                syn = synset(string, pos, wn, tag_converter)
-                if syn and syn.pos() == 'n':
-                    increment_synset_count(noun_tree, syn, count)
-                elif syn and syn.pos() == 'v':
-                    increment_synset_count(verb_tree, syn, count)
+def count_synsets(corpus, num_workers, synsets=None, pool=None):
+    """Count the synsets of a tagged corpus in WordNet trees.
 
-        noun_results.append(np.array([leaf.value for leaf in noun_tree.leaves()]))
-        verb_results.append(np.array([leaf.value for leaf in verb_tree.leaves()]))
+    Args:
+        synsets - optional - the synset table of the corpus (see
+            resolve_synsets), computed if not given and the corpus has no
+            synsets yet
+        pool - optional - a WorkerPool to compute the synset table on
 
-    manager = Manager()
-    noun_results = manager.list()
-    verb_results = manager.list()
-    pool = []
+    Returns:
+        tuple (noun tree, verb tree) of ArrayWordNetTree with updated counts
+    """
+    attach_synsets(corpus, num_workers, synsets, pool)
+    counts = corpus.synset_counts()
 
-    share = math.ceil(len(passwords)/num_workers)
-    for i in range(num_workers):
-        work = passwords[i*share:i*share+share]
-        p = Process(target=do_work, args=(work, noun_results, verb_results))
-        p.start()
-        pool.append(p)
+    noun_tree = load_tree('n', array=True)
+    verb_tree = load_tree('v', array=True)
 
-    for p in pool:
-        p.join()
+    noun_tree.increment_synset_counts({name: count
+        for name, count in counts.items() if synset_pos(name) == 'n'})
+    verb_tree.increment_synset_counts({name: count
+        for name, count in counts.items() if synset_pos(name) == 'v'})
 
-    noun_counts = np.sum(noun_results, 0)
-    verb_counts = np.sum(verb_results, 0)
+    noun_tree.updateCounts()
+    verb_tree.updateCounts()
 
-    noun_tree = IndexedWordNetTree('n')
-    verb_tree = IndexedWordNetTree('v')
+    return noun_tree, verb_tree
 
-    for i, leaf in enumerate(noun_tree.leaves()):
-        leaf.value = noun_counts[i]
-    for i, leaf in enumerate(verb_tree.leaves()):
-        leaf.value = verb_counts[i]
 
-    noun_tree.updateCounts()
-    verb_tree.updateCounts()
+def fit_tree_cut_models(corpus, estimator, specificity, num_workers,
+    synsets=None, pool=None):
+    noun_tree, verb_tree = count_synsets(corpus, num_workers, synsets, pool)
 
     tcm_n = TreeCutModel('n', estimator=estimator, specificity=specificity)
     tcm_n.fit_tree(noun_tree)
 
+    for level, treecut in enumerate(tcm_n.treecuts):
+        log.info("Noun tree cut (abstraction {}): {} classes, description "
+            "length {:.1f}".format(tcm_n.specificities[level], treecut.size(),
+            tcm_n.description_lengths[level]))
+
     tcm_v = TreeCutModel('v', estimator=estimator)
     tcm_v.fit_tree(verb_tree)
 
@@ -447,122 +959,310 @@ def fit_tree_cut_models(passwords, estimator, specificity, num_workers):
 class MyManager(BaseManager): pass
 
 
-def fit_grammar(passwords, tagtype, estimator, tcm_n, tcm_v, num_workers):
+def _count_grammar(task):
+    """ Count the tags and base structures of a range of passwords of a
+    shared corpus (runs in a worker, see fit_grammar).
 
-    def do_work(passwords, tcm_n, tcm_v, out_list):
-        # a fresh instance of wordnet
-        wordnet = new_wordnet_instance()
+    Returns:
+        GrammarCounts whose string IDs are those of the corpus
+    """
+    handle, classes_path, tagtype, start, end = task
+
+    corpus = _worker.open_corpus(handle)  # memory-mapped, not a copy
+    classes = _worker.load(classes_path) if classes_path else None
+
+    first, last = int(corpus.offsets[start]), int(corpus.offsets[end])
+    tokens = corpus.tokens[first:last].astype(np.int64)
+    pos = corpus.pos[first:last].astype(np.int64)
+    syns = corpus.synsets[first:last].astype(np.int64) if classes \
+        else np.full(last - first, -1, dtype=np.int64)
+
+    # each distinct (string, pos, synset) is tagged once, with all its
+    # semantic variations (one per class of the synset)
+    P, S = len(corpus.tags), len(corpus.synset_names) + 1
+    keys, chunk_keys = np.unique((tokens * P + pos) * S + syns + 1,
+        return_inverse=True)
+
+    strings, pos_tags = corpus.strings, corpus.tags
+    key_strings = keys // (P * S)
+    variants = []
+    for token, p, syn in zip(key_strings.tolist(), (keys // S % P).tolist(),
+            (keys % S - 1).tolist()):
+        synlist = classes[syn] if syn >= 0 else [None]
+        variants.append([(strings[token], pos_tags[p], c) for c in synlist])
+
+    # the cross-product of the variants of chunks is counted without
+    # expanding it; each variation of a single chunk gets the whole count
+    return GrammarCounts.from_chunks(GrammarTagger(), tagtype,
+        chunk_keys.reshape(-1), variants, corpus.offsets[start:end+1] - first,
+        corpus.counts[start:end], key_strings=key_strings,
+        single_full_count=True)
+
+
+def fit_grammar(corpus, tagtype, estimator, tcm_n, tcm_v, num_workers,
+    vocabulary=True, synsets=None, tmpdir=None, pool=None):
+    """
+    Args:
+        corpus - a TaggedCorpus
+        synsets - optional - the synset table of the corpus (see
+            resolve_synsets), computed if not given and the corpus has no
+            synsets yet
+        vocabulary - if True and estimator is 'laplace', add every noun and
+            verb in WordNet to the grammar with count 0 (the 'prior')
+        tmpdir - optional - where to save the corpus for the workers if it
+            is not memory-mapped already (see shared_corpus)
+        pool - optional - a WorkerPool to run on
+    """
+    grammar = Grammar(estimator=estimator, tagtype=tagtype)
 
-        results = []
+    # feed grammar with the 'prior' vocabulary
+    if estimator == 'laplace' and vocabulary:
+        postagger = BackoffTagger.from_pickle()
+        grammar.add_vocabulary(noun_vocab(tcm_n, postagger, min_length=3))
+        grammar.add_vocabulary(verb_vocab(tcm_v, postagger, min_length=2))
 
-        for chunks, count in passwords:
-            X = []  # list of list of tuples. X[0] holds one tuple for
-                    # every different synset of chunks[0]
+    # the classes of every synset of the corpus (abstract/generalize synsets)
+    classes = None
+    if tagtype != 'pos':
+        attach_synsets(corpus, num_workers, synsets, pool)
+
+        classes = []
+        for name in corpus.synset_names:
+            synlist = [None]
+            if synset_pos(name) == 'n':
+                synlist = tcm_n.predict(name)
+            elif synset_pos(name) == 'v':
+                synlist = tcm_v.predict(name)
+            classes.append(list(set(synlist)))
+
+    # the pool is innermost, so that its workers are done with the
+    # temporary files before they are removed
+    with tempfile.TemporaryDirectory(dir=tmpdir) as folder, \
+            shared_corpus(corpus, tmpdir) as handle, \
+            worker_pool(pool, num_workers) as pool:
+
+        # workers load the classes once, rather than once per task
+        classes_path = None
+        if classes is not None:
+            classes_path = os.path.join(folder, 'classes.pickle')
+            with open(classes_path, 'wb') as f:
+                pickle.dump(classes, f, -1)
+
+        # many small ranges, so that workers that are done early take more
+        share = max(1, min(50000,
+            math.ceil(len(corpus) / (pool.num_workers * 8))))
+        tasks = ((handle, classes_path, tagtype, start,
+            min(start + share, len(corpus)))
+            for start in range(0, len(corpus), share))
+
+        # combine partial counts a group at a time, as they arrive
+        pending = []
+        for counts in pool.imap_unordered(_count_grammar, tasks):
+            pending.append(counts)
+            if len(pending) == Grammar.REDUCE_EVERY:
+                pending = [GrammarCounts.reduce(pending)]
+
+        grammar.add_counts(*GrammarCounts.reduce(pending).to_dicts(
+            corpus.strings))
 
-            for string, pos in chunks:
-                syn = synset(string, pos, wordnet, tag_converter)
-                synlist = [None] # in case synset is None
+    return grammar
 
-                if syn is not None:  # abstract (generalize) synset
-                    if syn.pos() == 'n':
-                        synlist = tcm_n.predict(syn)
-                    elif syn.pos() == 'v':
-                        synlist = tcm_v.predict(syn)
 
-                chunkset = [] # all semantic variations of this chunk
-                for syn in set(synlist):
-                    chunkset.append((string, pos, syn))
-                X.append(chunkset)
+def train_grammar(password_file, outfolder, tagtype='backoff',
+    estimator='laplace', specificity=None, num_workers=2,
+    memory_budget=None, tmpdir=None, cache_size=100000, cache_path=None,
+    checkpoint_dir=None, text=True):
+    """Train a semantic password model.
+
+    If specificity is a list (see TreeCutModel), one grammar is trained per
+    value on the same tree cut models, in subfolders of outfolder named
+    'a' + value (e.g., outfolder/a50), without counting synsets again.
+
+    If checkpoint_dir is given, the output of each stage (tagged corpus,
+    synset table, tree cut models and grammar) is saved there, keyed by the contents of the
+    password list and the options affecting the stage. Stages whose artifact
+    already exists are skipped. E.g., changing the estimator or the
+    abstraction level does not require tagging the passwords again.
+
+    Grammars are saved in binary form (see Grammar.write_binary) and, if
+    text is True, also as text files (rules.txt and nonterminals/).
+    """
+    checkpoints = Checkpoints(checkpoint_dir)
+    corpus_key  = None
+
+    if checkpoints.enabled:
+        digest = input_digest(password_file)
+        if digest is None:
+            log.warning("Password list cannot be read twice, checkpoints "
+                "are disabled.")
+            checkpoints = Checkpoints(None)
+        else:
+            corpus_key = checkpoints.key('corpus', digest,
+                segmenter_version(), tagger_version())
 
-            # navigate the cross-product of the chunksets
-            if len(X) > 1:
-                n_variations = reduce(lambda x,y: x * len(y), X, 1)
-                count_ = count/n_variations
-                for x in reduce(product, X):
-                    results.append((x, count_))
-            elif len(X) == 1:
-                for x in X[0]:
-                    results.append(([x], count))
-            else:
-                log.warning("Unable to feed chunks to grammar: {}".format(chunks))
+    levels = specificity if isinstance(specificity, (list, tuple)) \
+        else [specificity]
 
-        out_list.extend(results)
-        # log.info("Results delivered.")
+    if tagtype == 'pos' and len(levels) > 1:
+        log.warning("Tag type 'pos' has no semantic classes, training a "
+            "single grammar.")
+        levels = levels[:1]
 
-    grammar = Grammar(estimator=estimator, tagtype=tagtype)
+    treecut_key = checkpoints.key('treecut', corpus_key, tagtype == 'pos',
+        estimator, levels)
+    grammar_keys = [checkpoints.key('grammar', treecut_key, tagtype, estimator,
+        level) for level in range(len(levels))]
 
-    # feed grammar with the 'prior' vocabulary
-    if estimator == 'laplace':
-        postagger = BackoffTagger.from_pickle()
-        grammar.add_vocabulary(noun_vocab(tcm_n, postagger, min_length=3))
-        grammar.add_vocabulary(verb_vocab(tcm_v, postagger, min_length=2))
+    # one set of processes serves every stage (started only if one runs)
+    pool = WorkerPool(num_workers, cache_size, cache_path)
 
-    if tagtype != 'pos':
-        manager = Manager()
-        results = manager.list()
-        pool    = []
+    # Chunking and Part-of-Speech tagging
 
-        share = math.ceil(len(passwords)/num_workers)
-        for i in range(num_workers):
-            # progressively empty passwords to free memory
-            #work = [passwords.pop() for i in range(min(share, len(passwords)))]
-            work = passwords[i*share:i*share+share]
-            p = Process(target=do_work, args=(work, tcm_n, tcm_v, results))
-            p.start()
-            pool.append(p)
+    def tag():
+        log.info("Counting, chunking and POS tagging... ")
 
-        log.info("Pool has {} workers".format(len(pool)))
+        with Timer("counting, chunking and POS tagging", log):
+            return tally_chunk_tag(password_file, num_workers,
+                memory_budget, tmpdir, pool=pool)
 
-        del passwords[:] # this atrocity is really necessary to free memory
+    with pool:
+        # the tagged corpus is only needed if a later stage has to run
+        corpus = None
+        if not (checkpoints.exists('treecut', treecut_key) and all(
+                checkpoints.exists('grammar', key) for key in grammar_keys)):
+            corpus = checkpoints.run('corpus', corpus_key, tag, TaggedCorpus)
 
-        for p in pool:
-            p.join()
+        # Resolve the synsets of the corpus, once for both stages below
 
-        grammar.fit(results, num_workers=num_workers)
-    else:
-        # add null synset to every segment before passing to grammar
-        for i in range(len(passwords)):
-            x, count = passwords[i]
-            x = [(word, pos, None) for word, pos in x]
-            passwords[i] = (x, count)
+        def resolve():
+            with Timer("resolving synsets", log):
+                return resolve_synsets(corpus, num_workers, pool)
 
-        grammar.fit(passwords, num_workers=num_workers)
+        if corpus is not None and tagtype != 'pos':
+            corpus.set_synsets(checkpoints.run('synsets', corpus_key, resolve))
 
-    return grammar
+        # Train tree cut models
 
+        def fit_tree_cuts():
+            log.info("Training tree cut models... ")
 
-def train_grammar(password_file, outfolder, tagtype='backoff',
-    estimator='laplace', specificity=None, num_workers=2):
-    """Train a semantic password model"""
+            with Timer("training tree cut models", log):
+                if tagtype != 'pos':
+                    return fit_tree_cut_models(corpus, estimator,
+                        levels, num_workers, pool=pool)
+                else:
+                    return None, None
 
-    # Chunking and Part-of-Speech tagging
+        tcm_n, tcm_v = checkpoints.run('treecut', treecut_key, fit_tree_cuts)
 
-    log.info("Counting, chunking and POS tagging... ")
+        grammars = []
 
-    with Timer("counting, chunking and POS tagging", log):
-        passwords = tally_chunk_tag(password_file, num_workers)
+        for level, grammar_key in enumerate(grammar_keys):
+            tcm_level = tcm_n.at_level(level) if tcm_n is not None else None
 
-    # Train tree cut models
+            def fit():
+                log.info("Training grammar...")
 
-    log.info("Training tree cut models... ")
+                with Timer("training grammar", log):
+                    return fit_grammar(corpus, tagtype, estimator, tcm_level,
+                        tcm_v, num_workers, tmpdir=tmpdir, pool=pool)
 
-    with Timer("training tree cut models", log):
-        if tagtype != 'pos':
-            tcm_n, tcm_v = fit_tree_cut_models(passwords, estimator,
-                specificity, num_workers)
-        else:
-            tcm_n = None
-            tcm_v = None
+            grammar = checkpoints.run('grammar', grammar_key, fit)
+
+            folder = outfolder
+            if len(levels) > 1:
+                folder = os.path.join(outfolder, 'a{}'.format(levels[level]))
+
+            log.info("Persisting grammar")
+            grammar.write_to_disk(folder, text)
+            noun_filepath = os.path.join(folder, 'noun_treecut.pickle')
+            verb_filepath = os.path.join(folder, 'verb_treecut.pickle')
+            pickle.dump(tcm_level, open(noun_filepath, 'wb'), -1)
+            pickle.dump(tcm_v, open(verb_filepath, 'wb'), -1)
+
+            grammars.append(grammar)
 
-    log.info("Training grammar...")
+    log.info("Done.")
+
+    return grammars[0] if len(grammars) == 1 else grammars
+
+
+
+def class_resolver(tcm_n, tcm_v, wordnet=wn):
+    """Return a function that, given a word, the class it was assigned to
+    in a grammar and a set of classes replacing it, returns the replacing
+    classes the word belongs to, according to WordNet (see Grammar.relabel).
+    Like synset(), it favors the word's most frequent senses."""
+
+    def resolve(word, old_class, candidates):
+        pos = old_class.split('.')[-2]
+        tcm = tcm_n if pos == 'n' else tcm_v
+
+        for syn in wordnet.synsets(word, pos):
+            try:
+                classes = set(tcm.predict(syn)) & candidates
+            except KeyError:  # synset not in tree
+                continue
+            if classes:
+                return list(classes)
 
-    with Timer("training grammar", log):
-        grammar = fit_grammar(passwords, tagtype, estimator, tcm_n, tcm_v, num_workers)
+        return []
+
+    return resolve
+
+
+def update_grammar(password_file, grammar_dir, num_workers=2,
+    memory_budget=None, tmpdir=None, cache_size=100000, cache_path=None,
+    text=True):
+    """Fold the passwords of a new list into a trained grammar.
+
+    The new passwords are tagged and counted in WordNet trees. Their counts
+    are added to the tree cut models, which are refitted if they received
+    new counts. If a cut changes, the grammar's semantic tags are relabeled
+    accordingly. Finally, the counts of a grammar fitted on the new passwords
+    only are added to the existing grammar, which is written back to
+    grammar_dir. All but the relabeling cost time proportional to the new
+    data.
+    """
+    grammar = Grammar.from_files(grammar_dir)
+    noun_filepath = os.path.join(grammar_dir, 'noun_treecut.pickle')
+    verb_filepath = os.path.join(grammar_dir, 'verb_treecut.pickle')
+    tcm_n = TreeCutModel.from_pickle(noun_filepath)
+    tcm_v = TreeCutModel.from_pickle(verb_filepath)
+
+    with WorkerPool(num_workers, cache_size, cache_path) as pool:
+        log.info("Counting, chunking and POS tagging... ")
+
+        with Timer("counting, chunking and POS tagging", log):
+            corpus = tally_chunk_tag(password_file, num_workers,
+                memory_budget, tmpdir, pool=pool)
+
+        if grammar.tagtype != 'pos':
+            with Timer("resolving synsets", log):
+                corpus.set_synsets(resolve_synsets(corpus, num_workers, pool))
+
+            log.info("Updating tree cut models... ")
+
+            with Timer("updating tree cut models", log):
+                noun_tree, verb_tree = count_synsets(corpus, num_workers)
+                changes = tcm_n.update(noun_tree)
+                changes.update(tcm_v.update(verb_tree))
+
+            if changes:
+                log.info("{} classes of the tree cuts changed, relabeling "
+                    "grammar...".format(len(changes)))
+                grammar.relabel(changes, class_resolver(tcm_n, tcm_v))
+
+        log.info("Training grammar on the new passwords...")
+
+        with Timer("training grammar", log):
+            new_grammar = fit_grammar(corpus, grammar.tagtype,
+                grammar.estimator, tcm_n, tcm_v, num_workers, vocabulary=False,
+                tmpdir=tmpdir, pool=pool)
+            grammar.merge(new_grammar)
 
     log.info("Persisting grammar")
-    grammar.write_to_disk(outfolder)
-    noun_filepath = os.path.join(outfolder, 'noun_treecut.pickle')
-    verb_filepath = os.path.join(outfolder, 'verb_treecut.pickle')
+    grammar.write_to_disk(grammar_dir, text)
     pickle.dump(tcm_n, open(noun_filepath, 'wb'), -1)
     pickle.dump(tcm_v, open(verb_filepath, 'wb'), -1)
 
@@ -571,22 +1271,41 @@ def train_grammar(password_file, outfolder, tagtype='backoff',
     return grammar
 
 
-
 def options():
     parser = argparse.ArgumentParser()
     parser.add_argument('passwords', nargs='?', default=sys.stdin,
         type=argparse.FileType('r'), help='a password list')
     parser.add_argument('output_folder', help='a folder to store the grammar model')
+    parser.add_argument('--update', action='store_true',
+        help='add the passwords to the grammar in output_folder instead of \
+        training a new one')
     parser.add_argument('--estimator', default='mle', choices=['mle', 'laplace'])
     parser.add_argument('-a', '--abstraction', type=int, default=None,
-        help='Detail level of the grammar. An integer > 0 proportional to \
-        the desired specificity.')
+        nargs='+', help='Detail level of the grammar. An integer > 0 \
+        proportional to the desired specificity. If several are given, \
+        a grammar is trained for each in a subfolder of output_folder.')
     parser.add_argument('-v', action = 'append_const', const = 1, help="""
         verbose level (e.g., -vvv) """)
     parser.add_argument('--tagtype', default='backoff',
         choices=['pos_semantic', 'pos', 'backoff', 'word'])
     parser.add_argument('-w', '--num_workers', type=int, default=2,
         help="number of cores available for parallel work")
+    parser.add_argument('-m', '--memory_budget', type=int, default=None,
+        help='count passwords in on-disk shards, using at most this many \
+        megabytes per shard (for lists too large to count in memory)')
+    parser.add_argument('--tmpdir', default=None,
+        help='folder for temporary files (default: system temp folder)')
+    parser.add_argument('--cache_size', type=int, default=100000,
+        help='max. number of memoized segmentations and POS taggings per \
+        worker')
+    parser.add_argument('--cache', default=None,
+        help='a file for caching segmentations and POS tags across runs')
+    parser.add_argument('--checkpoints', default=None,
+        help='a folder for saving the output of each training stage, so \
+        that later runs with the same inputs can skip them')
+    parser.add_argument('--no_text', action='store_true',
+        help='save the grammar in binary form only, without the text files \
+        (rules.txt and nonterminals/) that guessmaker reads')
     return parser.parse_args()
 
 
@@ -599,9 +1318,26 @@ if __name__ == '__main__':
     logging.basicConfig(level=verbose_levels[verbose_level])
     log.setLevel(verbose_levels[verbose_level])
 
+    if opts.update:
+        update_grammar(password_file,
+                       opts.output_folder,
+                       opts.num_workers,
+                       opts.memory_budget * 2**20 if opts.memory_budget else None,
+                       opts.tmpdir,
+                       opts.cache_size,
+                       opts.cache,
+                       not opts.no_text)
+        sys.exit()
+
     train_grammar(password_file,
                   opts.output_folder,
                   opts.tagtype,
                   opts.estimator,
                   opts.abstraction,
-                  opts.num_workers)
+                  opts.num_workers,
+                  opts.memory_budget * 2**20 if opts.memory_budget else None,
+                  opts.tmpdir,
+                  opts.cache_size,
+                  opts.cache,
+                  opts.checkpoints,
+                  not opts.no_text)
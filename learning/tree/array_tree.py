@@ -0,0 +1,315 @@
+"""
+A tree whose structure and counts live in NumPy arrays.
+
+Nodes are stored in depth-first (pre)order, so parents precede their children
+and every subtree occupies a contiguous range of positions. Aggregating counts
+is then a vectorized reduction (one per level of the tree) instead of a walk
+over linked Python objects.
+
+ArrayTreeNode is a light view of a position that provides the node API of
+DefaultTreeNode (key, value, parent, children(), leaves()...), so the tree
+cut algorithms and TreeCut work with either kind of tree.
+"""
+
+from learning.tree.abstract import Tree, TreeNode
+
+import numpy as np
+
+
+class ArrayTreeNode(TreeNode):
+
+    __slots__ = ('tree', 'id')
+
+    def __init__(self, tree, i):
+        self.tree = tree
+        self.id = i  # the position of the node in the tree's arrays
+
+    @property
+    def key(self):
+        return self.tree.keys[self.id]
+
+    @property
+    def value(self):
+        return self.tree.value[self.id]
+
+    @value.setter
+    def value(self, value):
+        self.tree.value[self.id] = value
+
+    @property
+    def leaf_count(self):
+        return self.tree.leaf_count[self.id]
+
+    @leaf_count.setter
+    def leaf_count(self, leaf_count):
+        self.tree.leaf_count[self.id] = leaf_count
+
+    @property
+    def depth(self):
+        return self.tree.depth[self.id]
+
+    @property
+    def parent(self):
+        return self.tree.node(self.tree.parent[self.id])
+
+    @property
+    def leftchild(self):
+        return self.tree.node(self.tree.first_child[self.id])
+
+    @property
+    def rightsibling(self):
+        return self.tree.node(self.tree.next_sibling[self.id])
+
+    def is_leaf(self):
+        return self.tree.first_child[self.id] < 0
+
+    def has_children(self):
+        return not self.is_leaf()
+
+    def children(self):
+        tree = self.tree
+        children = []
+        c = tree.first_child[self.id]
+        while c >= 0:
+            children.append(tree.node(c))
+            c = tree.next_sibling[c]
+        return children
+
+    def child(self, key):
+        for c in self.children():
+            if c.key == key:
+                return c
+        return None
+
+    def find(self, key):
+        return self.child(key)
+
+    def leaves(self):
+        """Return the leaves within the subtree rooted at this node, in
+        depth-first order (as DefaultTreeNode.leaves)."""
+        tree = self.tree
+        start, end = self.id, tree.end[self.id]
+        positions = start + np.flatnonzero(tree.is_leaf[start:end])
+        return [tree.node(i) for i in positions.tolist()]
+
+    def flat(self):
+        """Return all nodes of the subtree, parents before children."""
+        return [self.tree.node(i) for i in range(self.id, self.tree.end[self.id])]
+
+    def increment_value(self, delta, cumulative=True):
+        if cumulative:
+            self.tree.value[self.tree.ancestors(self.id)] += delta
+        else:
+            self.tree.value[self.id] += delta
+
+    def path(self):
+        """ Returns the path to the root based on the parent attribute."""
+        return [self.tree.node(i) for i in reversed(self.tree.ancestors(self.id))]
+
+    def updateCounts(self):
+        """Counts are aggregated for the whole tree at once (see
+        ArrayTree.updateCounts)."""
+        self.tree.updateCounts()
+
+    def __str__(self):
+        return self.key
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class ArrayTree(Tree):
+
+    def __init__(self, keys, parents, value=None):
+        """
+        Args:
+            keys - list of node keys in depth-first order
+            parents - for each node, the position of its parent in that
+                order (-1 for the root, which must come first)
+            value - optional - the counts of the nodes (default: zeros)
+        """
+        n = len(keys)
+        parent = np.asarray(parents, dtype=np.int32)
+
+        if n == 0 or parent[0] != -1 or np.any(parent[1:] >= np.arange(1, n)):
+            raise ValueError("Nodes must be in depth-first order, root first.")
+
+        self.keys = list(keys)
+        self.parent = parent
+        self.value = np.zeros(n) if value is None \
+            else np.array(value, dtype=np.float64)
+        self.leaf_count = np.zeros(n, dtype=np.int64)
+
+        self._link()
+        self._views = [None] * n
+        self._index = None
+        self.root = self.node(0)
+        self.updateCounts()
+
+    def _link(self):
+        """Derive first_child, next_sibling, depth, levels and subtree ends
+        from the parent array."""
+        n = len(self.keys)
+        parent = self.parent
+        children = np.arange(1, n)
+
+        self.first_child = np.full(n, -1, dtype=np.int32)
+        parents, first = np.unique(parent[1:], return_index=True)
+        self.first_child[parents] = first + 1
+
+        # siblings are consecutive when children are grouped by parent
+        # (stable, so they keep their depth-first order)
+        order = children[np.argsort(parent[1:], kind='stable')]
+        same_parent = parent[order[:-1]] == parent[order[1:]]
+        self.next_sibling = np.full(n, -1, dtype=np.int32)
+        self.next_sibling[order[:-1][same_parent]] = order[1:][same_parent]
+
+        self.is_leaf = self.first_child < 0
+
+        depth = np.zeros(n, dtype=np.int32)
+        for i, p in zip(children.tolist(), parent[1:].tolist()):
+            depth[i] = depth[p] + 1
+        self.depth = depth
+
+        # positions grouped by depth, deepest first: visiting them in this
+        # order, children are always reduced before their parents
+        by_depth = np.argsort(depth, kind='stable')
+        bounds = np.searchsorted(depth[by_depth], np.arange(depth.max() + 2))
+        self.levels = [by_depth[bounds[d]:bounds[d+1]]
+            for d in range(depth.max(), 0, -1)]
+
+        size = np.ones(n, dtype=np.int64)
+        for level in self.levels:
+            size += np.bincount(parent[level], weights=size[level],
+                minlength=n).astype(np.int64)
+        self.end = np.arange(n) + size
+
+    def node(self, i):
+        """Return the view of the node at position i (None if i < 0). The
+        same object is returned for a position every time."""
+        if i < 0:
+            return None
+        view = self._views[i]
+        if view is None:
+            view = self._views[i] = ArrayTreeNode(self, int(i))
+        return view
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ancestors(self, i):
+        """Return the positions of node i and its ancestors, bottom-up."""
+        path = []
+        while i >= 0:
+            path.append(i)
+            i = self.parent[i]
+        return path
+
+    @property
+    def index(self):
+        """ A dict mapping each key to the list of nodes with that key. """
+        if self._index is None:
+            index = dict()
+            for i, key in enumerate(self.keys):
+                if key in index:
+                    index[key].append(i)
+                else:
+                    index[key] = [i]
+            self._index = _NodeIndex(self, index)
+        return self._index
+
+    def get_nodes(self, key):
+        return self.index[key] if key in self.index else None
+
+    def positions(self, key):
+        """ Return the positions of the nodes with a given key. """
+        return self.index.positions.get(key, [])
+
+    def updateCounts(self):
+        """ Recompute value and leaf_count of internal nodes from the leaves:
+        the value of an internal node is the sum of the values of the leaves
+        under it. """
+        n = len(self.keys)
+        is_leaf = self.is_leaf
+        value = np.where(is_leaf, self.value, 0)
+        leaf_count = is_leaf.astype(np.int64)
+
+        for level in self.levels:
+            parents = self.parent[level]
+            value += np.bincount(parents, weights=value[level], minlength=n)
+            leaf_count += np.bincount(parents, weights=leaf_count[level],
+                minlength=n).astype(np.int64)
+
+        self.value = value
+        self.leaf_count = leaf_count
+
+    def leaves(self):
+        return self.root.leaves()
+
+    def flat(self):
+        return self.root.flat()
+
+    def hashtable(self):
+        return {key: list(nodes) for key, nodes in self.index.items()}
+
+    def snapshot(self):
+        """ The structure of the tree, as WordNetTree.snapshot(). """
+        return {'keys': self.keys, 'parents': self.parent}
+
+    @classmethod
+    def from_tree(cls, tree):
+        """ Copy a linked tree (e.g., a WordNetTree), including its counts. """
+        keys, parents, values = [], [], []
+        position = dict()  # id(node) -> position
+
+        stack = [tree.root]
+        while stack:
+            node = stack.pop()
+            position[id(node)] = len(keys)
+            keys.append(node.key)
+            parents.append(position[id(node.parent)] if node.parent else -1)
+            values.append(node.value)
+            stack.extend(reversed(node.children()))
+
+        return cls(keys, parents, values)
+
+    def __getstate__(self):
+        # the derived arrays and views are rebuilt on load
+        return {
+            'keys': self.keys,
+            'parent': self.parent,
+            'value': self.value
+        }
+
+    def __setstate__(self, d):
+        ArrayTree.__init__(self, d['keys'], d['parent'], d['value'])
+
+
+class _NodeIndex(object):
+    """ Read-only mapping key -> list of nodes, backed by a mapping
+    key -> list of positions (so that node views are made on demand). """
+
+    def __init__(self, tree, positions):
+        self.tree = tree
+        self.positions = positions
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __getitem__(self, key):
+        return [self.tree.node(i) for i in self.positions[key]]
+
+    def get(self, key, default=None):
+        return self[key] if key in self.positions else default
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def keys(self):
+        return self.positions.keys()
+
+    def items(self):
+        return ((key, self[key]) for key in self.positions)
@@ -10,14 +10,75 @@ Created on Mar 23, 2013
 
 from . import _li_abe
 from . import _wagner
+from ..array_tree import ArrayTree
 
+import math
+import numpy as np
 
 
 class li_abe:
 
     def findcut(self, tree, estimator=None):
+        return self._dp_findcut(tree, estimator)
+
+    def findcut_recursive(self, tree, estimator=None):
+        """ The original, recursive search. Returns the same cut as
+        findcut(), but much slower on large trees. """
         return self._findcut(tree.root, tree.root.value, estimator)
 
+    def _dl_weights(self, sample_size, **args):
+        """ Return (w, l) such that the description length of a cut is
+        w * (its data description length) + l * (its number of nodes), up
+        to a constant. """
+        return 1, math.log(sample_size, 2) / 2
+
+    def _dp_findcut(self, tree, estimator=None, **args):
+        t, nodes = _as_array_tree(tree)
+        ddl = _node_ddl(t, t.value[0], estimator)
+        cut, dl = self._dp(t, ddl, **args)
+        return _cut_nodes(t, nodes, cut)
+
+    def _dp(self, t, ddl, **args):
+        """ Bottom-up dynamic programming on the tree's arrays. The best cut
+        of a subtree is either its root or the union of the best cuts of the
+        root's children, so every node is visited once, level by level.
+
+        Args:
+            t - an ArrayTree
+            ddl - the data description length of every node (see _node_ddl)
+
+        Returns:
+            tuple (positions of the cut nodes, description length of the cut)
+        """
+        n = len(t)
+        parent = t.parent
+        is_leaf = t.is_leaf
+
+        w, l = self._dl_weights(t.value[0], **args)
+        single = w * ddl + l
+        cost = single.copy()         # description length of the best cut
+        children = np.zeros(n)       # sum of the children's costs
+        select = np.ones(n, dtype=bool)  # True if the node beats its children
+
+        for level in t.levels + [np.zeros(1, dtype=np.int64)]:
+            internal = level[~is_leaf[level]]
+            # using <= instead of < leads to better generalization
+            # deviates slightly from Li & Abe
+            select[internal] = single[internal] <= children[internal]
+            cost[internal] = np.where(select[internal], single[internal],
+                children[internal])
+            if level[0] != 0:
+                children += np.bincount(parent[level], weights=cost[level],
+                    minlength=n)
+
+        # the cut: selected nodes without a selected ancestor
+        covered = np.zeros(n, dtype=bool)
+        for level in reversed(t.levels):
+            covered[level] = covered[parent[level]] | select[parent[level]]
+        cut = np.flatnonzero(select & ~covered).tolist()
+
+        return cut, float(cost[0] - l)
+
     def _findcut(self, node, samplesize, estimator=None, **args):
         # bind common args for the sake of conciseness
         findcut = lambda arg: self._findcut(arg, samplesize, estimator, **args)
@@ -58,19 +119,107 @@ class wagner(li_abe):
     default_c = 50  # default weighting factor
 
     def findcut(self, tree, weight=None, estimator=None):
+        if weight is None:
+            weight = wagner.default_c
+        return self._dp_findcut(tree, estimator, weight=weight)
+
+    def findcut_recursive(self, tree, weight=None, estimator=None):
         if weight is None:
             weight = wagner.default_c
         return self._findcut(tree.root, tree.root.value, estimator, weight=weight)
 
+    def _dl_weights(self, sample_size, weight=50):
+        return weight * math.log(sample_size, 2) / sample_size, \
+            math.log(sample_size, 2) / 2
+
     def desc_length(self, cut, sample_size, estimator=None, weight=50):
         """ Returns the description length of a cut """
         dl = _wagner.compute_dl(cut, sample_size, weight, estimator)
 
         return dl
 
+def _as_array_tree(tree):
+    """ Return (ArrayTree, None) for array trees. Other trees are copied
+    into an ArrayTree, keeping their nodes' values and leaf counts as they
+    are; the list of nodes in depth-first order is returned along. """
+    if isinstance(tree, ArrayTree):
+        return tree, None
+
+    nodes, parents = [], []
+    position = dict()  # id(node) -> position
+
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        position[id(node)] = len(nodes)
+        nodes.append(node)
+        parents.append(position[id(node.parent)] if node.parent else -1)
+        stack.extend(reversed(node.children()))
+
+    t = ArrayTree([node.key for node in nodes], parents)
+    t.value = np.array([node.value for node in nodes], dtype=np.float64)
+    t.leaf_count = np.array([getattr(node, 'leaf_count', 0) for node in nodes])
+    return t, nodes
+
+
+def _cut_nodes(t, nodes, cut):
+    """ Map positions in an ArrayTree to nodes (see _as_array_tree). """
+    if nodes is None:
+        return [t.node(i) for i in cut]
+    return [nodes[i] for i in cut]
+
+
+def _node_ddl(tree, sample_size, estimator=None):
+    """ The data description length of every node as a single-node cut
+    (see _li_abe.compute_ddl), as an array. """
+    if estimator is None:
+        p = tree.value / sample_size
+    elif hasattr(estimator, 'probabilities'):
+        p = estimator.probabilities(tree.value, tree.leaf_count)
+    else:
+        p = np.array([estimator.probability(tree.node(i))
+            for i in range(len(tree))])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pn = p / tree.leaf_count
+
+    ddl = np.zeros(len(tree))
+    positive = pn > 0
+    ddl[positive] = -(np.log(pn[positive]) / math.log(2)) * tree.value[positive]
+    return ddl
+
+
 #:::::::::::::::::::::
 # PUBLIC API
 #:::::::::::::::::::::
 
 li_abe = li_abe()
 wagner = wagner()
+
+
+def findcuts(tree, specificities, estimator=None):
+    """ Find one cut per specificity in one pass over the tree's counts: the
+    description lengths of the nodes are computed once and only the (cheap)
+    bottom-up search is repeated.
+
+    Args:
+        tree - a tree with updated counts
+        specificities - list of Wagner weights; None stands for Li & Abe's
+            method
+        estimator - optional - see li_abe.findcut
+
+    Returns:
+        list of tuples (cut, description length), one per specificity
+    """
+    t, nodes = _as_array_tree(tree)
+    ddl = _node_ddl(t, t.value[0], estimator)
+
+    cuts = []
+    for specificity in specificities:
+        if specificity is None:
+            cut, dl = li_abe._dp(t, ddl)
+        else:
+            cut, dl = wagner._dp(t, ddl, weight=specificity)
+        cuts.append((_cut_nodes(t, nodes, cut), dl))
+
+    return cuts
@@ -0,0 +1,105 @@
+"""
+Compares the dynamic programming tree cut search (findcut) with the original
+recursive one (findcut_recursive): running time and resulting cuts.
+
+By default, runs on a random tree with roughly the shape of the WordNet noun
+tree. With --wordnet, runs on the WordNet trees with random counts.
+
+    python -m learning.tree.cut.benchmark [--nodes N] [--wordnet]
+"""
+
+from learning.tree.cut import li_abe, wagner
+from learning.tree.array_tree import ArrayTree
+from learning.model import MleEstimator, LaplaceEstimator
+from misc.util import Timer
+
+import sys
+import argparse
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def random_tree(n, max_children=12, seed=0):
+    """ Return an ArrayTree of n nodes with random shape and leaf counts
+    (Zipf-distributed, with many zeros, as synset counts). """
+    rng = np.random.RandomState(seed)
+
+    keys, parents = ['root'], [-1]
+    open_ = [0]  # nodes that may still receive children
+    while len(keys) < n:
+        p = open_[rng.randint(len(open_))]
+        for _ in range(min(rng.randint(1, max_children), n - len(keys))):
+            open_.append(len(keys))
+            keys.append('node.{}'.format(len(keys)))
+            parents.append(p)
+
+    # relabel positions in depth-first order
+    children = [[] for _ in keys]
+    for i, p in enumerate(parents[1:], 1):
+        children[p].append(i)
+    order, stack = [], [0]
+    while stack:
+        i = stack.pop()
+        order.append(i)
+        stack.extend(reversed(children[i]))
+    position = {old: new for new, old in enumerate(order)}
+
+    tree = ArrayTree([keys[i] for i in order],
+        [position[parents[i]] if i else -1 for i in order])
+    counts = rng.zipf(1.5, len(tree)).astype(np.float64)
+    counts[rng.rand(len(tree)) < 0.7] = 0
+    tree.value = np.where(tree.is_leaf, counts, 0)
+    tree.updateCounts()
+    return tree
+
+
+def compare(tree, name):
+    N = tree.root.value
+    estimators = [('mle', MleEstimator(N)),
+        ('laplace', LaplaceEstimator(N, tree.root.leaf_count, 1))]
+
+    for estimator_name, estimator in estimators:
+        for method, args in [('li_abe', ()), ('wagner', (wagner.default_c,))]:
+            method_ = li_abe if method == 'li_abe' else wagner
+            title = '{} {} {}'.format(name, method, estimator_name)
+
+            with Timer(title + ' (recursive)', log) as t1:
+                old = method_.findcut_recursive(tree, *args, estimator=estimator)
+            with Timer(title + ' (dynamic programming)', log) as t2:
+                new = method_.findcut(tree, *args, estimator=estimator)
+
+            same = [node.id for node in old] == [node.id for node in new]
+            print('{:<40} {:>8.3f}s {:>8.3f}s {:>6.1f}x  cut size {:>6}  {}'
+                .format(title, t1.elapsed, t2.elapsed,
+                    t1.elapsed / max(t2.elapsed, 1e-9), len(new),
+                    'same cut' if same else 'DIFFERENT CUT'))
+
+
+def options():
+    parser = argparse.ArgumentParser(description=('Benchmark the dynamic '
+        'programming tree cut search against the recursive one.'))
+    parser.add_argument('--nodes', type=int, default=150000,
+        help='number of nodes of the random tree')
+    parser.add_argument('--wordnet', action='store_true',
+        help='use the WordNet trees (with random counts) instead')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts = options()
+    sys.setrecursionlimit(100000)
+
+    if opts.wordnet:
+        from learning.tree.wordnet import load_tree
+        rng = np.random.RandomState(0)
+        for pos in ('n', 'v'):
+            tree = load_tree(pos, array=True)
+            counts = rng.zipf(1.5, len(tree)).astype(np.float64)
+            counts[rng.rand(len(tree)) < 0.7] = 0
+            tree.value = np.where(tree.is_leaf, counts, 0)
+            tree.updateCounts()
+            compare(tree, 'wordnet ' + pos)
+    else:
+        compare(random_tree(opts.nodes), 'random')
@@ -407,11 +407,13 @@ class TreeCut(object):
             return None
 
     def abstract_synset(self, syn):
+        """Returns the nodes that represent a synset (or synset name)"""
+        name = syn if isinstance(syn, str) else syn.name()
         try:
-            key = 's.' + syn.name()
+            key = 's.' + name
             return self.leaf2cut[key]
         except:
-            return self.leaf2cut[syn.name()]
+            return self.leaf2cut[name]
 
     def __contains__(self, item):
         return id(item) in self.cut_ids
@@ -428,9 +430,13 @@ class TreeCut(object):
         self.tree = d['tree']
         cut_ids = set(d['cut']) # the ids of cut nodes
         self.cut = []
-        for depth, node in DepthFirstIterator(self.tree.root):
-            if node.id in cut_ids:
-                self.cut.append(node)
+        if hasattr(self.tree, 'node'):
+            # array-backed trees: ids are positions in depth-first order
+            self.cut = [self.tree.node(i) for i in sorted(cut_ids)]
+        else:
+            for depth, node in DepthFirstIterator(self.tree.root):
+                if node.id in cut_ids:
+                    self.cut.append(node)
         self._build_indexes()
 
 
@@ -7,8 +7,22 @@ Created on 2013-03-25
 
 from nltk.corpus import wordnet as wn
 from learning.tree.default_tree import DefaultTree, DefaultTreeNode, DepthFirstIterator
+from learning.tree.array_tree import ArrayTree
 from collections import deque
 
+import os
+import pickle
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# where snapshots of the WordNet trees are stored (see load_tree), by default
+# in the user's cache directory
+snapshot_folder = os.environ.get('WORDNET_TREE_CACHE', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'semantic-guesser'))
+
 class WordNetTreeNode(DefaultTreeNode):
 
     # a counter for ids. Everytime a node is created, next_id is assigned to it
@@ -168,6 +182,60 @@ class WordNetTree(DefaultTree):
     def updateCounts(self):
         self.root.updateCounts()
 
+    def snapshot(self):
+        """ Return a compact representation of the tree's structure (without
+        counts): the node keys in depth-first order and, for each node, the
+        position of its parent in that order (-1 for the root).
+        """
+        keys = []
+        parents = []
+        position = dict()  # id(node) -> position
+
+        for depth, node in DepthFirstIterator(self.root):
+            position[id(node)] = len(keys)
+            keys.append(node.key)
+            parents.append(position[id(node.parent)] if node.parent else -1)
+
+        return {
+            'pos': self.pos,
+            'keys': keys,
+            'parents': np.array(parents, dtype=np.int32)
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot, wordnet=None):
+        """ Build a tree from the output of snapshot(), without querying
+        WordNet. All counts are zero. """
+        tree = cls.__new__(cls)
+        WordNetTree.__init__(tree, snapshot['pos'], wordnet, init=False)
+
+        keys = snapshot['keys']
+        nodes = [None] * len(keys)
+        last_child = [None] * len(keys)
+
+        for i, (key, parent) in enumerate(zip(keys, snapshot['parents'].tolist())):
+            node = WordNetTreeNode(key)
+            nodes[i] = node
+
+            if parent < 0:
+                continue
+
+            node.parent = nodes[parent]
+            if last_child[parent] is None:
+                nodes[parent].leftchild = node
+            else:
+                last_child[parent].rightsibling = node
+            last_child[parent] = node
+
+        tree.root = nodes[0]
+        tree._init_from_snapshot(nodes)
+        return tree
+
+    def _init_from_snapshot(self, nodes):
+        """ Hook for subclasses to build their indexes from the list of nodes
+        in depth-first order. """
+        pass
+
     def __extend(self, path, is_internal=False):
         """ Given a path representing a subtree,
         create and insert nodes that are missing.
@@ -305,6 +373,14 @@ class IndexedWordNetTree(WordNetTree):
         super(IndexedWordNetTree, self).__init__(pos, wordnet)
         self.index = self.hashtable()
 
+    def _init_from_snapshot(self, nodes):
+        self.index = index = dict()
+        for node in nodes:
+            if node.key in index:
+                index[node.key].append(node)
+            else:
+                index[node.key] = [node]
+
     def get_nodes(self, key):
         return self.index[key] if key in self.index else None
 
@@ -329,5 +405,106 @@ class IndexedWordNetTree(WordNetTree):
         self.index = self.hashtable()
 
 
+class ArrayWordNetTree(ArrayTree):
+    """ A WordNetTree backed by arrays (see learning.tree.array_tree). """
+
+    def __init__(self, pos, keys, parents, value=None):
+        self.pos = pos
+        super(ArrayWordNetTree, self).__init__(keys, parents, value)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return cls(snapshot['pos'], snapshot['keys'], snapshot['parents'])
+
+    def snapshot(self):
+        return {'pos': self.pos, 'keys': self.keys, 'parents': self.parent}
+
+    def increment_synset_counts(self, counts):
+        """ Add synset counts to the leaves, without propagating them (call
+        updateCounts() afterwards). The count of a synset is divided among
+        all nodes with its key; for internal nodes it goes to their sense
+        child ('s.' + key), as in IndexedWordNetTree.
+
+        Args:
+            counts - a mapping synset name -> count
+        """
+        positions = []
+        weights = []
+
+        for key, count in counts.items():
+            nodes = self.positions(key)
+            for i in nodes:
+                if not self.is_leaf[i]:
+                    i = self.node(i).find('s.' + key).id
+                positions.append(i)
+                weights.append(float(count) / len(nodes))
+
+        np.add.at(self.value, np.array(positions, dtype=np.int64), weights)
+
+    def __getstate__(self):
+        d = ArrayTree.__getstate__(self)
+        d['pos'] = self.pos
+        return d
+
+    def __setstate__(self, d):
+        ArrayWordNetTree.__init__(self, d['pos'], d['keys'], d['parent'],
+            d['value'])
+
+
+_snapshots = dict()  # path -> snapshot, loaded once per process
+
+
+def snapshot_path(pos, version, folder=None):
+    folder = snapshot_folder if folder is None else folder
+    return os.path.abspath(os.path.join(folder,
+        'wordnet_tree_{}_{}.pickle'.format(pos, version)))
+
+
+def load_tree(pos, wordnet=None, folder=None, array=False):
+    """ Return a new IndexedWordNetTree (or ArrayWordNetTree) for a
+    part-of-speech.
+
+    Walking WordNet to build the tree is slow, so the tree's structure is
+    saved as a snapshot the first time it is built for a WordNet version and
+    loaded from there afterwards. Within a process, the snapshot is read only
+    once; processes forked after that share it.
+
+    Args:
+        pos - 'n' for nouns and 'v' for verbs
+        wordnet - optional - an instance of WordNetCorpusReader
+        folder - optional - where snapshots are stored (default:
+            snapshot_folder, which the environment variable
+            WORDNET_TREE_CACHE overrides)
+        array - optional - if True, return an ArrayWordNetTree
+    """
+    wordnet = wn if wordnet is None else wordnet
+    path = snapshot_path(pos, wordnet.get_version(), folder)
+
+    if path not in _snapshots:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                _snapshots[path] = pickle.load(f)
+        else:
+            log.info("Building WordNet tree ({}), this happens once per "
+                "WordNet version...".format(pos))
+            tree = IndexedWordNetTree(pos, wordnet)
+            _snapshots[path] = tree.snapshot()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(_snapshots[path], f, -1)
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                log.warning("Could not save WordNet tree snapshot: {}"
+                    .format(e))
+            if not array:
+                return tree
+
+    snapshot = _snapshots[path]
+    if array:
+        return ArrayWordNetTree.from_snapshot(snapshot)
+    return IndexedWordNetTree.from_snapshot(snapshot, wordnet)
+
+
 if __name__ == '__main__':
     pass
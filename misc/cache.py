@@ -0,0 +1,106 @@
+"""
+A local, on-disk key-value cache for results that are expensive to compute
+and reused across runs (e.g., word segmentation and POS tagging).
+
+Entries are content-addressed (stored under a digest of the key) and grouped
+in namespaces. Each namespace records the version of whatever produced its
+values; opening a namespace with a different version empties it.
+
+Backed by sqlite, so several processes can share one cache file.
+"""
+
+import sqlite3
+import pickle
+import hashlib
+
+
+class PersistentCache(object):
+
+    def __init__(self, path, namespace, version, flush_every=1000, timeout=60):
+        """
+        Args:
+            path - the cache file (created if it does not exist)
+            namespace - a name for the kind of values stored (str)
+            version - version of the code/data producing the values (str).
+                If it differs from the stored one, the namespace is cleared.
+            flush_every - new entries are written in batches of this size
+            timeout - seconds to wait for other processes holding a lock
+        """
+        self.path      = path
+        self.namespace = namespace
+        self.version   = str(version)
+        self.flush_every = flush_every
+        self.pending   = dict()
+        self.hits      = 0
+        self.misses    = 0
+
+        self.db = sqlite3.connect(path, timeout=timeout)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS versions ('
+                'namespace TEXT PRIMARY KEY, version TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                'namespace TEXT, key BLOB, value BLOB, '
+                'PRIMARY KEY (namespace, key))')
+            self._validate()
+
+    def _validate(self):
+        row = self.db.execute('SELECT version FROM versions WHERE namespace=?',
+            (self.namespace,)).fetchone()
+
+        if row is None or row[0] != self.version:
+            self.db.execute('DELETE FROM entries WHERE namespace=?',
+                (self.namespace,))
+            self.db.execute('INSERT OR REPLACE INTO versions VALUES (?, ?)',
+                (self.namespace, self.version))
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha1(pickle.dumps(key, 4)).digest()
+
+    def get(self, key, default=None):
+        digest = self.digest(key)
+
+        if digest in self.pending:
+            self.hits += 1
+            return self.pending[digest]
+
+        row = self.db.execute('SELECT value FROM entries WHERE namespace=? '
+            'AND key=?', (self.namespace, digest)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.pending[self.digest(key)] = value
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        rows = [(self.namespace, digest, pickle.dumps(value, -1))
+            for digest, value in self.pending.items()]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO entries '
+                'VALUES (?, ?, ?)', rows)
+        self.pending = dict()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
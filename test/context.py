@@ -4,8 +4,16 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from learning import pos, model, train
-from learning.tree.cut import _li_abe, li_abe
-from learning.tree.wordnet import WordNetTreeNode, WordNetTree
-from learning.tree.default_tree import DefaultTree, DepthFirstIterator
-from learning.model import MleEstimator, LaplaceEstimator, Grammar
-from guessing import score
+from learning.checkpoint import Checkpoints, input_digest
+from learning.corpus import CorpusBuilder, TaggedCorpus, shared_corpus
+from learning.tree.cut import _li_abe, li_abe, wagner, benchmark, findcuts
+from learning.tree import wordnet as wordnet_tree
+from learning.tree.wordnet import WordNetTreeNode, WordNetTree, \
+    IndexedWordNetTree, load_tree
+from learning.tree.default_tree import DefaultTree, DepthFirstIterator, TreeCut
+from learning.tree.array_tree import ArrayTree
+from learning.terminals import alias_table
+from learning.model import MleEstimator, LaplaceEstimator, Grammar, \
+    GrammarCounts, GrammarTagger, TreeCutModel, count_factorized
+from misc.cache import PersistentCache
+from guessing import score, sample, guesses
@@ -0,0 +1,94 @@
+from context import train, PersistentCache
+
+
+def test_reopen(tmpdir):
+    path = str(tmpdir.join('cache.db'))
+
+    with PersistentCache(path, 'segment', '1') as cache:
+        cache['iloveyou'] = ['i', 'love', 'you']
+        cache[('love', None)] = ('vv0', None)
+        assert cache.get('iloveyou') == ['i', 'love', 'you']
+
+    with PersistentCache(path, 'segment', '1') as cache:
+        assert cache.get('iloveyou') == ['i', 'love', 'you']
+        assert cache.get(('love', None)) == ('vv0', None)
+        assert cache.get('dog') is None
+        assert cache.hit_rate() == 2/3
+
+        # namespaces have their own entries and versions
+        with PersistentCache(path, 'pos_tag', '7') as other:
+            assert other.get('iloveyou') is None
+        assert cache.get('iloveyou') == ['i', 'love', 'you']
+
+
+def test_version(tmpdir):
+    path = str(tmpdir.join('cache.db'))
+
+    with PersistentCache(path, 'segment', '1') as cache:
+        cache['iloveyou'] = ['i', 'love', 'you']
+
+    # a different version empties the namespace, also for the old version
+    with PersistentCache(path, 'segment', '2') as cache:
+        assert cache.get('iloveyou') is None
+    with PersistentCache(path, 'segment', '1') as cache:
+        assert cache.get('iloveyou') is None
+
+
+def test_tagger_version(tmpdir, monkeypatch):
+    """ Tags cached with a tagger are not returned after its data changes. """
+    coca = tmpdir.join('coca.csv')
+    coca.write('1000\tlove\tvv0\t\n')
+    backoff = tmpdir.join('backoff_tagger.pickle')
+    backoff.write('tagger')
+    monkeypatch.setattr(train.COCATagger, 'coca_path', str(coca))
+    monkeypatch.setattr(train.BackoffTagger, 'pickle_path', str(backoff))
+
+    class Tagger(object):
+        def __init__(self, tag):
+            self.tag_ = tag
+
+        def tag(self, tokens):
+            return [(token, self.tag_) for token in tokens]
+
+    path = str(tmpdir.join('cache.db'))
+
+    def chunk_and_tag(password, tagger):
+        versions = (train.segmenter_version(), train.tagger_version())
+        segment_cache, tag_cache = train.open_persistent_caches(path, versions)
+        memo = train.MemoChunkTagger(tagger, None,
+            segment_cache=segment_cache, tag_cache=tag_cache)
+        try:
+            return memo.chunk_and_tag(password)
+        finally:
+            memo.close()
+
+    assert chunk_and_tag('love123', Tagger('vv0')) == \
+        [('love', 'vv0'), ('123', None)]
+    # same versions: the cached tags are returned
+    assert chunk_and_tag('love123', Tagger('nn1')) == \
+        [('love', 'vv0'), ('123', None)]
+
+    coca.write('1000\tlove\tnn1\t\n')
+    assert chunk_and_tag('love123', Tagger('nn1')) == \
+        [('love', 'nn1'), ('123', None)]
+
+
+def test_flush_every(tmpdir):
+    path = str(tmpdir.join('cache.db'))
+
+    writer = PersistentCache(path, 'segment', '1', flush_every=3)
+    reader = PersistentCache(path, 'segment', '1')
+
+    writer['a'] = 1
+    writer['b'] = 2
+    assert writer.get('a') == 1  # pending entries are visible to the writer
+    assert reader.get('a') is None
+
+    writer['c'] = 3  # a batch of flush_every entries is written at once
+    assert [reader.get(key) for key in 'abc'] == [1, 2, 3]
+
+    writer['d'] = 4
+    assert reader.get('d') is None
+    writer.close()  # closing writes the rest
+    assert reader.get('d') == 4
+    reader.close()
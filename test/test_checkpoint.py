@@ -0,0 +1,121 @@
+from context import Checkpoints, input_digest, CorpusBuilder, TaggedCorpus
+
+import io
+import os
+
+
+class Stage(object):
+    """A stage function that records how many times it ran."""
+
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_skip(tmpdir):
+    checkpoints = Checkpoints(str(tmpdir))
+    key = checkpoints.key('corpus', 'digest', 'tagger-1')
+    stage = Stage({'love': 3})
+
+    assert checkpoints.run('corpus', key, stage) == {'love': 3}
+    assert checkpoints.run('corpus', key, stage) == {'love': 3}
+    assert stage.calls == 1
+
+    # a new instance on the same folder, as in a later run
+    checkpoints = Checkpoints(str(tmpdir))
+    assert checkpoints.run('corpus', key, stage) == {'love': 3}
+    assert stage.calls == 1
+    assert [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')] == []
+
+
+def test_input_changes(tmpdir):
+    passwords = tmpdir.join('passwords.txt')
+    passwords.write('love\n123\n')
+    checkpoints = Checkpoints(str(tmpdir.join('checkpoints')))
+
+    def corpus_key():
+        with open(str(passwords)) as f:
+            return checkpoints.key('corpus', input_digest(f), 'tagger-1')
+
+    stage = Stage('corpus')
+    checkpoints.run('corpus', corpus_key(), stage)
+    checkpoints.run('corpus', corpus_key(), stage)
+    assert stage.calls == 1
+
+    passwords.write('love\n1234\n')
+    checkpoints.run('corpus', corpus_key(), stage)
+    assert stage.calls == 2
+
+    # so do the options of the stage
+    with open(str(passwords)) as f:
+        digest = input_digest(f)
+    assert checkpoints.key('corpus', digest, 'tagger-1') != \
+        checkpoints.key('corpus', digest, 'tagger-2')
+
+    # lists that cannot be read twice have no digest
+    assert input_digest(io.StringIO('love\n')) is None
+
+
+def test_resume(tmpdir):
+    """ Later stages are keyed by the keys of earlier ones, so a run with
+    other options for a later stage, or after a failure, resumes from the
+    first stage whose artifact is missing. """
+    checkpoints = Checkpoints(str(tmpdir))
+    stages = {'corpus': Stage('corpus'), 'treecut': Stage('treecut'),
+              'grammar': Stage('grammar')}
+
+    def train(estimator, fail=False):
+        corpus_key = checkpoints.key('corpus', 'digest')
+        checkpoints.run('corpus', corpus_key, stages['corpus'])
+        treecut_key = checkpoints.key('treecut', corpus_key, 'abstraction')
+        checkpoints.run('treecut', treecut_key, stages['treecut'])
+        if fail:
+            raise KeyboardInterrupt()
+        grammar_key = checkpoints.key('grammar', treecut_key, estimator)
+        return checkpoints.run('grammar', grammar_key, stages['grammar'])
+
+    try:
+        train('laplace', fail=True)
+    except KeyboardInterrupt:
+        pass
+    assert train('laplace') == 'grammar'
+    assert train('mle') == 'grammar'
+    assert train('laplace') == 'grammar'
+
+    assert [stages[name].calls for name in ['corpus', 'treecut', 'grammar']] \
+        == [1, 1, 2]
+
+
+def test_disabled():
+    checkpoints = Checkpoints(None)
+    assert not checkpoints.enabled
+
+    key = checkpoints.key('corpus', None)
+    stage = Stage([1, 2, 3])
+    assert checkpoints.run('corpus', key, stage) == [1, 2, 3]
+    assert checkpoints.run('corpus', key, stage) == [1, 2, 3]
+    assert stage.calls == 2
+    assert not checkpoints.exists('corpus', key)
+
+
+def test_artifact_folder(tmpdir):
+    builder = CorpusBuilder()
+    builder.extend([([('love', 'vv0'), ('123', None)], 3)])
+    corpus = builder.build()
+
+    # saved as a folder and continued with memory-mapped
+    checkpoints = Checkpoints(str(tmpdir))
+    stage = Stage(corpus)
+    for i in range(2):
+        mapped = checkpoints.run('corpus', 'key', stage, TaggedCorpus)
+        assert mapped.path == checkpoints.path('corpus', 'key', True)
+        assert list(mapped) == list(corpus)
+    assert stage.calls == 1
+
+    # with checkpoints disabled, the artifact is the one computed
+    checkpoints = Checkpoints(None)
+    assert checkpoints.run('corpus', 'key', stage, TaggedCorpus) is corpus
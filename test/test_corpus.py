@@ -0,0 +1,53 @@
+from context import CorpusBuilder, TaggedCorpus, shared_corpus
+
+
+passwords = [
+    ([('i', 'ppis1'), ('love', 'vv0'), ('you', 'ppy')], 10),
+    ([('love', 'nn1')], 3),
+    ([('123', None)], 7),
+    ([('iloveyou', 'nn1'), ('123', None)], 2)
+]
+
+
+def test_round_trip():
+    builder = CorpusBuilder()
+    builder.extend(passwords)
+    corpus = builder.build()
+
+    assert len(corpus) == 4
+    assert corpus.num_chunks == 7
+    assert list(corpus) == passwords
+    assert list(corpus.passwords(1, 3)) == passwords[1:3]
+    assert corpus.lengths().tolist() == [3, 1, 1, 2]
+    assert corpus.chunk_counts().tolist() == [10, 10, 10, 3, 7, 2, 2]
+    assert set(corpus.pairs()) == set(chunk for x, count in passwords
+        for chunk in x)
+
+
+def test_synsets():
+    builder = CorpusBuilder()
+    builder.extend(passwords)
+    corpus = builder.build()
+
+    corpus.set_synsets({('love', 'vv0'): 'love.v.01',
+                        ('love', 'nn1'): 'love.n.01',
+                        ('iloveyou', 'nn1'): 'love.n.01'})
+
+    assert corpus.synset_counts() == {'love.v.01': 10, 'love.n.01': 5}
+
+
+def test_memory_mapping(tmpdir):
+    builder = CorpusBuilder()
+    builder.extend(passwords)
+    corpus = builder.build()
+    corpus.save(str(tmpdir))
+
+    mapped = TaggedCorpus.load(str(tmpdir), mmap_mode='r')
+    assert mapped.path == str(tmpdir)
+    assert list(mapped) == passwords
+
+    mapped.set_synsets({('love', 'vv0'): 'love.v.01'})
+    with shared_corpus(mapped) as handle:
+        shared = handle.open()
+        assert list(shared) == passwords
+        assert shared.synset_counts() == {'love.v.01': 10}
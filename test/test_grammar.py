@@ -1,8 +1,16 @@
-from context import Grammar
+from context import Grammar, GrammarCounts, GrammarTagger, \
+    count_factorized, alias_table, sample, train
+
+from collections import Counter, defaultdict
+
+import numpy as np
+import os
+import pickle
+import tempfile
 
 
 def test_tagging():
-    g = Grammar()
+    g = GrammarTagger()
 
     chunk = ('love', 'v', 'love.n.01')
     assert g._tag_semantic_backoff_pos(*chunk) == 'love.n.01'
@@ -11,7 +19,7 @@ def test_tagging():
 
     chunk = ('trampolining', 'v', None)
     assert g._tag_semantic_backoff_pos(*chunk) == 'v'
-    assert g._tag_pos_semantic(*chunk) == 'v_unkwn'
+    assert g._tag_pos_semantic(*chunk) == 'v_unk'
     assert g._tag_pos(*chunk) == 'v'
 
     chunk = ('usa', 'np', 'country.n.01')
@@ -35,5 +43,333 @@ def test_tagging():
     assert g._tag_pos(*chunk) == 'number6'
 
 
+def test_fit_parallel():
+    X = [([('love', 'vv0', None), ('123', None, None)], 3),
+         ([('dog', 'nn1', 'dog.n.01')], 2)] * 500
+
+    expected = Grammar(tagtype='backoff')
+    expected.fit(X)
+
+    # the stages of a training run share one pool
+    with train.WorkerPool(2) as pool:
+        for i in range(2):
+            g = Grammar(tagtype='backoff')
+            g.fit(X, pool=pool)
+
+            assert g.base_structures == expected.base_structures
+            assert g.tag_dicts == expected.tag_dicts
+
+
+def test_merge():
+    X = [([('love', 'vv0', None), ('123', None, None)], 3),
+         ([('dog', 'nn1', 'dog.n.01')], 2),
+         ([('dog', 'nn1', 'dog.n.01'), ('123', None, None)], 1),
+         ([('love', 'vv0', None), ('12', None, None)], 4)]
+
+    expected = Grammar(tagtype='backoff')
+    expected.fit(X)
+
+    g, other = Grammar(tagtype='backoff'), Grammar(tagtype='backoff')
+    g.fit(X[:2])
+    other.fit(X[2:])
+    g.merge(other)
+
+    assert g.base_structures == expected.base_structures
+    assert g.tag_dicts == expected.tag_dicts
+    assert g.counter == expected.counter
+
+
+def test_relabel():
+    def grammar():
+        g = Grammar(tagtype='pos_semantic')
+        g.add_counts(
+            {'nn1_bird.n.01': Counter({'crow': 3, 'eagle': 1}),
+             'nn1_ice_cream.n.01': Counter({'gelato': 2}),
+             'number3': Counter({'123': 4})},
+            Counter({'(nn1_bird.n.01)(number3)': 4,
+                     '(nn1_ice_cream.n.01)': 2}))
+        return g
+
+    changes = {'bird.n.01': Counter({'crow.n.01': 1, 'eagle.n.01': 1})}
+
+    def resolve(word, old_class, candidates):
+        return [c for c in candidates if c.startswith(word + '.')]
+
+    # words go to the classes they resolve to
+    g = grammar()
+    g.relabel(changes, resolve)
+    assert 'nn1_bird.n.01' not in g.tag_dicts
+    assert g.tag_dicts['nn1_crow.n.01'] == {'crow': 3}
+    assert g.tag_dicts['nn1_eagle.n.01'] == {'eagle': 1}
+    assert g.tag_dicts['nn1_ice_cream.n.01'] == {'gelato': 2}
+    assert g.base_structures == {'(nn1_crow.n.01)(number3)': 3,
+        '(nn1_eagle.n.01)(number3)': 1, '(nn1_ice_cream.n.01)': 2}
+
+    # otherwise, they are split by the weights of the new classes
+    g = grammar()
+    g.relabel(changes)
+    assert g.tag_dicts['nn1_crow.n.01'] == {'crow': 1.5, 'eagle': 0.5}
+    assert g.base_structures['(nn1_crow.n.01)(number3)'] == 2
+
+    # either way, the totals are kept
+    for resolver in [resolve, None]:
+        g = grammar()
+        g.relabel(changes, resolver)
+        assert sum(g.base_structures.values()) == g.counter == 6
+        assert sum(sum(terminals.values())
+            for terminals in g.tag_dicts.values()) == 10
+
+    # in backoff grammars, tags are classes, which may contain '_'
+    g = Grammar(tagtype='backoff')
+    g.add_counts({'ice_cream.n.01': Counter({'gelato': 2}),
+                  'cream.n.01': Counter({'cream': 1})},
+        Counter({'(ice_cream.n.01)': 2, '(cream.n.01)': 1}))
+    g.relabel({'cream.n.01': Counter({'dairy.n.01': 1})})
+    assert g.tag_dicts == {'ice_cream.n.01': {'gelato': 2},
+        'dairy.n.01': {'cream': 1}}
+    assert g.base_structures == {'(ice_cream.n.01)': 2, '(dairy.n.01)': 1}
+
+
+def test_grammar_counts():
+    chunks = [('love', 'vv0', None), ('123', None, None),
+        ('dog', 'nn1', 'dog.n.01'), ('usa', 'np', 'country.n.01')]
+    X = [([chunks[0], chunks[1]], 3), ([chunks[2]], 2),
+         ([chunks[2], chunks[3], chunks[1]], 1), ([chunks[0], chunks[1]], 4)]
+
+    expected = Grammar(tagtype='backoff')
+    for x, count in X:
+        expected.fit_incremental(x, count)
+
+    tagger = GrammarTagger()
+    counts = GrammarCounts.from_observations(tagger, 'backoff', X)
+    tags, base_structures = counts.to_dicts()
+    assert base_structures == expected.base_structures
+    assert tags == expected.tag_dicts
+
+    # partial counts of shards, with their own vocabularies
+    parts = [GrammarCounts.from_observations(tagger, 'backoff', X[:2]),
+             GrammarCounts.from_observations(tagger, 'backoff', X[2:])]
+    tags, base_structures = GrammarCounts.reduce(parts).to_dicts()
+    assert base_structures == expected.base_structures
+    assert tags == expected.tag_dicts
+
+
+def test_grammar_counts_factorized():
+    dog = [('dog', 'nn1', 'dog.n.01'), ('dog', 'nn1', 'animal.n.01'),
+           ('dog', 'nn1', 'dog.n.01')]
+    X = [([dog, [('123', None, None)]], 3), ([dog], 2)]
+
+    tags, base_structures = defaultdict(Counter), Counter()
+    for x, count in X:
+        count_factorized(GrammarTagger(), 'pos_semantic', x, count, tags,
+            base_structures)
+
+    counts = GrammarCounts.from_observations(GrammarTagger(), 'pos_semantic',
+        X, factorized=True)
+    tags_, base_structures_ = counts.to_dicts()
+
+    assert base_structures_.keys() == base_structures.keys()
+    for struct, count in base_structures.items():
+        assert abs(base_structures_[struct] - count) < 1e-9
+    assert abs(base_structures['(nn1_dog.n.01)(number3)'] - 2) < 1e-9
+    assert abs(tags_['nn1_animal.n.01']['dog'] - 5/3) < 1e-9
+
+
+def test_terminal_store():
+    g = Grammar(tagtype='pos', estimator='laplace')
+    g.tag_dicts['nn1'].update({'dog': 3, 'cat': 5, 'mouse': 0})
+    g.tag_dicts['vv0'].update({'love': 2, 'dog': 2})
+
+    terminals = g.terminals
+    assert terminals.top('nn1') == [('cat', 6/11), ('dog', 4/11),
+                                    ('mouse', 1/11)]
+    assert terminals.top('vv0', 1) == [('love', 3/6)]
+    assert terminals.prob('vv0', 'dog') == 3/6
+    assert terminals.prob('vv0', 'cat') == 0
+    assert terminals.prob('jj', 'cat') == 0
+    assert g.get_vocab() == {'dog', 'cat', 'mouse', 'love'}
+
+    assert terminals.draw('nn1', 0) == ('cat', 6/11)
+    assert terminals.draw('nn1', 0.99) == ('mouse', 1/11)
+
+    # saved in the compact form, and updated through the counts
+    g = pickle.loads(pickle.dumps(g))
+    g.tag_dicts['nn1']['cat'] += 11
+    assert g.terminals.top('nn1', 1) == [('cat', 17/22)]
+
+    # grammars pickled with tag_dicts
+    old = Grammar(tagtype='pos')
+    state = dict(old.__dict__, tag_dicts=defaultdict(Counter,
+        nn1=Counter({'dog': 1, 'cat': 3})))
+    del state['_tag_dicts'], state['_terminals']
+    old.__setstate__(state)
+    assert old.terminals.top('nn1') == [('cat', 0.75), ('dog', 0.25)]
+
+
+def test_rule_table():
+    g = Grammar(tagtype='pos')
+    g.add_counts(
+        {'nn1': Counter({'dog': 3, 'cat': 1}), 'number3': Counter({'123': 4}),
+         'vv0': Counter({'love': 2})},
+        Counter({'(nn1)(number3)': 1, '(vv0)(nn1)': 2, '(nn1)': 1}))
+
+    rules = g.rules
+    assert [rules.tag_names(i) for i in range(len(rules))] == \
+        [('vv0', 'nn1'), ('nn1', 'number3'), ('nn1',)]
+    assert rules.probabilities.tolist() == [0.5, 0.25, 0.25]
+    assert rules.find(['nn1', 'number3']) == 1
+    assert rules.find(['number3']) is None
+    assert rules.count(['vv0', 'nn1']) == 2
+    assert g.base_structure_probabilities() == [('(vv0)(nn1)', 0.5),
+        ('(nn1)(number3)', 0.25), ('(nn1)', 0.25)]
+
+    nn1, vv0 = rules.tag_ids['nn1'], rules.tag_ids['vv0']
+    assert rules[0] == (vv0, nn1)
+    assert rules.prefixes() == {(vv0,), (vv0, nn1), (nn1,),
+        (nn1, rules.tag_ids['number3'])}
+
+    for password, base_struct, p in g.sample(20):
+        assert base_struct in ('(vv0)(nn1)', '(nn1)(number3)', '(nn1)')
+        assert p > 0
+
+    # saved in the compact form, and updated through the counts
+    g = pickle.loads(pickle.dumps(g))
+    assert g.rules.count(['nn1']) == 1
+    g.base_structures['(nn1)'] += 3
+    assert g.rules.format(0) == '(nn1)'
+    assert g.rules.probabilities[0] == 4/7
+
+    # grammars pickled with base_structures
+    old = Grammar(tagtype='pos')
+    state = dict(old.__dict__, base_structures=Counter({'(nn1)': 1}))
+    del state['_base_structures'], state['_rules']
+    old.__setstate__(state)
+    assert old.base_structure_probabilities() == [('(nn1)', 1.0)]
+
+
+def test_binary_format():
+    g = Grammar(tagtype='pos', estimator='laplace')
+    g.add_counts(
+        {'nn1': Counter({'dog': 3, 'cat': 1}), 'number3': Counter({'123': 4}),
+         'vv0': Counter({'love': 2, 'l\u00f6ve': 1})},
+        Counter({'(nn1)(number3)': 1, '(vv0)(nn1)': 2}))
+    g.tag_dicts['jj'] = Counter()
+
+    with tempfile.TemporaryDirectory() as folder:
+        g.write_to_disk(folder, text=False)
+        assert os.listdir(folder) == [Grammar.BINARY_FILE]
+
+        loaded = Grammar.from_files(folder)
+        assert (loaded.tagtype, loaded.estimator, loaded.counter) == \
+            ('pos', 'laplace', 3)
+        assert loaded.base_structure_probabilities() == \
+            g.base_structure_probabilities()
+        for tag in g.terminals:
+            assert loaded.terminals.top(tag) == g.terminals.top(tag)
+        assert loaded.get_vocab() == g.get_vocab()
+
+        # updated through the counts, and saved again over the mapped file
+        loaded.tag_dicts['nn1']['cat'] += 4
+        loaded.write_to_disk(folder)
+        assert Grammar.from_files(folder).terminals.top('nn1', 1) == \
+            [('cat', 6/10)]
+        assert os.path.exists(os.path.join(folder, 'rules.txt'))
+
+
+def test_lazy_loading():
+    g = Grammar(tagtype='pos')
+    tags = ['t{}'.format(i) for i in range(10)]
+    g.add_counts({tag: Counter({tag + 'a': 2, tag + 'b': 1}) for tag in tags},
+        Counter({'({})'.format(tag): 1 for tag in tags}))
+
+    with tempfile.TemporaryDirectory() as folder:
+        g.write_to_disk(folder, text=False)
+        lazy = Grammar.from_files(folder, lazy=True)
+
+        terminals = lazy.terminals
+        for tag in tags:
+            assert terminals.prob(tag, tag + 'a') == 2/3
+            assert terminals.draw(tag, 0.9) == (tag + 'b', 1/3)
+        assert len(terminals._lookups) <= Grammar.LAZY_CACHE_SIZE
+
+        small = Grammar.from_binary(os.path.join(folder, Grammar.BINARY_FILE),
+            lazy=True, cache_size=3)
+        for tag in tags + tags[:2]:
+            assert small.terminals.prob(tag, tag + 'b') == 1/3
+        assert list(small.terminals._lookups.tables) == [9, 0, 1]
+
+        vocab = lazy.get_vocab()
+        assert 't3a' in vocab and 't9b' in vocab
+        assert 't3' not in vocab and 't9c' not in vocab and '' not in vocab
+        assert set(vocab) == g.get_vocab()
+        assert lazy.base_structure_probabilities() == \
+            g.base_structure_probabilities()
+
+
+def test_alias_sampling():
+    rng = np.random.default_rng(0)
+    for weights in [np.array([0.5, 0.3, 0.2]), rng.random(100) ** 4,
+            np.array([2.0]), np.zeros(3)]:
+        prob, alias = alias_table(weights)
+        n = len(weights)
+        implied = np.bincount(np.arange(n), prob / n, n) + \
+            np.bincount(alias, (1 - prob) / n, n)
+        expected = weights / weights.sum() if weights.sum() else np.ones(n) / n
+        assert np.allclose(implied, expected)
+
+    g = Grammar(tagtype='pos', estimator='laplace')
+    g.add_counts(
+        {'nn1': Counter({'dog': 3, 'cat': 1}), 'number3': Counter({'123': 4}),
+         'vv0': Counter({'love': 2, 'hate': 1})},
+        Counter({'(nn1)(number3)': 1, '(vv0)(nn1)': 3}))
+    prob = g.terminals.prob
+
+    drawn = list(g.sample(5000, rng=1))
+    assert drawn == list(g.sample(5000, rng=1))
+    for password, base_struct, p in drawn[:100]:
+        if base_struct == '(nn1)(number3)':
+            expected = 0.25 * prob('nn1', password[:3]) * prob('number3', '123')
+        else:
+            word = password[:4]
+            expected = 0.75 * prob('vv0', word) * prob('nn1', password[4:])
+        assert abs(p - expected) < 1e-12
+
+    structs = Counter(base_struct for _, base_struct, _ in drawn)
+    assert abs(structs['(vv0)(nn1)'] / 5000 - 0.75) < 0.03
+    dogs = sum(password.endswith('dog') for password, _, _ in drawn)
+    assert abs(dogs / structs['(vv0)(nn1)'] - 4/6) < 0.03
+
+
+def test_sample_shards():
+    g = Grammar(tagtype='pos')
+    g.add_counts({'nn1': Counter({'dog': 3, 'cat': 1}),
+                  'vv0': Counter({'love': 2, 'hate': 1})},
+        Counter({'(nn1)': 1, '(vv0)(nn1)': 3}))
+
+    with tempfile.TemporaryDirectory() as folder:
+        g.write_to_disk(folder, text=False)
+
+        def draw(num_workers):
+            return [(passwords, p.tolist()) for passwords, p in sample.sample(
+                folder, 250, num_workers, seed=3, shard_size=100)]
+
+        shards = draw(1)
+        assert [len(passwords) for passwords, p in shards] == [100, 100, 50]
+        assert shards == draw(2)
+
+        path = os.path.join(folder, 'sample.npz')
+        sample.write_npz(iter(shards), path)
+        with np.load(path) as data:
+            assert data['p'].tolist() == sum((p for _, p in shards), [])
+            assert len(data['password_offsets']) == 251
+            blob, offsets = data['passwords'].tobytes(), \
+                data['password_offsets'].tolist()
+            assert [blob[a:b].decode('utf-8') for a, b in zip(offsets,
+                offsets[1:])] == sum((passwords for passwords, _ in shards), [])
+        assert not [name for name in os.listdir(folder)
+            if name.startswith('sample-')]
 
-test_tagging()
+        sample.write_npz(iter([]), path)
+        with np.load(path) as data:
+            assert len(data['p']) == 0
+            assert data['password_offsets'].tolist() == [0]
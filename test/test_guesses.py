@@ -0,0 +1,118 @@
+from context import Grammar, guesses
+
+from collections import Counter
+
+import io
+import os
+import tempfile
+import itertools
+
+
+def grammar():
+    g = Grammar(tagtype='pos')
+    g.add_counts(
+        {'nn1': Counter({'dog': 5, 'cat': 3, 'cow': 3, 'owl': 1}),
+         'vv0': Counter({'love': 4, 'hate': 2, 'see': 1}),
+         'number2': Counter({'12': 6, '99': 1})},
+        Counter({'(vv0)(nn1)(number2)': 3, '(nn1)(number2)': 2,
+                 '(nn1)': 2, '(number2)': 1}))
+    return g
+
+
+def all_guesses(g):
+    rules, terminals = g.rules, g.terminals
+    for r in range(len(rules)):
+        options = [terminals.top(tag) for tag in rules.tag_names(r)]
+        for combination in itertools.product(*options):
+            p = float(rules.probabilities[r])
+            for word, q in combination:
+                p *= q
+            yield (''.join(w for w, q in combination), p, rules.format(r))
+
+
+def test_enumeration():
+    g = grammar()
+    expected = Counter(all_guesses(g))
+
+    for algorithm in ['deadbeat', 'next']:
+        for batch_size in [4, 10**6]:
+            output = list(guesses.guesses(g, algorithm,
+                batch_size=batch_size))
+            assert Counter(output) == expected
+            assert all(a[1] >= b[1] for a, b in zip(output, output[1:]))
+
+    # bands resume from the previous band's frontier or, if it does not
+    # fit, restart from the roots
+    for algorithm in ['deadbeat', 'next']:
+        resumed = list(guesses.GuessEnumerator(g, algorithm, batch_size=4))
+        restarted = list(guesses.GuessEnumerator(g, algorithm, batch_size=4,
+            frontier_size=2))
+        assert Counter(restarted) == Counter(resumed)
+        assert len(resumed) == sum(expected.values())
+
+    output = list(guesses.guesses(g, min_prob=0.01, min_length=4))
+    assert Counter(output) == Counter(guess for guess in expected
+        if guess[1] >= 0.01 and len(guess[0]) >= 4)
+
+
+def test_mangle():
+    assert guesses.mangle(['love', 'dog', '12'], ['vv0', 'nn1', 'number2']) \
+        == ['lovedog12', 'LOVEDOG12', 'LoveDog12', 'Lovedog12']
+    assert guesses.mangle(['dog'], ['nn1']) == ['dog', 'DOG', 'Dog']
+    assert guesses.mangle(['12', '!'], ['number2', 'special1']) == ['12!']
+
+    output = list(guesses.guesses(grammar(), mangled=True))
+    assert len(output) == len(set(output))
+    variants = [(guess, p) for guess, p, struct in output
+        if guess.lower() == 'dog12']
+    assert [guess for guess, p in variants] == ['dog12', 'DOG12', 'Dog12']
+    assert all(abs(p - 2/8 * 5/12 * 6/7) < 1e-12 for guess, p in variants)
+
+
+def test_write_guesses():
+    output = list(guesses.guesses(grammar()))
+
+    for limit, expected in [(None, output), (0, []), (2, output[:2])]:
+        f = io.StringIO()
+        guesses.write_guesses(iter(output), f, limit)
+        assert f.getvalue().splitlines() == [guess
+            for guess, p, struct in expected]
+
+
+def test_parallel():
+    g = grammar()
+    expected = Counter(guesses.guesses(g))
+
+    parts = guesses.partition_rules(g, 3)
+    assert sorted(sum(parts, [])) == list(range(len(g.rules)))
+
+    with tempfile.TemporaryDirectory() as folder:
+        g.write_to_disk(folder, text=False)
+
+        output = list(guesses.parallel_guesses(folder, 3, batch_size=4))
+        assert Counter(output) == expected
+        assert all(a[1] >= b[1] for a, b in zip(output, output[1:]))
+
+        paths = guesses.write_parts(folder, os.path.join(folder, 'parts'), 2)
+        lines = []
+        for path in paths:
+            with open(path) as f:
+                part = [line.rstrip('\n').split('\t') for line in f]
+            assert all(float(a[1]) >= float(b[1])
+                for a, b in zip(part, part[1:]))
+            lines.extend(part)
+        assert len(lines) == sum(expected.values())
+
+
+def test_guess_number():
+    g = grammar()
+    probabilities = [p for guess, p, struct in all_guesses(g)]
+    counter = guesses.GuessCounter(g)
+
+    for p in probabilities + [0, 1, 0.005]:
+        expected = sum(1 for q in probabilities
+            if q > p * (1 + guesses.GuessCounter.TIES))
+        assert counter.count(p) == expected
+        assert counter.count(p, limit=expected) == expected
+        if expected:
+            assert counter.count(p, limit=expected - 1) is None
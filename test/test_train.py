@@ -0,0 +1,172 @@
+from context import train, Grammar, CorpusBuilder
+
+from collections import Counter
+
+import io
+import os
+
+
+def test_tally_sharded(tmpdir, monkeypatch):
+    # duplicates far apart in the list, so that they are read in different
+    # blocks, and mixed case, which is counted lowercased
+    passwords = ['password{}'.format(i % 3000) for i in range(9000)]
+    passwords += ['Love', 'LOVE', 'love', '   ', 'abc']
+    path = tmpdir.join('passwords.txt')
+    path.write('\n'.join(passwords) + '\n')
+
+    with open(str(path)) as f:
+        expected = train.tally(f)
+
+    depths, paths = [], []
+    partition = train._partition
+
+    def _partition(passwords, folder, num_shards, depth, *args):
+        shards = partition(passwords, folder, num_shards, depth, *args)
+        depths.append(depth)
+        paths.extend(path for path, depth in shards)
+        return shards
+
+    monkeypatch.setattr(train, '_partition', _partition)
+
+    # a budget of a few passwords per shard forces shards to be split again
+    counts = Counter()
+    with open(str(path)) as f:
+        for password, count in train.tally_sharded(f, 1000, str(tmpdir)):
+            assert password not in counts
+            counts[password] = count
+
+    assert counts == expected
+    assert max(depths) > 0
+    assert len(set(paths)) == len(paths)  # no shard overwrote another
+    assert tmpdir.listdir() == [path]
+
+
+class NeighbourTagger(object):
+    """A POS tagger whose tags depend on the tokens around each token."""
+
+    def tag(self, tokens):
+        return [(token, 'nn1' if i == len(tokens) - 1 else 'jj')
+            for i, token in enumerate(tokens)]
+
+
+class ShortWordBlacklist(object):
+
+    def is_bad(self, word):
+        return len(word) < 3
+
+
+def test_memo_chunk_tagger():
+    # passwords sharing segments ('love', 'sweet') and skeletons
+    # (('love', None) for 'love123' and 'love!!')
+    passwords = ['iloveyou', 'iloveyou123', 'iloveyou!!', 'love123',
+        'love!!', '123love', 'ab1cd', 'ab12cd', 'sweetlove', 'sweetlove99',
+        'x1', '!!!', 'love', 'lovesweet2']
+    tagger = NeighbourTagger()
+
+    for blacklist in [None, ShortWordBlacklist()]:
+        memo = train.MemoChunkTagger(tagger, blacklist, cache_size=8)
+        for password in passwords * 2:
+            chunks = train.getchunks(password)
+            assert memo.chunk(password) == chunks
+            assert memo.chunk_and_tag(password) == \
+                train.pos_tag(chunks, tagger, blacklist)
+
+        assert memo._tag_skeleton.cache_info().hits > 0
+        assert memo.segment.cache_info().hits > 0
+
+
+def test_tally_chunk_tag(tmpdir):
+    # more distinct passwords than a batch, so that both workers tag some
+    words = ['i', 'love', 'you', 'my', 'dog', 'sweet', 'blue', 'sky', 'pass',
+        'word']
+    passwords = ['{}{}{}'.format(a, b, i) for a in words for b in words
+        for i in range(120)]
+    path = tmpdir.join('passwords.txt')
+    path.write('\n'.join(passwords + passwords[::7]) + '\n')
+
+    # tagged one password at a time, in this process
+    with open(str(path)) as f:
+        counts = train.tally(f)
+    tagger = train.BackoffTagger.from_pickle()
+    tagger.set_wordnet_instance(train.new_wordnet_instance())
+    blacklist = train.POSBlacklist()
+    expected = Counter((tuple(train.pos_tag(train.getchunks(password), tagger,
+        blacklist)), count) for password, count in counts.items())
+
+    with open(str(path)) as f:
+        corpus = train.tally_chunk_tag(f, 2)
+
+    assert len(corpus) == len(counts)
+    assert Counter((tuple(chunks), count) for chunks, count in corpus) == \
+        expected
+
+
+def test_train_without_checkpoints(tmpdir):
+    # a password list that cannot be read twice, like the standard input
+    passwords = io.StringIO('iloveyou\nlove123\niloveyou\n123456\n')
+
+    grammar = train.train_grammar(passwords, str(tmpdir), tagtype='pos',
+        estimator='mle', num_workers=1)
+
+    assert sum(grammar.base_structures.values()) == 4
+    assert grammar.tag_dicts['number6'] == Counter({'123456': 1})
+    assert os.path.exists(str(tmpdir.join('grammar.bin')))
+
+    loaded = Grammar.from_files(str(tmpdir))
+    assert loaded.base_structures == grammar.base_structures
+
+
+def test_update_grammar(tmpdir):
+    old, new = ['iloveyou', 'love123', 'dog'], ['iloveyou', 'dog99', '123456']
+
+    def train_on(passwords, folder):
+        return train.train_grammar(io.StringIO('\n'.join(passwords) + '\n'),
+            str(tmpdir.join(folder)), tagtype='pos', estimator='mle',
+            num_workers=1)
+
+    expected = train_on(old + new, 'expected')
+
+    train_on(old, 'grammar')
+    grammar = train.update_grammar(io.StringIO('\n'.join(new) + '\n'),
+        str(tmpdir.join('grammar')), num_workers=1)
+
+    assert grammar.base_structures == expected.base_structures
+    assert grammar.tag_dicts == expected.tag_dicts
+
+    loaded = Grammar.from_files(str(tmpdir.join('grammar')))
+    assert loaded.base_structures == expected.base_structures
+
+
+def test_resolve_synsets():
+    # repeated (string, pos) pairs, pairs without synsets and proper nouns
+    passwords = [([('love', 'vv0'), ('dogs', 'nn2')], 3),
+        ([('love', 'nn1')], 2), ([('love', 'vv0'), ('123', None)], 1),
+        ([('i', 'ppis1'), ('love', 'vv0'), ('dogs', 'nn2')], 4),
+        ([('paris', 'np1')], 1), ([('zzxq', 'nn1')], 1)]
+
+    builder = CorpusBuilder()
+    builder.extend(passwords)
+    corpus = builder.build()
+
+    # the synset of every chunk, looked up one row at a time
+    wordnet = train.new_wordnet_instance()
+    expected, counts, pairs = [], Counter(), set()
+    for x, count in passwords:
+        for string, pos in x:
+            syn = train.synset(string, pos, wordnet, train.tag_converter)
+            expected.append(syn.name() if syn is not None else None)
+            if syn is not None:
+                counts[syn.name()] += count
+                pairs.add((string, pos))
+    assert counts
+
+    # resolved once per distinct pair
+    table = train.resolve_synsets(corpus, 2)
+    assert set(table) == pairs
+    assert all(table[pair] == name for pair, name in zip(((string, pos)
+        for x, count in passwords for string, pos in x), expected) if name)
+
+    train.attach_synsets(corpus, 2)
+    assert [corpus.synset_names[i] if i >= 0 else None
+        for i in corpus.synsets.tolist()] == expected
+    assert corpus.synset_counts() == counts
@@ -1,7 +1,11 @@
 # %cd test
 from context import _li_abe, \
     li_abe, WordNetTreeNode, WordNetTree, DefaultTree,\
-    MleEstimator, LaplaceEstimator, DepthFirstIterator
+    MleEstimator, LaplaceEstimator, DepthFirstIterator, ArrayTree, TreeCut,\
+    wagner, benchmark, findcuts, TreeCutModel, IndexedWordNetTree, \
+    load_tree, wordnet_tree
+
+from collections import Counter
 
 import pickle
 
@@ -89,6 +93,181 @@ def test_dl_with_nodes():
     assert cut_mle[1].key == 'INSECT'
 
 
+def test_array_tree():
+    # the tree of test_dl_with_nodes, in depth-first order
+    keys = ['ANIMAL', 'BIRD', 'swallow', 'crow', 'eagle', 'bird',
+            'INSECT', 'bug', 'bee', 'insect']
+    parents = [-1, 0, 1, 1, 1, 1, 0, 6, 6, 6]
+    values  = [0, 0, 0, 2, 2, 4, 0, 0, 2, 0]
+
+    tree = ArrayTree(keys, parents, values)
+
+    assert tree.root.value == 10
+    assert tree.root.leaf_count == 7
+    assert tree.index['INSECT'][0].value == 2
+    assert [c.key for c in tree.root.children()] == ['BIRD', 'INSECT']
+    assert [l.key for l in tree.leaves()] == \
+        ['swallow', 'crow', 'eagle', 'bird', 'bug', 'bee', 'insect']
+    assert tree.index['bee'][0].parent.key == 'INSECT'
+
+    cut = li_abe.findcut(tree)
+    assert [node.key for node in cut] == ['BIRD', 'INSECT']
+
+    treecut = pickle.loads(pickle.dumps(TreeCut(tree, cut)))
+    assert [node.key for node in treecut] == ['BIRD', 'INSECT']
+    assert [node.key for node in treecut.abstract('crow')] == ['BIRD']
+
+
+def test_update():
+    # the tree of test_array_tree, with new counts
+    keys = ['ANIMAL', 'BIRD', 'swallow', 'crow', 'eagle', 'bird',
+            'INSECT', 'bug', 'bee', 'insect']
+    parents = [-1, 0, 1, 1, 1, 1, 0, 6, 6, 6]
+
+    tcm = TreeCutModel('n', estimator='mle')
+    tcm.fit_tree(ArrayTree(keys, parents, [0, 0, 0, 2, 2, 4, 0, 0, 2, 0]))
+    assert [node.key for node in tcm.treecut] == ['BIRD', 'INSECT']
+
+    # without new counts, the cut is not refitted
+    assert tcm.update(ArrayTree(keys, parents, [0] * 10)) == {}
+
+    # many crows refine BIRD; the new classes are weighted by leaf counts
+    changes = tcm.update(ArrayTree(keys, parents,
+        [0, 0, 0, 30, 0, 0, 0, 0, 0, 0]))
+    assert tcm.tree.root.value == 40
+    assert [node.key for node in tcm.treecut] == \
+        ['swallow', 'crow', 'eagle', 'bird', 'INSECT']
+    assert changes == {'BIRD': Counter({'crow': 33, 'bird': 5, 'eagle': 3,
+        'swallow': 1})}
+
+    try:
+        tcm.update(ArrayTree(keys[:2], parents[:2], [0, 1]))
+        assert False
+    except ValueError:
+        pass
+
+
+class FakeSynset(object):
+
+    def __init__(self, wordnet, name):
+        self.wordnet = wordnet
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def hyponyms(self):
+        return [self.wordnet.synset(name)
+            for name in self.wordnet.hyponyms.get(self._name, [])]
+
+    def hypernyms(self):
+        return [self.wordnet.synset(parent) for parent, children
+            in self.wordnet.hyponyms.items() if self._name in children]
+
+    def hypernym_paths(self):
+        parents = self.hypernyms()
+        if not parents:
+            return [[self]]
+        return [path + [self] for parent in parents
+            for path in parent.hypernym_paths()]
+
+
+class FakeWordNet(object):
+    """A WordNet of a few verbs, in the interface WordNetTree uses."""
+
+    def __init__(self, version, hyponyms):
+        self.version = version
+        self.hyponyms = hyponyms
+
+    def get_version(self):
+        return self.version
+
+    def synset(self, name):
+        return FakeSynset(self, name)
+
+    def all_synsets(self, pos):
+        names = set(self.hyponyms)
+        for children in self.hyponyms.values():
+            names.update(children)
+        return [self.synset(name) for name in sorted(names)]
+
+
+def test_tree_snapshots(tmpdir, monkeypatch):
+    monkeypatch.setattr(wordnet_tree, '_snapshots', dict())
+    wordnet = FakeWordNet('1', {'move.v.01': ['run.v.01', 'walk.v.01'],
+        'run.v.01': ['sprint.v.01'], 'think.v.01': ['plan.v.01'],
+        'be.v.01': ['walk.v.01']})
+    folder = str(tmpdir)
+
+    def structure(tree):
+        snapshot = tree.snapshot()
+        return snapshot['keys'], snapshot['parents'].tolist()
+
+    fresh = IndexedWordNetTree('v', wordnet)
+    built = load_tree('v', wordnet, folder)
+    assert structure(built) == structure(fresh)
+    assert len(tmpdir.listdir()) == 1
+
+    # read back from the snapshot, in this process and in a new one
+    for i in range(2):
+        loaded = load_tree('v', wordnet, folder)
+        assert loaded is not built
+        assert structure(loaded) == structure(fresh)
+        assert loaded.index.keys() == fresh.index.keys()
+        assert [node.key for node in loaded.index['walk.v.01'][0].path()] \
+            == [node.key for node in fresh.index['walk.v.01'][0].path()]
+        array = load_tree('v', wordnet, folder, array=True)
+        assert list(array.keys) == structure(fresh)[0]
+        monkeypatch.setattr(wordnet_tree, '_snapshots', dict())
+
+    # a snapshot of another WordNet version is stale: the tree is rebuilt
+    wordnet = FakeWordNet('2', dict(wordnet.hyponyms,
+        **{'think.v.01': ['plan.v.01', 'dream.v.01']}))
+    loaded = load_tree('v', wordnet, folder)
+    assert 'dream.v.01' in loaded.index
+    assert structure(loaded) == structure(IndexedWordNetTree('v', wordnet))
+    assert len(tmpdir.listdir()) == 2
+
+    # snapshots of another folder are not shared, even of the same version
+    other = FakeWordNet('2', {'move.v.01': ['run.v.01']})
+    loaded = load_tree('v', other, str(tmpdir.join('other')))
+    assert structure(loaded) == structure(IndexedWordNetTree('v', other))
+    assert tmpdir.join('other').listdir()
+    assert 'dream.v.01' in load_tree('v', wordnet, folder).index
+
+
+def test_dynamic_programming_cut():
+    # findcut must return the same cuts as the recursive search
+    for seed in range(3):
+        tree = benchmark.random_tree(5000, seed=seed)
+        N = tree.root.value
+        estimators = [None, MleEstimator(N),
+            LaplaceEstimator(N, tree.root.leaf_count, 1)]
+
+        for estimator in estimators:
+            expected = li_abe.findcut_recursive(tree, estimator)
+            assert li_abe.findcut(tree, estimator) == expected
+
+            for weight in [1, 50, 1000]:
+                expected = wagner.findcut_recursive(tree, weight, estimator)
+                assert wagner.findcut(tree, weight, estimator) == expected
+
+
+def test_findcuts():
+    tree = benchmark.random_tree(5000)
+    estimator = MleEstimator(tree.root.value)
+
+    cuts = findcuts(tree, [None, 10, 100], estimator)
+    assert cuts[0][0] == li_abe.findcut(tree, estimator)
+    assert cuts[1][0] == wagner.findcut(tree, 10, estimator)
+    assert cuts[2][0] == wagner.findcut(tree, 100, estimator)
+
+    # description lengths are those of the cuts
+    sample_size = tree.root.value
+    dl = _li_abe.compute_dl(cuts[0][0], sample_size, estimator)
+    assert abs(cuts[0][1] - dl) < 1e-6 * dl
+
+
 def test_laplace_estimator():
     cut1  = [('ANIMAL', 10, 7)]
     cut2  = [('BIRD', 8, 4), ('INSECT', 2, 3)]